@@ -0,0 +1,165 @@
+"""Reading files for ``/attach``.
+
+Files are mapped into memory (or read in chunks where they can't be) and
+hashed straight from the mapping; their text is only decoded when the
+conversation doesn't already hold a blob with the same hash, so
+re-attaching a file that did not change costs one pass over its bytes
+and no copy. Binary files (a NUL byte near the start, or not UTF-8) and
+files over the size limits are skipped.
+"""
+
+import fnmatch
+import glob
+import hashlib
+import mmap
+import os
+from pathlib import Path
+from typing import Callable, Container, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Directories never descended into when a directory is attached
+SKIP_DIRS = {
+    ".git", ".hg", ".svn", "__pycache__", "node_modules", ".venv", "venv",
+    ".mypy_cache", ".pytest_cache", ".ruff_cache", ".tox", ".eggs",
+}
+
+# Bytes searched for a NUL byte to tell binary files apart
+BINARY_PROBE = 8192
+
+# Read size where a file can't be memory-mapped
+CHUNK_SIZE = 1 << 16
+
+
+def display_path(path: str) -> str:
+    """``path`` relative to the working directory when it is inside it."""
+    try:
+        return str(Path(path).relative_to(Path.cwd()))
+    except ValueError:
+        return path
+
+
+def _walk(root: str) -> Iterator[str]:
+    for directory, subdirs, files in os.walk(root):
+        subdirs[:] = sorted(d for d in subdirs if d not in SKIP_DIRS)
+        for name in sorted(files):
+            yield os.path.join(directory, name)
+
+
+def expand(patterns: Iterable[str]) -> Iterator[str]:
+    """Absolute paths of the files named by ``patterns``.
+
+    A pattern is a file, a directory (attached recursively) or a glob
+    (``**`` matches across directories). Each file is produced once.
+    """
+    seen = set()
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            paths = _walk(match) if os.path.isdir(match) else [match]
+            for path in paths:
+                path = os.path.abspath(path)
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+
+def match_attached(patterns: Iterable[str], attached: Iterable[str]) -> List[str]:
+    """Attached paths named by ``patterns`` (paths, directories or globs)."""
+    attached = list(attached)
+    selected = []
+    for pattern in patterns:
+        if pattern == "all":
+            return attached
+        pattern = os.path.abspath(os.path.expanduser(pattern))
+        for path in attached:
+            if path in selected:
+                continue
+            if path == pattern or path.startswith(pattern.rstrip(os.sep) + os.sep) \
+                    or fnmatch.fnmatchcase(path, pattern):
+                selected.append(path)
+    return selected
+
+
+def _from_buffer(buffer, known: Container[str]) -> Tuple[str, Optional[str], Optional[str]]:
+    if buffer.find(b"\0", 0, BINARY_PROBE) != -1:
+        return "binary", None, None
+    digest = hashlib.sha256(buffer).hexdigest()
+    if digest in known:
+        return "unchanged", digest, None
+    try:
+        # Decoded directly from the mapping, without an intermediate bytes copy
+        text = str(buffer, "utf-8")
+    except UnicodeDecodeError:
+        return "binary", None, None
+    return "ok", digest, text
+
+
+def read_file(path: str, max_bytes: int, known: Container[str] = ()) -> Tuple[str, Optional[str], Optional[str], int]:
+    """Read a text file for attaching.
+
+    Returns ``(status, digest, text, size)``. ``status`` is ``ok``;
+    ``unchanged`` if ``known`` has the digest already (``text`` is None
+    then); or why the file was skipped: ``binary``, ``too large``,
+    ``empty`` or ``unreadable``.
+    """
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > max_bytes:
+                return "too large", None, None, size
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return (*_from_buffer(mapped, known), size)
+            except ValueError:
+                # Empty, or a file that reports no size (e.g. under /proc)
+                pass
+            except OSError:
+                # Not mappable (pipes, some network filesystems)
+                pass
+            data = bytearray()
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+                if len(data) > max_bytes:
+                    return "too large", None, None, len(data)
+    except OSError:
+        return "unreadable", None, None, 0
+    if not data:
+        return "empty", None, None, 0
+    return (*_from_buffer(data, known), len(data))
+
+
+def collect(patterns: Iterable[str], known: Container[str], max_file_bytes: int, max_total_bytes: int,
+            cancelled: Callable[[], bool] = lambda: False) -> Dict[str, List]:
+    """Read the files named by ``patterns`` for attaching.
+
+    Meant to run in a worker thread; ``cancelled`` is polled between files.
+
+    Returns a dict with ``files``, a list of ``(path, digest, text or
+    None, size)`` of the files to attach (text is None for digests in
+    ``known``), and lists of the paths skipped for each reason
+    (``binary``, ``too large``, ``empty``, ``unreadable``, ``missing``).
+    ``max_total_bytes`` limits the size of the new blobs read.
+    """
+    result: Dict[str, List] = {"files": [], "binary": [], "too large": [], "empty": [], "unreadable": [],
+                               "missing": []}
+    # Files with the same content in this batch are only decoded once too
+    known = set(known)
+    total = 0
+    for path in expand(patterns):
+        if cancelled():
+            break
+        if not os.path.isfile(path):
+            result["missing"].append(path)
+            continue
+        status, digest, text, size = read_file(path, min(max_file_bytes, max_total_bytes - total), known)
+        if status in ("ok", "unchanged"):
+            result["files"].append((path, digest, text, size))
+            if text is not None:
+                known.add(digest)
+                total += size
+        else:
+            result[status].append(path)
+    return result
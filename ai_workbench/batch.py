@@ -0,0 +1,151 @@
+"""Concurrent batch execution of prompts across providers."""
+
+import asyncio
+import json
+import random
+import time
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from ai_workbench.conversation import Conversation
+from ai_workbench.providers import AIProvider
+from ai_workbench.resilience import is_resilient, is_transient, retry_counter
+
+
+def read_prompts(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """Parse prompt items from JSONL lines.
+
+    Each line is either a JSON string (the prompt) or an object with a
+    ``prompt`` key and optional ``id`` and ``system`` keys. Blank lines are
+    skipped; malformed lines become items with an ``error``.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            yield {"id": number, "error": f"invalid JSON on line {number}: {e}"}
+            continue
+        if isinstance(data, str):
+            data = {"prompt": data}
+        if not isinstance(data, dict) or not isinstance(data.get("prompt"), str):
+            yield {"id": number, "error": f"line {number} has no 'prompt' string"}
+            continue
+        data.setdefault("id", number)
+        yield data
+
+
+def build_messages(item: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Build the request messages for a prompt item."""
+    conversation = Conversation()
+    if item.get("system"):
+        conversation.add_system_message(item["system"])
+    conversation.add_user_message(item["prompt"])
+    return conversation.get_messages()
+
+
+class BatchRunner:
+    """Run prompt items through providers with bounded parallelism.
+
+    Every (item, provider) pair is one job. At most ``concurrency`` jobs run
+    at once, and results are written as JSONL in input order as soon as
+    every earlier result is out. Transient failures are retried by the
+    providers' resilience layer; only providers without one are retried
+    here, with exponential backoff and jitter. A result's ``attempts``
+    counts the retries of either.
+    """
+
+    def __init__(self, providers: List[AIProvider], output: IO[str], concurrency: int = 4,
+                 retries: int = 2, backoff: float = 1.0, on_result: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.providers = providers
+        self.output = output
+        self.concurrency = max(concurrency, 1)
+        self.retries = retries
+        self.backoff = backoff
+        self.on_result = on_result
+
+    async def _run_job(self, item: Dict[str, Any], provider: AIProvider) -> Dict[str, Any]:
+        result = {"id": item.get("id"), "provider": provider.name, "model": provider.model}
+        if "error" in item:
+            result.update({"response": None, "error": item["error"], "attempts": 0, "latency_ms": 0.0})
+            return result
+
+        messages = build_messages(item)
+        # Retrying around the resilience layer would multiply its attempts
+        retries = 0 if is_resilient(provider) else self.retries
+        retried = [0]
+        token = retry_counter.set(retried)
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                start = time.perf_counter()
+                try:
+                    response = await provider.agenerate_response(messages)
+                except Exception as e:
+                    latency = (time.perf_counter() - start) * 1000
+                    if attempt > retries or not is_transient(e):
+                        result.update({"response": None, "error": str(e), "attempts": attempt + retried[0],
+                                       "latency_ms": round(latency, 1)})
+                        return result
+                    delay = self.backoff * 2 ** (attempt - 1)
+                    await asyncio.sleep(delay + random.uniform(0, delay))
+                    continue
+                latency = (time.perf_counter() - start) * 1000
+                result.update({"response": response, "error": None, "attempts": attempt + retried[0],
+                               "latency_ms": round(latency, 1)})
+                return result
+        finally:
+            retry_counter.reset(token)
+
+    async def run(self, items: Iterable[Dict[str, Any]]) -> Dict[str, int]:
+        """Run all items and write their results.
+
+        Returns:
+            Counts of succeeded and failed jobs
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        # Bounds jobs that are queued, running or finished but not yet
+        # written, so a slow early job cannot make the reorder buffer grow
+        # without limit.
+        window = asyncio.Semaphore(self.concurrency * 4)
+        finished: Dict[int, Dict[str, Any]] = {}
+        next_index = 0
+        counts = {"succeeded": 0, "failed": 0}
+
+        def flush():
+            nonlocal next_index
+            while next_index in finished:
+                result = finished.pop(next_index)
+                self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                self.output.flush()
+                counts["failed" if result["error"] else "succeeded"] += 1
+                if self.on_result is not None:
+                    self.on_result(result)
+                next_index += 1
+                window.release()
+
+        async def worker():
+            while True:
+                job = await queue.get()
+                if job is None:
+                    return
+                index, item, provider = job
+                finished[index] = await self._run_job(item, provider)
+                flush()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        try:
+            index = 0
+            for item in items:
+                for provider in self.providers:
+                    await window.acquire()
+                    await queue.put((index, item, provider))
+                    index += 1
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        return counts
@@ -0,0 +1,242 @@
+"""Content-addressed on-disk cache for provider responses."""
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from ai_workbench.providers import AIProvider, ProviderWrapper
+
+
+class ResponseCache:
+    """SQLite-backed response store with TTL expiry and LRU size eviction.
+    
+    Each entry holds the response as the list of chunks it arrived in, so a
+    cached stream can be replayed chunk by chunk. The total size of the
+    entries is kept up to date by triggers, in the database so that every
+    process sharing it sees the same, and eviction doesn't sum it up on
+    every write.
+    """
+    
+    def __init__(self, path: Path, max_bytes: int, ttl: float):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(provider: str, model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> str:
+        """Hash a request into a cache key.
+        
+        Messages are normalised (line endings, surrounding whitespace) so that
+        trivially different prompts share an entry.
+        """
+        normalized = [
+            {"role": msg["role"], "content": msg["content"].replace("\r\n", "\n").strip()}
+            for msg in messages
+        ]
+        payload = json.dumps(
+            {"provider": provider, "model": model, "messages": normalized, "kwargs": kwargs},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Providers may be driven from worker threads, hence the shared
+            # connection guarded by our own lock.
+            self._conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # One transaction, so that a process opening the same file can't
+            # change entries between the totals row and its triggers
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " chunks TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL,"
+                " hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created ON responses (created)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)"
+            )
+            if self._conn.execute("SELECT 1 FROM totals").fetchone() is None:
+                # New database, or one written before the totals were kept
+                self._conn.execute("INSERT INTO totals VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM responses))")
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses"
+                " BEGIN UPDATE totals SET size = size + NEW.size; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses"
+                " BEGIN UPDATE totals SET size = size + NEW.size - OLD.size; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses"
+                " BEGIN UPDATE totals SET size = size - OLD.size; END"
+            )
+            self._conn.commit()
+        return self._conn
+    
+    def get(self, key: str) -> Optional[List[str]]:
+        """Return the cached chunks for ``key``, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT chunks FROM responses WHERE key = ? AND created >= ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET accessed = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+    
+    def put(self, key: str, chunks: List[str]):
+        """Store a complete response and evict entries over the limits."""
+        data = json.dumps(chunks)
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete
+            # would not fire the delete trigger
+            conn.execute(
+                "INSERT INTO responses (key, chunks, size, created, accessed) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET chunks = excluded.chunks, size = excluded.size,"
+                " created = excluded.created, accessed = excluded.accessed, hits = 0",
+                (key, data, len(data), now, now),
+            )
+            self._evict(conn, now)
+            conn.commit()
+    
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        """Drop expired entries, then least recently used ones until under the size limit."""
+        conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        total = conn.execute("SELECT size FROM totals").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        doomed = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return entry count, stored size and hit/miss counters."""
+        with self._lock:
+            entries, size, stored_hits = self._connect().execute(
+                "SELECT COUNT(*), (SELECT size FROM totals), COALESCE(SUM(hits), 0) FROM responses"
+            ).fetchone()
+        return {
+            "path": str(self.path),
+            "entries": entries,
+            "size_bytes": size,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "session_hits": self.hits,
+            "session_misses": self.misses,
+            "total_hits": stored_hits,
+        }
+    
+    def clear(self):
+        """Remove every cached response."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+            conn.execute("VACUUM")
+
+
+class CachedProvider(ProviderWrapper):
+    """Serve repeated requests from a ``ResponseCache``."""
+    
+    def __init__(self, provider: AIProvider, cache: ResponseCache):
+        super().__init__(provider)
+        self.cache = cache
+        # Whether the most recent request was answered from the cache
+        self.last_hit = False
+    
+    def _key(self, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> str:
+        return self.cache.make_key(self.name, self.model, messages, kwargs)
+    
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response, returning the cached one if available."""
+        key = self._key(messages, kwargs)
+        chunks = self.cache.get(key)
+        self.last_hit = chunks is not None
+        if chunks is not None:
+            return "".join(chunks)
+        response = self.provider.generate_response(messages, **kwargs)
+        self.cache.put(key, [response])
+        return response
+    
+    def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Generate a streaming response, replaying cached chunks if available."""
+        key = self._key(messages, kwargs)
+        chunks = self.cache.get(key)
+        self.last_hit = chunks is not None
+        if chunks is not None:
+            yield from chunks
+            return
+        received = []
+        for chunk in self.provider.generate_stream(messages, **kwargs):
+            received.append(chunk)
+            yield chunk
+        # Only reached when the stream ran to completion
+        self.cache.put(key, received)
+    
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response, returning the cached one if available."""
+        loop = asyncio.get_running_loop()
+        key = self._key(messages, kwargs)
+        chunks = await loop.run_in_executor(None, self.cache.get, key)
+        self.last_hit = chunks is not None
+        if chunks is not None:
+            return "".join(chunks)
+        response = await self.provider.agenerate_response(messages, **kwargs)
+        await loop.run_in_executor(None, self.cache.put, key, [response])
+        return response
+    
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Asynchronously generate a streaming response, replaying cached chunks if available.
+        
+        The cache is read and written in a worker thread: SQLite may wait on
+        the disk, or on another process writing to the same file.
+        """
+        loop = asyncio.get_running_loop()
+        key = self._key(messages, kwargs)
+        chunks = await loop.run_in_executor(None, self.cache.get, key)
+        self.last_hit = chunks is not None
+        if chunks is not None:
+            for chunk in chunks:
+                yield chunk
+            return
+        received = []
+        stream = self.provider.agenerate_stream(messages, **kwargs)
+        try:
+            async for chunk in stream:
+                received.append(chunk)
+                yield chunk
+        finally:
+            # Stopped early (e.g. cancelled): close the provider's stream now
+            # rather than when the generator is garbage collected
+            await stream.aclose()
+        await loop.run_in_executor(None, self.cache.put, key, received)
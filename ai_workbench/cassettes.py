@@ -0,0 +1,499 @@
+"""Recording provider exchanges into cassettes and replaying them offline.
+
+With ``--record DIR`` every HTTP exchange of the providers is written to
+DIR as a cassette: the response status and headers, the time until the
+response started and every chunk of the body with its arrival time.
+``--replay DIR`` answers the requests from those cassettes instead of the
+network, at the recorded pace (or faster, see ``replay_speed``), so
+rendering and conversation handling see exactly the stream they saw when
+it was recorded, without credentials, costs or a network.
+
+Recording and replay happen below the SDKs, in the HTTP transport of the
+pooled clients (OpenAI, Anthropic) and in the session of Gemini's REST
+transport, so the providers run their usual code.
+
+A cassette is a gzip-compressed JSON file named after a digest of the
+request: method, path, query (without API keys) and body, with JSON
+bodies compared by content. A request sent several times in a session is
+recorded once per time (``<digest>.json.gz``, ``<digest>.1.json.gz``,
+...) and replayed in the same order. A request without a cassette is
+answered with a 404 error naming it.
+"""
+
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from ai_workbench.config import config
+
+# Response headers that described the recorded connection, not the reply
+_DROPPED_HEADERS = frozenset({"connection", "keep-alive", "transfer-encoding", "content-length"})
+
+# Query parameters holding credentials, left out of digests and cassettes
+_SECRET_PARAMS = frozenset({"key", "api_key"})
+
+# Chunks arriving within this many seconds of the previous one are stored
+# as one; some clients read the body a byte at a time
+_COALESCE = 0.002
+
+
+def _strip_secrets(url: str) -> Tuple[str, str]:
+    """``url`` without credentials, and its path and sorted query."""
+    parts = urlsplit(url)
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                             if k not in _SECRET_PARAMS))
+    return urlunsplit(parts._replace(query=query)), f"{parts.path}?{query}"
+
+
+def request_key(method: str, url: str, body: Optional[bytes]) -> str:
+    """Digest identifying a request, independent of the host and credentials."""
+    _, target = _strip_secrets(url)
+    body = body or b""
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":")).encode("utf-8")
+    except ValueError:
+        pass
+    digest = hashlib.sha256(f"{method.upper()} {target}\n".encode("utf-8"))
+    digest.update(body)
+    return digest.hexdigest()[:32]
+
+
+class Exchange:
+    """A recorded response: status, headers, wait and timed body chunks.
+
+    Args:
+        status: HTTP status
+        headers: Response headers as (name, value) pairs
+        wait: Seconds from sending the request until the response started
+        chunks: ``(offset, data)`` pairs, offsets in seconds from the start
+            of the response
+    """
+
+    def __init__(self, status: int, headers: List[Tuple[str, str]], wait: float = 0.0,
+                 chunks: Optional[List[Tuple[float, bytes]]] = None):
+        self.status = status
+        self.headers = headers
+        self.wait = wait
+        self.chunks = chunks or []
+
+    @classmethod
+    def missing(cls, method: str, url: str, directory: Path) -> "Exchange":
+        """An error response for a request that was not recorded."""
+        message = f"No recording of {method} {_strip_secrets(url)[0]} in {directory}"
+        body = {"type": "error", "error": {"type": "not_found_error", "code": 404, "status": "NOT_FOUND",
+                                           "message": message}}
+        return cls(404, [("content-type", "application/json")], chunks=[(0.0, json.dumps(body).encode("utf-8"))])
+
+    def to_json(self, method: str, url: str) -> Dict[str, Any]:
+        chunks = []
+        for offset, data in self.chunks:
+            try:
+                chunks.append([round(offset, 4), data.decode("utf-8")])
+            except UnicodeDecodeError:
+                chunks.append([round(offset, 4), {"b64": base64.b64encode(data).decode("ascii")}])
+        return {"method": method, "url": _strip_secrets(url)[0], "status": self.status,
+                "headers": self.headers, "wait": round(self.wait, 4), "chunks": chunks}
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Exchange":
+        chunks = []
+        for offset, chunk in data["chunks"]:
+            chunks.append((offset, base64.b64decode(chunk["b64"]) if isinstance(chunk, dict) else chunk.encode("utf-8")))
+        return cls(data["status"], [tuple(h) for h in data["headers"]], data["wait"], chunks)
+
+
+class Recording:
+    """An exchange being recorded; saved when its body ends or is closed."""
+
+    def __init__(self, store: "CassetteStore", path: Path, method: str, url: str):
+        self.store = store
+        self.path = path
+        self.method = method
+        self.url = url
+        self.exchange = Exchange(0, [])
+        self._sent = time.monotonic()
+        self._started = self._sent
+        self._last = 0.0
+        self._saved = False
+
+    def respond(self, status: int, headers: Iterable[Tuple[str, str]], dropped: Iterable[str] = ()):
+        """Record the start of the response."""
+        self._started = time.monotonic()
+        skip = _DROPPED_HEADERS.union(dropped)
+        self.exchange.status = status
+        self.exchange.headers = [(k, v) for k, v in headers if k.lower() not in skip]
+        self.exchange.wait = self._started - self._sent
+
+    def add(self, data: bytes):
+        """Record a chunk of the body."""
+        if not data:
+            return
+        now = time.monotonic() - self._started
+        chunks = self.exchange.chunks
+        if chunks and now - self._last < _COALESCE:
+            chunks[-1] = (chunks[-1][0], chunks[-1][1] + data)
+        else:
+            chunks.append((now, bytes(data)))
+        self._last = now
+
+    def finish(self):
+        """Save the cassette (once)."""
+        if not self._saved:
+            self._saved = True
+            self.store.save(self.path, self.exchange.to_json(self.method, self.url))
+
+
+class CassetteStore:
+    """A directory of cassettes, recorded to or replayed from.
+
+    Args:
+        directory: Directory of the cassettes
+        record: Record exchanges (True) or replay them (False)
+        speed: Replay speed: 1 keeps the recorded timing, 10 is ten times
+            faster, 0 sends everything at once
+    """
+
+    def __init__(self, directory: Path, record: bool, speed: float = 1.0):
+        self.directory = Path(directory).expanduser()
+        self.record = record
+        self.speed = speed
+        # Requests seen so far per digest, so repeats map to the nth cassette
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        if record:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str, index: int) -> Path:
+        return self.directory / (f"{key}.json.gz" if not index else f"{key}.{index}.json.gz")
+
+    def _next_index(self, key: str) -> int:
+        with self._lock:
+            index = self._counts.get(key, 0)
+            self._counts[key] = index + 1
+            return index
+
+    def start(self, method: str, url: str, body: Optional[bytes]) -> Recording:
+        """Begin recording a request's exchange."""
+        key = request_key(method, url, body)
+        return Recording(self, self._path(key, self._next_index(key)), method, url)
+
+    def save(self, path: Path, data: Dict[str, Any]):
+        """Write a cassette atomically."""
+        temp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        temp.write_bytes(gzip.compress(json.dumps(data, separators=(",", ":")).encode("utf-8")))
+        os.replace(temp, path)
+
+    def find(self, method: str, url: str, body: Optional[bytes]) -> Exchange:
+        """The recorded exchange for a request.
+
+        The nth identical request gets the nth recording, or the last one
+        if it was sent fewer times when recording.
+        """
+        key = request_key(method, url, body)
+        for index in range(self._next_index(key), -1, -1):
+            path = self._path(key, index)
+            if path.exists():
+                return Exchange.from_json(json.loads(gzip.decompress(path.read_bytes())))
+        return Exchange.missing(method, url, self.directory)
+
+    def delay(self, seconds: float) -> float:
+        """Recorded seconds scaled to the replay speed."""
+        return seconds / self.speed if self.speed > 0 else 0.0
+
+    def mount(self, session):
+        """Record or replay the exchanges of a ``requests`` session."""
+        adapter = _requests_adapter_class(self.record)(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+
+_store: Optional[Tuple[tuple, Optional[CassetteStore]]] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> Optional[CassetteStore]:
+    """The cassette store of the configured mode, or None when neither recording nor replaying."""
+    global _store
+    if config.replay_dir:
+        settings = (str(config.replay_dir), False, config.replay_speed)
+    elif config.record_dir:
+        settings = (str(config.record_dir), True, 1.0)
+    else:
+        return None
+    with _store_lock:
+        if _store is None or _store[0] != settings:
+            _store = (settings, CassetteStore(Path(settings[0]), settings[1], settings[2]))
+        return _store[1]
+
+
+def _timed(exchange: Exchange, store: CassetteStore):
+    """Yield the chunks of ``exchange`` with the (scaled) seconds to wait before each."""
+    started = time.monotonic()
+    for offset, data in exchange.chunks:
+        yield max(started + store.delay(offset) - time.monotonic(), 0.0), data
+
+
+# Transport classes per httpx-style library (httpx or the SDKs' fork)
+_http_classes: Dict[Any, Dict[str, type]] = {}
+
+
+def _http_transport_classes(http) -> Dict[str, type]:
+    """Transport and stream classes derived from the library ``http``'s base classes.
+
+    Clients and responses check that their transports and streams come
+    from their own library, so the classes are built for each one.
+    """
+    classes = _http_classes.get(http)
+    if classes is not None:
+        return classes
+
+    class RecordingStream(http.SyncByteStream):
+        def __init__(self, stream, recording: Recording):
+            self._stream = stream
+            self._recording = recording
+
+        def __iter__(self):
+            for data in self._stream:
+                self._recording.add(data)
+                yield data
+            self._recording.finish()
+
+        def close(self):
+            try:
+                self._stream.close()
+            finally:
+                self._recording.finish()
+
+    class AsyncRecordingStream(http.AsyncByteStream):
+        def __init__(self, stream, recording: Recording):
+            self._stream = stream
+            self._recording = recording
+
+        async def __aiter__(self):
+            async for data in self._stream:
+                self._recording.add(data)
+                yield data
+            self._recording.finish()
+
+        async def aclose(self):
+            try:
+                await self._stream.aclose()
+            finally:
+                self._recording.finish()
+
+    class ReplayStream(http.SyncByteStream):
+        def __init__(self, exchange: Exchange, store: CassetteStore):
+            self._exchange = exchange
+            self._store = store
+
+        def __iter__(self):
+            for wait, data in _timed(self._exchange, self._store):
+                if wait:
+                    time.sleep(wait)
+                yield data
+
+    class AsyncReplayStream(http.AsyncByteStream):
+        def __init__(self, exchange: Exchange, store: CassetteStore):
+            self._exchange = exchange
+            self._store = store
+
+        async def __aiter__(self):
+            for wait, data in _timed(self._exchange, self._store):
+                if wait:
+                    await asyncio.sleep(wait)
+                yield data
+
+    class RecordingTransport(http.BaseTransport):
+        def __init__(self, store: CassetteStore, transport):
+            self._store = store
+            self._transport = transport
+
+        def handle_request(self, request):
+            request.read()
+            # Uncompressed, so the cassettes show the chunks as they were streamed
+            request.headers["Accept-Encoding"] = "identity"
+            recording = self._store.start(request.method, str(request.url), request.content)
+            response = self._transport.handle_request(request)
+            recording.respond(response.status_code, response.headers.multi_items())
+            return http.Response(response.status_code, headers=response.headers,
+                                 stream=RecordingStream(response.stream, recording), extensions=response.extensions)
+
+        def close(self):
+            self._transport.close()
+
+    class AsyncRecordingTransport(http.AsyncBaseTransport):
+        def __init__(self, store: CassetteStore, transport):
+            self._store = store
+            self._transport = transport
+
+        async def handle_async_request(self, request):
+            await request.aread()
+            request.headers["Accept-Encoding"] = "identity"
+            recording = self._store.start(request.method, str(request.url), request.content)
+            response = await self._transport.handle_async_request(request)
+            recording.respond(response.status_code, response.headers.multi_items())
+            return http.Response(response.status_code, headers=response.headers,
+                                 stream=AsyncRecordingStream(response.stream, recording),
+                                 extensions=response.extensions)
+
+        async def aclose(self):
+            await self._transport.aclose()
+
+    class ReplayTransport(http.BaseTransport):
+        def __init__(self, store: CassetteStore):
+            self._store = store
+
+        def handle_request(self, request):
+            request.read()
+            exchange = self._store.find(request.method, str(request.url), request.content)
+            time.sleep(self._store.delay(exchange.wait))
+            return http.Response(exchange.status, headers=exchange.headers, stream=ReplayStream(exchange, self._store))
+
+    class AsyncReplayTransport(http.AsyncBaseTransport):
+        def __init__(self, store: CassetteStore):
+            self._store = store
+
+        async def handle_async_request(self, request):
+            await request.aread()
+            exchange = self._store.find(request.method, str(request.url), request.content)
+            await asyncio.sleep(self._store.delay(exchange.wait))
+            return http.Response(exchange.status, headers=exchange.headers,
+                                 stream=AsyncReplayStream(exchange, self._store))
+
+    classes = _http_classes[http] = {
+        "record": RecordingTransport, "async_record": AsyncRecordingTransport,
+        "replay": ReplayTransport, "async_replay": AsyncReplayTransport,
+    }
+    return classes
+
+
+def http_transport(http, is_async: bool, limits):
+    """A recording or replaying transport for an httpx-style client, or None.
+
+    Args:
+        http: The client's HTTP library (``httpx`` or the SDK's fork)
+        is_async: Whether the client is an ``AsyncClient``
+        limits: Connection limits of the network transport when recording
+    """
+    store = get_store()
+    if store is None:
+        return None
+    classes = _http_transport_classes(http)
+    prefix = "async_" if is_async else ""
+    if not store.record:
+        return classes[prefix + "replay"](store)
+    network = http.AsyncHTTPTransport(limits=limits) if is_async else http.HTTPTransport(limits=limits)
+    return classes[prefix + "record"](store, network)
+
+
+class _RecordingBody:
+    """A ``requests`` response body that records what is read from it."""
+
+    def __init__(self, raw, recording: Recording):
+        self._raw = raw
+        self._recording = recording
+
+    def stream(self, amt=None, decode_content=None):
+        for data in self._raw.stream(amt, decode_content=True):
+            self._recording.add(data)
+            yield data
+        self._recording.finish()
+
+    def close(self):
+        try:
+            self._raw.close()
+        finally:
+            self._recording.finish()
+
+    def __getattr__(self, name: str):
+        return getattr(self._raw, name)
+
+
+class _ReplayBody:
+    """A ``requests`` response body streaming a recorded exchange."""
+
+    def __init__(self, exchange: Exchange, store: CassetteStore):
+        self._chunks = _timed(exchange, store)
+
+    def stream(self, amt=None, decode_content=None):
+        for wait, data in self._chunks:
+            if wait:
+                time.sleep(wait)
+            yield data
+
+    def read(self, amt=None, decode_content=None):
+        return b"".join(self.stream())
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+_adapter_classes: Dict[bool, type] = {}
+
+
+def _requests_adapter_class(record: bool) -> type:
+    """The ``requests`` adapter class recording (or replaying) exchanges.
+
+    Built on first use, so that ``requests`` is only imported when needed.
+    """
+    adapter_class = _adapter_classes.get(record)
+    if adapter_class is not None:
+        return adapter_class
+    import requests
+    from requests.adapters import BaseAdapter, HTTPAdapter
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    def body_of(request) -> bytes:
+        body = request.body or b""
+        return body.encode("utf-8") if isinstance(body, str) else body
+
+    class RecordingAdapter(HTTPAdapter):
+        def __init__(self, store: CassetteStore):
+            super().__init__()
+            self._store = store
+
+        def send(self, request, **kwargs):
+            request.headers["Accept-Encoding"] = "identity"
+            recording = self._store.start(request.method, request.url, body_of(request))
+            response = super().send(request, **kwargs)
+            # The body is recorded as decoded
+            recording.respond(response.status_code, response.headers.items(), dropped=("content-encoding",))
+            response.raw = _RecordingBody(response.raw, recording)
+            return response
+
+    class ReplayAdapter(BaseAdapter):
+        def __init__(self, store: CassetteStore):
+            super().__init__()
+            self._store = store
+
+        def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+            exchange = self._store.find(request.method, request.url, body_of(request))
+            time.sleep(self._store.delay(exchange.wait))
+            response = requests.Response()
+            response.status_code = exchange.status
+            response.headers = CaseInsensitiveDict(exchange.headers)
+            response.encoding = get_encoding_from_headers(response.headers)
+            response.raw = _ReplayBody(exchange, self._store)
+            response.reason = ""
+            response.url = request.url
+            response.request = request
+            response.connection = self
+            return response
+
+        def close(self):
+            pass
+
+    adapter_class = _adapter_classes[record] = RecordingAdapter if record else ReplayAdapter
+    return adapter_class
@@ -1,26 +1,180 @@
 """Main CLI interface for AI Terminal Workbench."""
 
+import asyncio
+import os
+import signal
 import sys
+import time
 import click
-from rich.console import Console
-from rich.markdown import Markdown
-from rich.panel import Panel
-from rich.prompt import Prompt
-from prompt_toolkit import PromptSession
-from prompt_toolkit.history import InMemoryHistory
 
 from ai_workbench.config import config
 from ai_workbench.conversation import Conversation
-from ai_workbench.providers.openai_provider import OpenAIProvider
-from ai_workbench.providers.anthropic_provider import AnthropicProvider
-from ai_workbench.providers.google_provider import GoogleProvider
+from ai_workbench.providers import PROVIDERS, get_provider_class
 
 
-console = Console()
+class _LazyConsole:
+    """A Rich console that is only created (and Rich imported) on first use.
+    
+    ``ai-workbench ask`` writing to a pipe never prints through Rich, so
+    it doesn't pay for importing it.
+    """
+    
+    def __init__(self, **options):
+        self._options = options
+        self._console = None
+    
+    def load(self):
+        """Return the Rich console, creating it on first use."""
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console(**self._options)
+        return self._console
+    
+    def __getattr__(self, name: str):
+        return getattr(self.load(), name)
+
+
+console = _LazyConsole()
+# Diagnostics that must not mix with results written to stdout
+errors = _LazyConsole(stderr=True)
+
+# Shared response cache, opened on first use
+_response_cache = None
+
+# Request telemetry shared by every provider instance
+_telemetry = None
+
+# Status of the shared daemon (see get_daemon); False until looked for.
+# --daemon/--no-daemon override AWB_DAEMON through _daemon_mode.
+_daemon = False
+_daemon_mode = None
+
+# Asks for the rest of an interrupted reply, for providers that can't prefill it
+CONTINUE_PROMPT = ("Your previous reply was interrupted. Continue it exactly where it stopped, "
+                   "without repeating any of it or commenting on the interruption.")
+
+
+def get_response_cache():
+    """Return the shared response cache, or None if caching is disabled."""
+    global _response_cache
+    if _response_cache is None and config.cache_enabled:
+        from ai_workbench.cache import ResponseCache
+        _response_cache = ResponseCache(
+            config.cache_dir / "responses.sqlite3",
+            max_bytes=int(config.cache_max_mb * 1024 * 1024),
+            ttl=config.cache_ttl,
+        )
+    return _response_cache
+
+
+def get_telemetry(metrics_file: str = None, prometheus_file: str = None):
+    """Return the shared request telemetry, creating it on first use.
+    
+    The file arguments override the configured export files; they only
+    take effect on the first call.
+    """
+    global _telemetry
+    if _telemetry is None:
+        from ai_workbench.telemetry import Telemetry
+        _telemetry = Telemetry(metrics_file or config.metrics_file, prometheus_file or config.prometheus_file)
+    return _telemetry
+
+
+def report_retry(provider, attempt: int, delay: float, error: BaseException):
+    """Tell the user that a request failed and is being retried."""
+    # stderr, so that batch results written to stdout stay clean
+    errors.print(f"[dim]{provider.name}: {error.__class__.__name__}: {error}; "
+                 f"retrying in {delay:.1f}s (retry {attempt} of {config.max_retries})[/dim]")
+
+
+def report_failover(route, next_route, error: BaseException):
+    """Tell the user that a routed request failed over to another model."""
+    errors.print(f"[dim]{route.provider_name}/{route.model}: {error.__class__.__name__}: {error}; "
+                 f"failing over to {next_route.provider_name}/{next_route.model}[/dim]")
+
+
+def get_daemon():
+    """Return the status of the shared daemon to send requests to.
+    
+    Returns None when requests are made in this process: the daemon is
+    disabled, or (with ``AWB_DAEMON=auto``) none is running. The daemon
+    is looked for once, when the first provider is created.
+    """
+    global _daemon
+    if _daemon is False:
+        mode = _daemon_mode or config.daemon
+        _daemon = None
+        # Cassettes are recorded and replayed by the providers of this process
+        if mode not in ("0", "false", "no", "off") and not (config.record_dir or config.replay_dir):
+            from ai_workbench.daemon import ping
+            _daemon = ping(config.daemon_socket)
+            if _daemon is None and mode != "auto":
+                console.print(f"[red]Error: no daemon is listening on {config.daemon_socket}.[/red]")
+                console.print("[yellow]Start one with: ai-workbench serve[/yellow]")
+                sys.exit(1)
+    return _daemon
+
+
+def is_provider_configured(provider_name: str) -> bool:
+    """Check if a provider can be used, here or by the daemon."""
+    daemon = get_daemon()
+    if daemon is not None:
+        return provider_name in daemon["providers"]
+    return config.is_configured(provider_name)
+
+
+def build_provider(provider_name: str, model: str, use_cache: bool = True):
+    """Create a configured provider with retries, rate limiting and the response cache.
+    
+    This is the stack the CLI uses locally and the daemon serves; the
+    provider must be configured.
+    """
+    # Importing the provider class pulls in its vendor SDK, so only do it
+    # for the provider that is actually requested.
+    provider_class = get_provider_class(provider_name)
+    provider = provider_class(config.get_api_key(provider_name), model, **config.get_provider_options(provider_name))
+    
+    from ai_workbench.resilience import ResilientProvider, get_rate_limiter
+    provider = ResilientProvider(
+        provider,
+        get_rate_limiter(provider_name, *config.rate_limits.get(provider_name, (0, 0))),
+        max_retries=config.max_retries,
+        base_delay=config.retry_base_delay,
+        max_delay=config.retry_max_delay,
+        on_retry=report_retry,
+    )
+    
+    # Cassettes need every request to reach the transport
+    cache = get_response_cache() if use_cache and not (config.record_dir or config.replay_dir) else None
+    if cache is not None:
+        from ai_workbench.cache import CachedProvider
+        provider = CachedProvider(provider, cache)
+    return provider
 
 
-def get_provider(provider_name: str, model: str = None):
-    """Get an AI provider instance."""
+def get_provider(provider_name: str, model: str = None, use_cache: bool = True):
+    """Get an AI provider instance.
+    
+    Requests go through the shared daemon when one is in use.
+    """
+    from ai_workbench.telemetry import InstrumentedProvider
+    
+    if get_daemon() is not None:
+        from ai_workbench.daemon import DaemonError, RemoteProvider, SettingsMismatch
+        try:
+            provider = RemoteProvider(config.daemon_socket, provider_name, model, use_cache,
+                                      config.provider_settings(provider_name))
+            return InstrumentedProvider(provider, get_telemetry())
+        except SettingsMismatch as e:
+            if (_daemon_mode or config.daemon) != "auto":
+                console.print(f"[red]Error: daemon: {e}[/red]")
+                sys.exit(1)
+            # Requests go out with this terminal's key and settings, from here
+            errors.print(f"[dim]{e}; not using the daemon for {provider_name}.[/dim]")
+        except (DaemonError, OSError) as e:
+            console.print(f"[red]Error: daemon: {e}[/red]")
+            sys.exit(1)
+    
     api_key = config.get_api_key(provider_name)
     
     if not api_key:
@@ -31,162 +185,1255 @@ def get_provider(provider_name: str, model: str = None):
     if model is None:
         model = config.get_default_model(provider_name)
     
-    providers = {
-        "openai": OpenAIProvider,
-        "anthropic": AnthropicProvider,
-        "google": GoogleProvider
-    }
-    
-    provider_class = providers.get(provider_name)
-    if not provider_class:
+    if not get_provider_class(provider_name):
         console.print(f"[red]Error: Unknown provider '{provider_name}'[/red]")
         console.print("[yellow]Available providers: openai, anthropic, google[/yellow]")
         sys.exit(1)
     
-    return provider_class(api_key, model)
+    return InstrumentedProvider(build_provider(provider_name, model, use_cache), get_telemetry())
+
+
+def get_session_store():
+    """Return the session store in the data directory."""
+    from ai_workbench.sessions import SessionStore
+    return SessionStore(config.data_dir / "sessions")
+
+
+def get_search_index(paths=()):
+    """Return the full-text index of sessions and saved conversation files."""
+    from ai_workbench.search import SearchIndex
+    return SearchIndex(config.data_dir / "search.sqlite3", get_session_store(), list(config.search_paths) + list(paths))
+
+
+def display_search_results(results, elapsed: float):
+    """Show search results with their matches highlighted."""
+    from datetime import datetime
+    from rich.markup import escape
+    from rich.table import Table
+    from ai_workbench.search import MATCH_END, MATCH_START
+    
+    if not results:
+        console.print(f"[yellow]No matches ({elapsed * 1000:.0f} ms).[/yellow]")
+        return
+    table = Table(title=f"{len(results)} matches in {elapsed * 1000:.0f} ms", border_style="blue", show_lines=True)
+    table.add_column("Session")
+    table.add_column("When")
+    table.add_column("Role")
+    table.add_column("Match")
+    for result in results:
+        when = datetime.fromtimestamp(result["ts"]).strftime("%Y-%m-%d %H:%M") if result["ts"] else ""
+        source = result["id"] if result["kind"] == "session" else f"[dim]{escape(result['id'])}[/dim]"
+        if result["title"]:
+            source += f"\n[dim]{escape(result['title'][:40])}[/dim]"
+        snippet = escape(result["snippet"]).replace(MATCH_START, "[bold yellow]").replace(MATCH_END, "[/bold yellow]")
+        table.add_row(source, when, result["role"], snippet)
+    console.print(table)
+    if any(result["kind"] == "session" for result in results):
+        console.print("[yellow]Resume one with: ai-workbench --resume <id>[/yellow]")
+
+
+def run_search(index, query: str, limit: int = 10, role: str = None):
+    """Search saved conversations and print the results."""
+    start = time.perf_counter()
+    results = index.search(query, limit=limit, role=role)
+    display_search_results(results, time.perf_counter() - start)
+
+
+def get_history_store():
+    """Return the prompt history of the current project (or of all, by config)."""
+    from ai_workbench.history import HistoryStore, project_key
+    project = "" if config.history_scope == "global" else project_key(os.getcwd())
+    return HistoryStore(config.data_dir / "history.sqlite3", project, config.history_max)
+
+
+def display_history_matches(matches, elapsed: float):
+    """Show prompts found in the history, best match first."""
+    from datetime import datetime
+    from rich.markup import escape
+    
+    if not matches:
+        console.print(f"[yellow]No matching prompts ({elapsed * 1000:.0f} ms).[/yellow]")
+        return
+    console.print(f"[bold]{len(matches)} matching prompts in {elapsed * 1000:.0f} ms:[/bold]")
+    for text, used in matches:
+        when = datetime.fromtimestamp(used).strftime("%Y-%m-%d %H:%M")
+        console.print(f"  [dim]{when}[/dim]  {escape(text[:200])}")
+    console.print("[dim]The best match is in the prompt; edit it, or clear it with Ctrl+U.[/dim]")
+
+
+def get_code_index(path: str = None):
+    """Return the code index of ``path``, or of the project of the working directory."""
+    from ai_workbench.codeindex import CodeIndex, index_file
+    from ai_workbench.history import project_key
+    root = os.path.abspath(path) if path else project_key(os.getcwd())
+    return CodeIndex(root, index_file(config.data_dir, root), int(config.index_max_kb * 1024))
+
+
+def update_code_index(code_index, jobs: int = None):
+    """Bring the code index up to date and show what changed."""
+    stats = code_index.update(config.index_jobs if jobs is None else jobs)
+    totals = code_index.stats()
+    console.print(f"[green]Indexed {code_index.root} in {stats['seconds']:.2f}s: "
+                  f"{stats['indexed']:,} files (re)indexed, {stats['removed']:,} removed, "
+                  f"{stats['files'] - stats['indexed'] - stats['skipped']:,} unchanged[/green]")
+    console.print(f"[green]{totals['indexed']:,} files, {totals['chunks']:,} chunks, "
+                  f"{totals['symbols']:,} symbols ({totals['files'] - totals['indexed']:,} files skipped: "
+                  f"binary, empty or over {config.index_max_kb:g} KB)[/green]")
+
+
+def retrieve_code(code_index, prompt: str, estimator):
+    """Snippets of the indexed code relevant to ``prompt``, within the configured budget."""
+    import sqlite3
+    try:
+        snippets = code_index.retrieve(prompt, config.index_budget, estimator.count)
+    except sqlite3.Error as e:
+        console.print(f"[yellow]Could not read the code index: {e}[/yellow]")
+        return []
+    if snippets:
+        files = len({snippet["path"] for snippet in snippets})
+        tokens = sum(snippet["tokens"] for snippet in snippets)
+        console.print(f"[dim]Retrieved {len(snippets)} code snippets from {files} files ({tokens:,} tokens)[/dim]")
+    return snippets
+
+
+def display_sessions(store, current_id: str = None, limit: int = 20):
+    """List the most recent saved sessions."""
+    from datetime import datetime
+    from rich.table import Table
+    
+    sessions = [meta for meta in store.list() if meta["records"]]
+    if not sessions:
+        console.print("[yellow]No saved sessions yet.[/yellow]")
+        return
+    table = Table(title="Sessions", border_style="blue")
+    table.add_column("ID")
+    table.add_column("Updated")
+    table.add_column("Provider/Model")
+    table.add_column("Records", justify="right")
+    table.add_column("Title")
+    for meta in sessions[:limit]:
+        session_id = f"[bold green]{meta['id']}[/bold green]" if meta["id"] == current_id else meta["id"]
+        updated = datetime.fromtimestamp(meta["updated"]).strftime("%Y-%m-%d %H:%M")
+        table.add_row(session_id, updated, f"{meta['provider']}/{meta['model']}",
+                      str(meta["records"]), meta.get("title") or "")
+    console.print(table)
+    console.print("[yellow]Resume one with: ai-workbench --resume <id>[/yellow]")
+
+
+def make_context_window(provider_name: str, model: str, window: int = None):
+    """Build the context window manager for a provider and model.
+    
+    ``window`` overrides the model's context window, e.g. with the largest
+    window of the models a router may pick.
+    """
+    from ai_workbench.context import ContextWindow
+    from ai_workbench.tokens import get_estimator
+    return ContextWindow(
+        get_estimator(provider_name, model),
+        window or config.get_context_window(model),
+        reserve=config.context_reserve,
+        policy=config.context_policy,
+        # Keep the start of requests stable for the provider's prompt cache
+        slack=config.context_slack if config.prompt_cache else 0.0,
+    )
+
+
+def display_context_usage(context_window, conversation: Conversation):
+    """Show how much of the context window the next request would use."""
+    context_window.fit(conversation)
+    usage = context_window.last_usage
+    percent = usage["tokens"] / usage["budget"] * 100 if usage["budget"] else 0.0
+    estimate = "exact" if usage["exact"] else "estimated"
+    console.print(f"[green]Context: {usage['tokens']:,} of {usage['budget']:,} tokens ({percent:.0f}%, {estimate}); "
+                  f"window {usage['context_window']:,}, policy '{usage['policy']}'[/green]")
+    console.print(f"[green]Messages: {usage['messages_sent']} of {usage['messages_total']} sent, "
+                  f"{usage['messages_dropped']} dropped, {usage['messages_summarized']} summarized[/green]")
+    if usage["attachments"]:
+        console.print(f"[green]Attachments: {usage['attachments']} files, "
+                      f"{usage['attachment_tokens']:,} tokens of the system message[/green]")
+
+
+def make_message_store():
+    """Return an empty message store with the configured memory tiers."""
+    from ai_workbench.memory import MessageStore
+    return MessageStore(
+        hot_bytes=int(config.memory_hot_kb * 1024),
+        cold_bytes=int(config.memory_cold_mb * 1024 * 1024),
+        compression=config.memory_compression,
+        spill_dir=config.data_dir,
+    )
+
+
+def display_memory(conversation: Conversation):
+    """Show the memory the conversation's messages and attachments take, per tier."""
+    from rich.table import Table
+    
+    store = conversation.messages
+    labels = {
+        "hot": "Hot (as is)",
+        "compressed": f"Compressed ({store.compression})",
+        "spilled": "Spilled (segment file, on disk)",
+        "loaded": "Decompressed, in use",
+    }
+    table = Table(title="Conversation memory", border_style="blue")
+    table.add_column("Tier")
+    table.add_column("Messages", justify="right")
+    table.add_column("KB", justify="right")
+    table.add_column("Decompressed KB", justify="right")
+    for name, tier in store.stats().items():
+        table.add_row(labels[name], f"{tier['messages']:,}", f"{tier['bytes'] / 1024:,.1f}",
+                      f"{tier['content'] / 1024:,.1f}")
+    held = sum(sys.getsizeof(content) for content in conversation.blobs.values())
+    table.add_row("Attached files", f"{len(conversation.blobs):,}", f"{held / 1024:,.1f}", f"{held / 1024:,.1f}")
+    console.print(table)
+    console.print(f"[green]Messages the last request sent stay as they are; before them, all but the newest "
+                  f"{config.memory_hot_kb:g} KB are compressed, and past {config.memory_cold_mb:g} MB "
+                  f"compressed, spilled to disk.[/green]")
+
+
+def display_attachments(conversation: Conversation, estimator):
+    """List the attached files."""
+    from rich.markup import escape
+    from rich.table import Table
+    from ai_workbench.attachments import display_path
+    
+    if not conversation.attachments:
+        console.print("[yellow]No files attached. Usage: /attach <path|dir|glob> ...[/yellow]")
+        return
+    table = Table(title="Attachments", border_style="blue")
+    table.add_column("File")
+    table.add_column("KB", justify="right")
+    for path, digest in conversation.attachments.items():
+        table.add_row(escape(display_path(path)), f"{len(conversation.blobs[digest]) / 1024:.1f}")
+    console.print(table)
+    console.print(f"[green]{len(conversation.attachments)} files, {len(conversation.blobs)} distinct, "
+                  f"{conversation.attachment_tokens(estimator):,} tokens[/green]")
+
+
+async def attach_files(conversation: Conversation, patterns, estimator):
+    """Attach the files named by ``patterns`` and report what was skipped.
+    
+    Files are read in a worker thread, so attaching a large tree doesn't
+    block the event loop; Ctrl+C stops it after the current file.
+    """
+    import functools
+    import threading
+    from ai_workbench.attachments import collect, display_path
+    
+    held = sum(len(content) for content in conversation.blobs.values())
+    cancel = threading.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        result = await run_interruptible(loop.run_in_executor(None, functools.partial(
+            collect, patterns, conversation.blobs,
+            max_file_bytes=int(config.attach_max_kb * 1024),
+            max_total_bytes=max(int(config.attach_total_mb * 1024 * 1024) - held, 0),
+            cancelled=cancel.is_set,
+        )))
+    except KeyboardInterrupt:
+        console.print("[yellow]Attaching cancelled.[/yellow]")
+        return
+    finally:
+        cancel.set()
+    
+    # Content that was already held (or read earlier in this batch) is
+    # referenced by digest; resolve it before anything is replaced
+    contents = {}
+    for path, digest, text, size in result["files"]:
+        contents.setdefault(digest, text if text is not None else conversation.blobs.get(digest))
+    attached = unchanged = reused = 0
+    for path, digest, text, size in result["files"]:
+        if not conversation.attach(path, digest, contents[digest]):
+            unchanged += 1
+            continue
+        attached += 1
+        if text is None:
+            reused += 1
+    
+    summary = f"Attached {attached} files"
+    if reused:
+        summary += f" ({reused} with content already attached, stored once)"
+    if unchanged:
+        summary += f", {unchanged} unchanged"
+    console.print(f"[green]{summary}; now {len(conversation.attachments)} files, "
+                  f"{conversation.attachment_tokens(estimator):,} tokens[/green]")
+    for reason in ("binary", "too large", "empty", "unreadable", "missing"):
+        paths = result[reason]
+        if paths:
+            shown = ", ".join(display_path(path) for path in paths[:3]) + (", ..." if len(paths) > 3 else "")
+            console.print(f"[yellow]Skipped {len(paths)} {reason}: {shown}[/yellow]")
+
+
+def detach_files(conversation: Conversation, patterns, estimator):
+    """Detach the attached files named by ``patterns`` (or ``all``)."""
+    from ai_workbench.attachments import match_attached
+    
+    paths = match_attached(patterns, conversation.attachments)
+    for path in paths:
+        conversation.detach(path)
+    console.print(f"[green]Detached {len(paths)} files; {len(conversation.attachments)} left, "
+                  f"{conversation.attachment_tokens(estimator):,} tokens[/green]")
+
+
+def parse_hedge_delay(value):
+    """Validate a hedge delay: seconds, ``p95``, or None to race."""
+    if value is None or value == "p95":
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise click.BadParameter("must be a number of seconds or 'p95'")
+
+
+def make_race_provider(names: str, use_cache: bool, hedge_delay=None):
+    """Build a RaceProvider from a comma-separated provider list.
+    
+    Returns None (after printing why) if fewer than two configured providers
+    are given.
+    """
+    from ai_workbench.race import RaceProvider
+    
+    provider_names = [name.strip().lower() for name in names.split(",") if name.strip()]
+    if len(provider_names) < 2:
+        console.print("[red]Racing needs at least two providers, e.g. openai,anthropic[/red]")
+        return None
+    for name in provider_names:
+        if name not in PROVIDERS or not is_provider_configured(name):
+            console.print(f"[red]Provider '{name}' is not configured.[/red]")
+            return None
+    return RaceProvider([get_provider(name, None, use_cache) for name in provider_names], hedge_delay)
+
+
+def make_router(policy: str, use_cache: bool):
+    """Build a RoutedProvider over the registry models of the configured providers.
+    
+    The models are ``AWB_ROUTE_MODELS``, or every registry model. Returns
+    None (after printing why) if the policy is unknown or there is no
+    model to route to.
+    """
+    from ai_workbench.routing import POLICIES, ModelRoute, RoutedProvider, observe
+    
+    if policy not in POLICIES:
+        console.print(f"[red]Unknown routing policy '{policy}' (choose from {', '.join(POLICIES)})[/red]")
+        return None
+    routes = []
+    for model in config.route_models or config.models:
+        info = config.models.get(model)
+        if info is None:
+            console.print(f"[red]Model '{model}' is not in the model registry.[/red]")
+            return None
+        if is_provider_configured(info["provider"]):
+            routes.append(ModelRoute(model, info, lambda name, routed: get_provider(name, routed, use_cache)))
+    if not routes:
+        console.print("[red]No model of a configured provider to route to.[/red]")
+        return None
+    telemetry = get_telemetry()
+    if observe not in telemetry.listeners:
+        telemetry.listeners.append(observe)
+    return RoutedProvider(routes, policy, config.route_short_tokens, config.route_reply_tokens,
+                          on_failover=report_failover)
+
+
+def display_routes(router):
+    """Show the models a router picks from, with their current measurements."""
+    from rich.table import Table
+    
+    now = time.monotonic()
+    table = Table(title=f"Routing: {router.policy}")
+    table.add_column("Model")
+    table.add_column("Window", justify="right")
+    table.add_column("$/M in, out", justify="right")
+    table.add_column("First token", justify="right")
+    table.add_column("Tokens/s", justify="right")
+    table.add_column("Measured", justify="right")
+    table.add_column("State")
+    for route in router.routes:
+        stats = route.stats
+        state = "ok" if stats.available(now) else f"cooling down {stats.down_until - now:.0f}s"
+        table.add_row(f"{route.provider_name}/{route.model}", f"{route.context_window:,}",
+                      f"{route.cost[0]:g}, {route.cost[1]:g}", f"{stats.ttft:.2f}s",
+                      f"{stats.tokens_per_second:.0f}", str(stats.samples), state)
+    console.print(table)
+
+
+def handle_cache_command(args):
+    """Handle ``/cache stats`` and ``/cache clear``."""
+    cache = get_response_cache()
+    if cache is None:
+        console.print("[yellow]Response cache is disabled.[/yellow]")
+        return
+    
+    action = args[0].lower() if args else "stats"
+    if action == "stats":
+        stats = cache.stats()
+        lookups = stats["session_hits"] + stats["session_misses"]
+        hit_rate = stats["session_hits"] / lookups * 100 if lookups else 0.0
+        console.print(f"[green]Cache: {stats['path']}[/green]")
+        console.print(f"[green]Entries: {stats['entries']} "
+                      f"({stats['size_bytes'] / 1024:.1f} KiB of {stats['max_bytes'] / 1024 / 1024:.0f} MiB)[/green]")
+        console.print(f"[green]This session: {stats['session_hits']} hits, {stats['session_misses']} misses "
+                      f"({hit_rate:.0f}% hit rate)[/green]")
+        console.print(f"[green]All-time hits on stored entries: {stats['total_hits']}[/green]")
+    elif action == "clear":
+        cache.clear()
+        console.print("[green]Response cache cleared.[/green]")
+    else:
+        console.print("[red]Usage: /cache [stats|clear][/red]")
+
+
+def display_stats(telemetry):
+    """Show latency percentiles and usage per provider and model."""
+    from rich.table import Table
+    from ai_workbench.telemetry import GAP_BUCKETS, percentile
+    
+    rows = telemetry.summary()
+    if not rows:
+        console.print("[yellow]No requests yet.[/yellow]")
+        return
+    
+    def fmt(values, q):
+        value = percentile(values, q)
+        return "-" if value is None else f"{value:,.0f}"
+    
+    labels = [f"≤{bound * 1000:g}ms" for bound in GAP_BUCKETS] + [f">{GAP_BUCKETS[-1] * 1000:g}ms"]
+    for row in rows:
+        notes = [f"{row[key]} {key}" for key in ("errors", "cancelled", "cached") if row[key]]
+        title = f"{row['provider']}/{row['model']}: {row['requests']} requests" + (f" ({', '.join(notes)})" if notes else "")
+        table = Table(title=title, border_style="blue")
+        table.add_column("ms")
+        for column in ("p50", "p95", "p99", "n"):
+            table.add_column(column, justify="right")
+        for label, key in (("Connect (new connections)", "connect_ms"), ("Response headers", "headers_ms"),
+                           ("First token", "ttft_ms"), ("Total", "duration_ms"), ("Rendering", "consumer_ms")):
+            values = row[key]
+            table.add_row(label, fmt(values, 0.5), fmt(values, 0.95), fmt(values, 0.99), str(len(values)))
+        console.print(table)
+        
+        rate = row["chars_per_second"]
+        console.print(f"[green]Tokens: {row['input_tokens']:,} in, {row['output_tokens']:,} out"
+                      + (f"; streamed {rate:,.0f} chars/s" if rate else "") + "[/green]")
+        if row["cache_reported"]:
+            read, written = row["cache_read_tokens"], row["cache_write_tokens"]
+            share = read / row["input_tokens"] * 100 if row["input_tokens"] else 0.0
+            console.print(f"[green]Prompt cache: {read:,} tokens read ({share:.0f}% of input)"
+                          + (f", {written:,} written" if written else "") + "[/green]")
+        if sum(row["gaps"]):
+            histogram = "  ".join(f"{label} {count}" for label, count in zip(labels, row["gaps"]) if count)
+            console.print(f"[green]Chunk gaps (max {row['max_gap_ms']:,.0f}ms): {histogram}[/green]")
+        console.print()
+
+
+def render_markdown(text: str):
+    """Build a Rich Markdown renderable.
+    
+    ``rich.markdown`` (and markdown-it with it) is imported on first use to
+    keep it off the startup path.
+    """
+    from rich.markdown import Markdown
+    return Markdown(text)
+
+
+def display_startup_profile(provider_name: str):
+    """Print an import-time breakdown of the CLI startup path."""
+    from rich.table import Table
+    from ai_workbench.startup import profile_startup
+    
+    provider_module = PROVIDERS.get(provider_name, (None, None))[0]
+    profile = profile_startup(provider_module)
+    
+    table = Table(title="Startup import profile", border_style="blue")
+    table.add_column("Package")
+    table.add_column("Self time (ms)", justify="right")
+    for package, ms in profile["packages"][:15]:
+        table.add_row(package, f"{ms:.1f}")
+    console.print(table)
+    console.print(f"[green]ai_workbench.cli import: {profile['cli_ms']:.1f} ms[/green]")
+    if provider_module:
+        console.print(f"[green]{provider_name} provider import: {profile['provider_ms']:.1f} ms[/green]")
+    console.print(f"[green]Total import time: {profile['total_ms']:.1f} ms "
+                  f"(interpreter wall time {profile['wall_ms']:.1f} ms)[/green]")
 
 
 def display_welcome():
     """Display welcome message."""
-    welcome_text = """
-# 🤖 AI Terminal Workbench
+    from rich.panel import Panel
+    
+    # Plain Rich markup rather than Markdown so that rendering the welcome
+    # screen does not pull the Markdown parser into startup.
+    welcome_text = """[bold]🤖 AI Terminal Workbench[/bold]
 
 Welcome to your AI-powered coding assistant!
 
-**Available commands:**
-- `/help` - Show this help message
-- `/clear` - Clear conversation history
-- `/exit` or `/quit` - Exit the application
-- `/provider <name>` - Switch AI provider (openai, anthropic, google)
-- `/model <name>` - Switch model
-- Any other input - Chat with the AI assistant
+[bold]Available commands:[/bold]
+• [cyan]/help[/cyan] - Show this help message
+• [cyan]/clear[/cyan] - Clear conversation history
+• [cyan]/exit[/cyan] or [cyan]/quit[/cyan] - Exit the application
+• [cyan]/provider <name>[/cyan] - Switch AI provider (openai, anthropic, google)
+• [cyan]/model <name>[/cyan] - Switch model
+• [cyan]/race <p1,p2,...>[/cyan] or [cyan]/race off[/cyan] - Race providers for the fastest first token
+• [cyan]/route fastest|cheapest|auto|off[/cyan] - Pick the model per request (no argument shows the models)
+• [cyan]/sessions[/cyan] - List saved sessions
+• [cyan]/search <query>[/cyan] - Search all saved conversations
+• [cyan]/history <query>[/cyan] - Find earlier prompts of this project (fuzzy) and recall the best one
+• [cyan]/context[/cyan] - Show context window usage
+• [cyan]/memory[/cyan] - Show the memory the conversation takes, hot, compressed and spilled
+• [cyan]/continue[/cyan] - Resume a reply interrupted with Ctrl+C
+• [cyan]/index <path>[/cyan] or [cyan]/index off[/cyan] - Index the project's code (or a directory) and send relevant snippets with each prompt
+• [cyan]/attach <path|dir|glob>[/cyan] - Attach files to the conversation (no argument lists them)
+• [cyan]/detach <path|dir|glob|all>[/cyan] - Detach files again
+• [cyan]/cache stats[/cyan] or [cyan]/cache clear[/cyan] - Inspect or empty the response cache
+• [cyan]/stats[/cyan] - Show request latency and token usage
+• Any other input - Chat with the AI assistant
+
+Type your question or command to get started!"""
+    console.print(Panel(welcome_text, border_style="blue"))
+
 
-Type your question or command to get started!
+async def generate_reply(provider, messages, no_stream: bool, received: list = None) -> str:
+    """Generate and print the assistant's reply, returning its full text.
+    
+    Streamed chunks are also appended to ``received`` as they arrive, so
+    that the caller keeps the partial reply if this is cancelled.
     """
-    console.print(Panel(Markdown(welcome_text), border_style="blue"))
+    if no_stream:
+        # Non-streaming response
+        response = await provider.agenerate_response(messages)
+        console.print(render_markdown(response))
+        return response
+    
+    # Streaming response: chunks are buffered and drawn at a capped frame
+    # rate, with Markdown rendered block by block as it completes.
+    from ai_workbench.rendering import StreamRenderer
+    with StreamRenderer(console.load(), fps=config.render_fps) as renderer:
+        async for chunk in provider.agenerate_stream(messages):
+            if received is not None:
+                received.append(chunk)
+            renderer.feed(chunk)
+    return renderer.text
 
 
-@click.command()
-@click.option("--provider", "-p", default=None, help="AI provider (openai, anthropic, google)")
-@click.option("--model", "-m", default=None, help="Model to use")
-@click.option("--no-stream", is_flag=True, help="Disable streaming responses")
-def main(provider, model, no_stream):
-    """AI Terminal Workbench - Your AI coding assistant in the terminal."""
+def continuation_request(provider, messages):
+    """Request continuing the interrupted reply that ends ``messages``.
     
-    # Use default provider if not specified
-    if provider is None:
-        provider = config.default_provider
+    Returns the request messages and the text the continuation follows.
+    Providers that can prefill a reply continue it directly; others are
+    asked to pick up where it stopped.
+    """
+    partial = messages[-1]["content"]
+    request = provider.continuation_messages(messages[:-1], partial)
+    if request is not None:
+        # The prefill is sent without trailing whitespace
+        return request, partial.rstrip()
+    return messages + [{"role": "user", "content": CONTINUE_PROMPT}], partial
+
+
+async def run_interruptible(coro):
+    """Await ``coro`` as a task that Ctrl+C cancels.
     
-    # Check if provider is configured
-    if not config.is_configured(provider):
-        console.print(f"[red]Error: {provider} is not configured.[/red]")
-        console.print("[yellow]Please set up your API keys in .env file.[/yellow]")
-        console.print(f"[yellow]Copy .env.example to .env and add your API keys.[/yellow]")
-        sys.exit(1)
+    Outside of a prompt, SIGINT would otherwise be raised as
+    KeyboardInterrupt at an arbitrary point inside the event loop. Here it
+    cancels the task instead, and KeyboardInterrupt is raised to the caller.
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(coro)
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+    except (NotImplementedError, RuntimeError):
+        # No signal handler support (e.g. Windows): plain KeyboardInterrupt
+        return await task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        raise KeyboardInterrupt
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+
+
+def start_prewarm(provider, background_tasks: set):
+    """Pre-warm the provider's connection in the background, if enabled."""
+    if not config.prewarm:
+        return
+    task = asyncio.ensure_future(provider.aprewarm())
+    # Keep a reference until done so the task is not garbage collected
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def run_repl(provider: str, model: str, no_stream: bool, use_cache: bool, resume: str = None,
+                   race: str = None, hedge_delay=None, route: str = None):
+    """Run the interactive chat loop."""
+    background_tasks = set()
+    conversation = Conversation(make_message_store())
+    
+    # Resume a saved session or start journaling a new one
+    store = get_session_store() if config.sessions_enabled or resume else None
+    session_id = None
+    if resume:
+        session_id = store.resolve(resume)
+        if session_id is None:
+            console.print(f"[red]Error: no unique session matches '{resume}'.[/red]")
+            sys.exit(1)
+        meta = store.get_meta(session_id)
+        store.load(session_id, conversation, config.resume_messages)
+        if model is None and provider == meta["provider"]:
+            model = meta["model"]
     
     # Initialize provider
-    current_provider = get_provider(provider, model)
-    conversation = Conversation()
+    if race:
+        current_provider = make_race_provider(race, use_cache, hedge_delay)
+        if current_provider is None:
+            sys.exit(1)
+        provider = current_provider.providers[0].name
+    elif route:
+        current_provider = make_router(route, use_cache)
+        if current_provider is None:
+            sys.exit(1)
+        provider = current_provider.routes[0].provider_name
+    else:
+        current_provider = get_provider(provider, model, use_cache)
+    start_prewarm(current_provider, background_tasks)
+    context_window = make_context_window(provider, current_provider.model, getattr(current_provider, "context_window", None))
+    
+    if store is not None:
+        if session_id is None:
+            session_id = store.create(provider, current_provider.model, conversation.system_message)
+        conversation.journal = store.open_journal(session_id)
     
     # Display welcome message
     display_welcome()
     console.print(f"[green]Using provider: {provider}[/green]")
     console.print(f"[green]Using model: {current_provider.model}[/green]")
+    if config.replay_dir:
+        speed = f"{config.replay_speed:g}x speed" if config.replay_speed else "no delays"
+        console.print(f"[yellow]Replaying recorded exchanges from {config.replay_dir} ({speed})[/yellow]")
+    elif config.record_dir:
+        console.print(f"[yellow]Recording exchanges to {config.record_dir}[/yellow]")
+    if race:
+        console.print(f"[green]Racing: {current_provider.describe()}[/green]")
+    elif route:
+        console.print(f"[green]Routing: {current_provider.describe()}[/green]")
+    if resume:
+        console.print(f"[green]Resumed session {session_id} ({len(conversation.messages)} messages)[/green]")
+    
+    # Code retrieval, once the project has been indexed with /index
+    code_index = None
+    if config.index_retrieve:
+        code_index = get_code_index()
+        if code_index.exists():
+            console.print(f"[green]Retrieving code from the index of {code_index.root} (/index updates it)[/green]")
+        else:
+            code_index = None
     console.print()
     
-    # Create prompt session with history
-    session = PromptSession(history=InMemoryHistory())
+    # Opened by the first /search
+    search_index = None
     
-    # Main loop
-    while True:
-        try:
-            # Get user input
-            user_input = session.prompt("You: ", multiline=False)
-            
-            if not user_input.strip():
-                continue
-            
-            # Handle commands
-            if user_input.startswith("/"):
-                command = user_input.split()[0].lower()
-                
-                if command in ["/exit", "/quit"]:
-                    console.print("[yellow]Goodbye! 👋[/yellow]")
-                    break
+    # Create prompt session with the persistent history, if enabled
+    from prompt_toolkit import PromptSession
+    history_store = None
+    if config.history_enabled:
+        from ai_workbench.history import HistorySuggest, PromptHistory
+        history_store = get_history_store()
+        history_store.compact_in_background()
+        session = PromptSession(history=PromptHistory(history_store, config.history_load),
+                                auto_suggest=HistorySuggest(history_store))
+    else:
+        from prompt_toolkit.history import InMemoryHistory
+        session = PromptSession(history=InMemoryHistory())
+    # Text to start the next prompt with (a prompt recalled by /history)
+    next_input = ""
+    
+    try:
+        # Main loop
+        while True:
+            try:
+                # Get user input
+                user_input = await session.prompt_async("You: ", multiline=False, default=next_input)
+                next_input = ""
                 
-                elif command == "/help":
-                    display_welcome()
+                if not user_input.strip():
                     continue
                 
-                elif command == "/clear":
-                    conversation.clear()
-                    console.print("[green]Conversation history cleared.[/green]")
-                    continue
+                # Handle commands
+                if user_input.startswith("/"):
+                    command = user_input.split()[0].lower()
+                    
+                    if command in ["/exit", "/quit"]:
+                        console.print("[yellow]Goodbye! 👋[/yellow]")
+                        break
+                    
+                    elif command == "/help":
+                        display_welcome()
+                        continue
+                    
+                    elif command == "/clear":
+                        conversation.clear()
+                        console.print("[green]Conversation history cleared.[/green]")
+                        if conversation.attachments:
+                            console.print(f"[yellow]{len(conversation.attachments)} attached files kept; "
+                                          f"/detach all drops them.[/yellow]")
+                        continue
+                    
+                    elif command == "/provider":
+                        parts = user_input.split()
+                        if len(parts) < 2:
+                            console.print("[red]Usage: /provider <name>[/red]")
+                            continue
+                        new_provider = parts[1].lower()
+                        if not is_provider_configured(new_provider):
+                            console.print(f"[red]Provider '{new_provider}' is not configured.[/red]")
+                            continue
+                        current_provider = get_provider(new_provider, model, use_cache)
+                        start_prewarm(current_provider, background_tasks)
+                        provider = new_provider
+                        context_window = make_context_window(provider, current_provider.model)
+                        if store is not None:
+                            store.update_meta(session_id, provider=provider, model=current_provider.model)
+                        console.print(f"[green]Switched to provider: {provider}[/green]")
+                        console.print(f"[green]Using model: {current_provider.model}[/green]")
+                        continue
+                    
+                    elif command == "/model":
+                        parts = user_input.split()
+                        if len(parts) < 2:
+                            console.print("[red]Usage: /model <name>[/red]")
+                            continue
+                        new_model = parts[1]
+                        current_provider = get_provider(provider, new_model, use_cache)
+                        start_prewarm(current_provider, background_tasks)
+                        context_window = make_context_window(provider, current_provider.model)
+                        if store is not None:
+                            store.update_meta(session_id, model=current_provider.model)
+                        console.print(f"[green]Switched to model: {new_model}[/green]")
+                        continue
+                    
+                    elif command == "/race":
+                        parts = user_input.split()
+                        if len(parts) < 2:
+                            if getattr(current_provider, "providers", None):
+                                console.print(f"[green]Racing: {current_provider.describe()}[/green]")
+                            else:
+                                console.print("[yellow]Racing is off. Usage: /race <p1,p2,...> or /race off[/yellow]")
+                            continue
+                        if parts[1].lower() == "off":
+                            current_provider = get_provider(provider, model, use_cache)
+                            console.print(f"[green]Racing off; using {provider}/{current_provider.model}[/green]")
+                        else:
+                            race_provider = make_race_provider(parts[1], use_cache, hedge_delay)
+                            if race_provider is None:
+                                continue
+                            current_provider = race_provider
+                            provider = current_provider.providers[0].name
+                            console.print(f"[green]Racing: {current_provider.describe()}[/green]")
+                        start_prewarm(current_provider, background_tasks)
+                        context_window = make_context_window(provider, current_provider.model)
+                        continue
+                    
+                    elif command == "/route":
+                        parts = user_input.split()
+                        if len(parts) < 2:
+                            if getattr(current_provider, "routes", None):
+                                display_routes(current_provider)
+                            else:
+                                console.print("[yellow]Routing is off. Usage: /route fastest|cheapest|auto|off[/yellow]")
+                            continue
+                        if parts[1].lower() == "off":
+                            current_provider = get_provider(provider, model, use_cache)
+                            console.print(f"[green]Routing off; using {provider}/{current_provider.model}[/green]")
+                        else:
+                            router = make_router(parts[1].lower(), use_cache)
+                            if router is None:
+                                continue
+                            current_provider = router
+                            provider = current_provider.routes[0].provider_name
+                            console.print(f"[green]Routing: {current_provider.describe()}[/green]")
+                        start_prewarm(current_provider, background_tasks)
+                        context_window = make_context_window(provider, current_provider.model,
+                                                             getattr(current_provider, "context_window", None))
+                        continue
+                    
+                    elif command == "/sessions":
+                        display_sessions(store or get_session_store(), session_id)
+                        continue
+                    
+                    elif command == "/search":
+                        query = user_input[len(command):].strip()
+                        if not query:
+                            console.print("[red]Usage: /search <query>[/red]")
+                            continue
+                        if conversation.journal is not None:
+                            # Make the current session's latest messages searchable
+                            conversation.journal.sync()
+                        if search_index is None:
+                            search_index = get_search_index()
+                        run_search(search_index, query)
+                        continue
+                    
+                    elif command == "/history":
+                        query = user_input[len(command):].strip()
+                        if history_store is None:
+                            console.print("[yellow]The prompt history is disabled (AWB_HISTORY=0).[/yellow]")
+                            continue
+                        if not query:
+                            scope = "all directories" if not history_store.project else history_store.project
+                            console.print(f"[green]{len(history_store):,} prompts in the history of {scope}.[/green]")
+                            continue
+                        start = time.perf_counter()
+                        # Earlier searches would only recall themselves
+                        matches = [m for m in history_store.search(query, 20) if not m[0].startswith(command)][:10]
+                        display_history_matches(matches, time.perf_counter() - start)
+                        if matches:
+                            next_input = matches[0][0]
+                        continue
+                    
+                    elif command == "/index":
+                        argument = os.path.expanduser(user_input[len(command):].strip())
+                        if argument.lower() == "off":
+                            if code_index is not None:
+                                code_index.close()
+                                code_index = None
+                            console.print("[green]Code retrieval off; /index turns it on again.[/green]")
+                            continue
+                        if argument and not os.path.isdir(argument):
+                            console.print(f"[red]Not a directory: {argument}[/red]")
+                            continue
+                        if code_index is not None:
+                            code_index.close()
+                        code_index = get_code_index(argument or None)
+                        console.print(f"[green]Indexing {code_index.root}...[/green]")
+                        try:
+                            # Off the event loop; the files are read in worker processes
+                            await asyncio.get_running_loop().run_in_executor(None, update_code_index, code_index)
+                        except Exception as e:
+                            console.print(f"[red]Error: {str(e)}[/red]")
+                            code_index.close()
+                            code_index = None
+                        continue
+                    
+                    elif command == "/context":
+                        display_context_usage(context_window, conversation)
+                        continue
+                    
+                    elif command == "/memory":
+                        display_memory(conversation)
+                        continue
+                    
+                    elif command == "/continue":
+                        if not conversation.truncated:
+                            console.print("[yellow]Nothing to continue: the last reply was not interrupted.[/yellow]")
+                            continue
+                        request, before = continuation_request(current_provider, context_window.fit(conversation))
+                        console.print("\n[bold cyan]Assistant (continued):[/bold cyan]")
+                        received = []
+                        truncated = False
+                        try:
+                            text = await run_interruptible(
+                                generate_reply(current_provider, request, no_stream, received)
+                            )
+                        except KeyboardInterrupt:
+                            text, truncated = "".join(received), True
+                            console.print("\n[yellow]Interrupted again; /continue resumes it.[/yellow]")
+                        except Exception as e:
+                            console.print(f"[red]Error: {str(e)}[/red]")
+                            text, truncated = "".join(received), True
+                        if text:
+                            # The reply is replaced by the longer one
+                            conversation.pop_message()
+                            conversation.add_assistant_message(before + text, truncated=truncated)
+                        console.print()
+                        continue
+                    
+                    elif command in ("/attach", "/detach"):
+                        import shlex
+                        try:
+                            patterns = shlex.split(user_input[len(command):])
+                        except ValueError as e:
+                            console.print(f"[red]Error: {e}[/red]")
+                            continue
+                        if command == "/detach":
+                            if not patterns:
+                                console.print("[red]Usage: /detach <path|dir|glob|all> ...[/red]")
+                            else:
+                                detach_files(conversation, patterns, context_window.estimator)
+                        elif not patterns:
+                            display_attachments(conversation, context_window.estimator)
+                        else:
+                            await attach_files(conversation, patterns, context_window.estimator)
+                        continue
+                    
+                    elif command == "/cache":
+                        handle_cache_command(user_input.split()[1:])
+                        continue
+                    
+                    elif command == "/stats":
+                        display_stats(get_telemetry())
+                        continue
+                    
+                    else:
+                        console.print(f"[red]Unknown command: {command}[/red]")
+                        console.print("[yellow]Type /help for available commands.[/yellow]")
+                        continue
                 
-                elif command == "/provider":
-                    parts = user_input.split()
-                    if len(parts) < 2:
-                        console.print("[red]Usage: /provider <name>[/red]")
-                        continue
-                    new_provider = parts[1].lower()
-                    if not config.is_configured(new_provider):
-                        console.print(f"[red]Provider '{new_provider}' is not configured.[/red]")
-                        continue
-                    current_provider = get_provider(new_provider, model)
-                    provider = new_provider
-                    console.print(f"[green]Switched to provider: {provider}[/green]")
-                    console.print(f"[green]Using model: {current_provider.model}[/green]")
-                    continue
+                # Add user message to conversation
+                conversation.add_user_message(user_input)
                 
-                elif command == "/model":
-                    parts = user_input.split()
-                    if len(parts) < 2:
-                        console.print("[red]Usage: /model <name>[/red]")
-                        continue
-                    new_model = parts[1]
-                    current_provider = get_provider(provider, new_model)
-                    console.print(f"[green]Switched to model: {new_model}[/green]")
-                    continue
+                # Indexed code for this prompt; sent with it, but not kept in the history
+                snippets = []
+                if code_index is not None:
+                    # Off the event loop; changed files are re-indexed first
+                    snippets = await asyncio.get_running_loop().run_in_executor(
+                        None, retrieve_code, code_index, user_input, context_window.estimator)
                 
-                else:
-                    console.print(f"[red]Unknown command: {command}[/red]")
-                    console.print("[yellow]Type /help for available commands.[/yellow]")
-                    continue
-            
-            # Add user message to conversation
-            conversation.add_user_message(user_input)
-            
-            # Generate response
-            console.print("\n[bold cyan]Assistant:[/bold cyan] ", end="")
-            
-            try:
-                if no_stream:
-                    # Non-streaming response
-                    response = current_provider.generate_response(conversation.get_messages())
-                    console.print(Markdown(response))
-                    conversation.add_assistant_message(response)
-                else:
-                    # Streaming response
-                    response_text = ""
-                    for chunk in current_provider.generate_stream(conversation.get_messages()):
-                        console.print(chunk, end="")
-                        response_text += chunk
-                    console.print()  # New line after streaming
+                # Generate response
+                console.print("\n[bold cyan]Assistant:[/bold cyan]")
+                
+                received = []
+                try:
+                    # Collapse old turns first if the policy summarizes, then send
+                    # only what fits in the model's context window
+                    await context_window.summarize(conversation, current_provider.agenerate_response)
+                    request = context_window.fit(conversation, sum(snippet["tokens"] for snippet in snippets))
+                    if snippets:
+                        from ai_workbench.codeindex import with_context
+                        request = with_context(request, snippets)
+                    response_text = await run_interruptible(
+                        generate_reply(current_provider, request, no_stream, received)
+                    )
                     conversation.add_assistant_message(response_text)
+                    
+                    winner = getattr(current_provider, "last_winner", None)
+                    if winner is not None:
+                        console.print(f"[dim]Answered by {winner.name}/{winner.model} "
+                                      f"(first token after {current_provider.last_ttft:.2f}s)[/dim]")
+                    route = getattr(current_provider, "last_route", None)
+                    if route is not None:
+                        console.print(f"[dim]Routed to {route.provider_name}/{route.model} "
+                                      f"({current_provider.last_reason})[/dim]")
+                
+                except KeyboardInterrupt:
+                    # Cancelling closed the provider's stream; keep what
+                    # was received so it can be continued
+                    partial = "".join(received)
+                    if partial:
+                        conversation.add_assistant_message(partial, truncated=True)
+                        console.print("\n[yellow]Interrupted; the partial reply was kept. "
+                                      "/continue resumes it.[/yellow]")
+                    else:
+                        conversation.pop_message()
+                        console.print("\n[yellow]Interrupted.[/yellow]")
+                
+                except Exception as e:
+                    console.print(f"[red]Error: {str(e)}[/red]")
+                    # A stream that failed partway (and couldn't be resumed)
+                    # is kept like an interrupted one
+                    partial = "".join(received)
+                    if partial:
+                        conversation.add_assistant_message(partial, truncated=True)
+                        console.print("[yellow]The partial reply was kept; /continue resumes it.[/yellow]")
+                    else:
+                        # Remove the user message that caused the error
+                        conversation.pop_message()
+                
+                console.print()
             
-            except Exception as e:
-                console.print(f"[red]Error: {str(e)}[/red]")
-                # Remove the user message that caused the error
-                conversation.messages.pop()
-            
-            console.print()
-        
-        except KeyboardInterrupt:
-            console.print("\n[yellow]Use /exit or /quit to exit.[/yellow]")
-            continue
-        except EOFError:
-            console.print("\n[yellow]Goodbye! 👋[/yellow]")
-            break
+            except KeyboardInterrupt:
+                console.print("\n[yellow]Use /exit or /quit to exit.[/yellow]")
+                continue
+            except EOFError:
+                console.print("\n[yellow]Goodbye! 👋[/yellow]")
+                break
+
+    finally:
+        if conversation.journal is not None:
+            conversation.journal.close()
+        if history_store is not None:
+            history_store.close()
+        if code_index is not None:
+            code_index.close()
+
+@click.group(invoke_without_command=True)
+@click.option("--provider", "-p", default=None, help="AI provider (openai, anthropic, google)")
+@click.option("--model", "-m", default=None, help="Model to use")
+@click.option("--no-stream", is_flag=True, help="Disable streaming responses")
+@click.option("--no-cache", is_flag=True, help="Do not read or write the local response cache")
+@click.option("--race", default=None, metavar="P1,P2", help="Send each request to several providers and stream the fastest")
+@click.option("--hedge-delay", default=None, callback=lambda ctx, param, value: parse_hedge_delay(value),
+              help="With --race, only ask the other providers after this many seconds without a first token ('p95' to adapt)")
+@click.option("--route", default=None, type=click.Choice(["fastest", "cheapest", "auto"]),
+              help="Pick the model of every request from the model registry (default: AWB_ROUTE)")
+@click.option("--resume", "resume", default=None, metavar="ID", help="Resume a saved session (id, id prefix or 'last')")
+@click.option("--profile-startup", is_flag=True, help="Print an import-time breakdown of startup and exit")
+@click.option("--metrics-file", default=None, metavar="PATH", help="Append timings of every request to this JSONL file")
+@click.option("--prometheus-file", default=None, metavar="PATH", help="Keep a Prometheus textfile of request metrics up to date")
+@click.option("--daemon/--no-daemon", "daemon", default=None,
+              help="Require the shared daemon (ai-workbench serve), or never use it (default: use it if it is running)")
+@click.option("--record", "record_dir", default=None, type=click.Path(file_okay=False),
+              help="Record every provider exchange, with its timing, into cassettes in this directory")
+@click.option("--replay", "replay_dir", default=None, type=click.Path(exists=True, file_okay=False),
+              help="Answer requests from the cassettes in this directory instead of the network")
+@click.option("--replay-speed", default=None, type=click.FloatRange(min=0),
+              help="Replay at this multiple of the recorded speed (0: without delays; default: AWB_REPLAY_SPEED or 1)")
+@click.pass_context
+def main(ctx, provider, model, no_stream, no_cache, race, hedge_delay, route, resume, profile_startup,
+         metrics_file, prometheus_file, daemon, record_dir, replay_dir, replay_speed):
+    """AI Terminal Workbench - Your AI coding assistant in the terminal."""
+    global _daemon_mode
+    
+    # Applies to subcommands too
+    get_telemetry(metrics_file, prometheus_file)
+    if daemon is not None:
+        _daemon_mode = "1" if daemon else "0"
+    if record_dir and replay_dir:
+        raise click.UsageError("--record and --replay cannot be combined")
+    if record_dir:
+        config.override(record_dir=record_dir, replay_dir=None)
+    if replay_dir:
+        config.override(replay_dir=replay_dir, record_dir=None)
+    if replay_speed is not None:
+        config.override(replay_speed=replay_speed)
+    
+    if ctx.invoked_subcommand is not None:
+        return
+    
+    # Use default provider if not specified
+    if provider is None:
+        provider = config.default_provider
+    
+    if profile_startup:
+        display_startup_profile(provider)
+        return
+    
+    if not sys.stdin.isatty():
+        repl_only = [flag for flag, value in (("--race", race), ("--hedge-delay", hedge_delay), ("--route", route),
+                                              ("--resume", resume)) if value is not None]
+        if repl_only:
+            verb = "needs" if len(repl_only) == 1 else "need"
+            errors.print(f"[red]Error: {', '.join(repl_only)} {verb} the interactive REPL, but standard input "
+                         f"is not a terminal. Pipe prompts to 'ai-workbench ask' instead.[/red]")
+            sys.exit(2)
+        # Piped in: answer it like ``ask`` rather than starting the REPL
+        ctx.invoke(ask, prompt=(), provider=provider, model=model, no_stream=no_stream, no_cache=no_cache)
+        return
+    
+    if route is None:
+        route = config.route
+    
+    # Check if provider is configured
+    if not race and not route and not is_provider_configured(provider):
+        console.print(f"[red]Error: {provider} is not configured.[/red]")
+        console.print("[yellow]Please set up your API keys in .env file.[/yellow]")
+        console.print(f"[yellow]Copy .env.example to .env and add your API keys.[/yellow]")
+        sys.exit(1)
+    
+    if hedge_delay is None:
+        hedge_delay = parse_hedge_delay(config.hedge_delay)
+    asyncio.run(run_repl(provider, model, no_stream, not no_cache, resume, race, hedge_delay, route))
+
+
+@main.command()
+@click.argument("input_file", type=click.File("r", encoding="utf-8"), default="-")
+@click.option("--providers", "-p", default=None, help="Comma-separated providers to run every prompt on (default: the default provider)")
+@click.option("--model", "-m", default=None, help="Model to use (only with a single provider)")
+@click.option("--concurrency", "-j", default=4, show_default=True, help="Maximum requests in flight")
+@click.option("--retries", default=None, type=click.IntRange(min=0),
+              help="Retries per prompt after a transient failure (default: AWB_MAX_RETRIES)")
+@click.option("--output", "-o", type=click.File("w", encoding="utf-8"), default="-", help="Where to write JSONL results")
+@click.option("--no-cache", is_flag=True, help="Do not read or write the local response cache")
+def batch(input_file, providers, model, concurrency, retries, output, no_cache):
+    """Run prompts from a JSONL file (or stdin) concurrently.
+    
+    Each input line is a JSON string or an object with a "prompt" key (and
+    optional "id" and "system"). One JSON result per prompt and provider is
+    written in input order, with the response, error, attempts and latency.
+    """
+    from ai_workbench.batch import BatchRunner, read_prompts
+    
+    names = [name.strip().lower() for name in (providers or config.default_provider).split(",") if name.strip()]
+    if model and len(names) > 1:
+        errors.print("[red]Error: --model can only be used with a single provider.[/red]")
+        sys.exit(1)
+    for name in names:
+        if not is_provider_configured(name):
+            errors.print(f"[red]Error: {name} is not configured.[/red]")
+            sys.exit(1)
+    
+    if retries is not None:
+        # The providers' resilience layer does the retrying
+        config.override(max_retries=retries)
+    instances = [get_provider(name, model, not no_cache) for name in names]
+    runner = BatchRunner(instances, output, concurrency=concurrency, retries=config.max_retries)
+    
+    start = time.perf_counter()
+    counts = asyncio.run(runner.run(read_prompts(input_file)))
+    elapsed = time.perf_counter() - start
+    errors.print(f"[green]{counts['succeeded']} succeeded, {counts['failed']} failed in {elapsed:.1f}s[/green]")
+    if counts["failed"]:
+        sys.exit(1)
+
+
+@main.command()
+@click.argument("prompt", nargs=-1)
+@click.option("--provider", "-p", default=None, help="AI provider (default: the default provider)")
+@click.option("--model", "-m", default=None, help="Model to use")
+@click.option("--system", "-s", default=None, help="System message (default: the workbench's)")
+@click.option("--no-stream", is_flag=True, help="Wait for the whole reply instead of streaming it")
+@click.option("--no-cache", is_flag=True, help="Do not read or write the local response cache")
+@click.option("--raw", is_flag=True, help="Write raw text even to a terminal")
+def ask(prompt, provider=None, model=None, system=None, no_stream=False, no_cache=False, raw=False):
+    """Answer one prompt and exit.
+    
+    The prompt is the arguments, followed by standard input when it is
+    piped in (git diff | ai-workbench ask "review this"). Written to a
+    pipe or file, the reply is streamed as raw text; on a terminal it is
+    rendered as Markdown unless --raw is given.
+    """
+    from ai_workbench.pipe import read_prompt
+    
+    text = read_prompt(prompt, sys.stdin)
+    if text is None:
+        errors.print("[red]Usage: ai-workbench ask <prompt>, or pipe the prompt in[/red]")
+        sys.exit(1)
+    provider = provider or config.default_provider
+    if not is_provider_configured(provider):
+        errors.print(f"[red]Error: {provider} is not configured.[/red]")
+        sys.exit(1)
+    
+    instance = get_provider(provider, model, not no_cache)
+    messages = [
+        {"role": "system", "content": system or Conversation().system_message},
+        {"role": "user", "content": text},
+    ]
+    if sys.stdout.isatty() and not raw:
+        reply = generate_reply(instance, messages, no_stream)
+    else:
+        from ai_workbench.pipe import write_reply
+        reply = write_reply(instance, messages, no_stream)
+    
+    try:
+        asyncio.run(run_interruptible(reply))
+    except KeyboardInterrupt:
+        sys.exit(130)
+    except BrokenPipeError:
+        # The reader went away (| head); nothing left to write to
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(141)
+    except Exception as e:
+        errors.print(f"[red]Error: {e}[/red]")
+        sys.exit(1)
+
+
+@main.command()
+@click.argument("query", nargs=-1)
+@click.option("--limit", "-n", default=10, show_default=True, help="Maximum number of results")
+@click.option("--role", type=click.Choice(["user", "assistant"]), default=None, help="Only match messages by this role")
+@click.option("--path", "paths", multiple=True, type=click.Path(exists=True),
+              help="Also search this saved conversation file or directory of them (repeatable)")
+@click.option("--reindex", is_flag=True, help="Rebuild the search index from scratch first")
+@click.option("--json", "as_json", is_flag=True, help="Print results as JSON lines")
+def search(query, limit, role, paths, reindex, as_json):
+    """Search every saved conversation.
+    
+    All words of the query have to match, falling back to any of them;
+    "quoted phrases" match as a whole and word* matches a prefix. Results
+    are ranked by BM25.
+    """
+    index = get_search_index(paths)
+    if reindex:
+        counts = index.rebuild()
+        errors.print(f"[green]Indexed {counts['messages']:,} messages "
+                     f"from {counts['sources']:,} conversations.[/green]")
+    text = " ".join(query)
+    if not text:
+        if not reindex:
+            console.print("[red]Usage: ai-workbench search <query>[/red]")
+            sys.exit(1)
+        return
+    if as_json:
+        import json
+        from ai_workbench.search import MATCH_END, MATCH_START
+        for result in index.search(text, limit=limit, role=role):
+            result["snippet"] = result["snippet"].replace(MATCH_START, "").replace(MATCH_END, "")
+            click.echo(json.dumps(result, ensure_ascii=False))
+        return
+    run_search(index, text, limit, role)
+
+
+@main.command()
+@click.argument("path", required=False, type=click.Path(exists=True, file_okay=False))
+@click.option("--rebuild", is_flag=True, help="Drop the index and build it from scratch")
+@click.option("--jobs", "-j", default=None, type=click.IntRange(min=0),
+              help="Worker processes reading the files (0: one per CPU; default: AWB_INDEX_JOBS)")
+@click.option("--query", "-q", default=None, help="Show the code that would be retrieved for this prompt")
+def index(path, rebuild, jobs, query):
+    """Index the code of a project for retrieval in the REPL.
+    
+    Without PATH, the project of the working directory (the repository
+    it is in) is indexed. Only files that changed since the last run are
+    read again. Once a project is indexed, the REPL sends the code most
+    relevant to each prompt along with it.
+    """
+    from ai_workbench.tokens import get_estimator
+    
+    code_index = get_code_index(path)
+    try:
+        if rebuild:
+            code_index.clear()
+        update_code_index(code_index, jobs)
+        if query:
+            provider = config.default_provider
+            estimator = get_estimator(provider, config.get_default_model(provider))
+            snippets = code_index.retrieve(query, config.index_budget, estimator.count)
+            if not snippets:
+                console.print("[yellow]No matching code.[/yellow]")
+            for snippet in snippets:
+                symbol = f" {snippet['symbol']}" if snippet["symbol"] else ""
+                console.print(f"  {snippet['path']}:{snippet['start']}-{snippet['end']}{symbol} "
+                              f"[dim]({snippet['tokens']:,} tokens)[/dim]")
+    except Exception as e:
+        console.print(f"[red]Error: {e}[/red]")
+        sys.exit(1)
+    finally:
+        code_index.close()
+
+
+@main.command()
+@click.option("--socket", "socket_path", default=None, type=click.Path(),
+              help="Socket to listen on (default: AWB_DAEMON_SOCKET or daemon.sock in the data directory)")
+@click.option("--status", is_flag=True, help="Show the status of the running daemon and exit")
+@click.option("--stop", is_flag=True, help="Stop the running daemon")
+def serve(socket_path, status, stop):
+    """Run the shared daemon that other ai-workbench processes send requests to.
+    
+    The daemon keeps providers, pooled connections, the response cache,
+    rate limits and telemetry warm in one process for every terminal;
+    conversations and sessions stay in each client.
+    """
+    from pathlib import Path
+    from ai_workbench.daemon import Daemon, DaemonError, call, ping
+    
+    path = Path(socket_path).expanduser() if socket_path else config.daemon_socket
+    if status or stop:
+        info = ping(path)
+        if info is None:
+            console.print(f"[yellow]No daemon is listening on {path}.[/yellow]")
+            sys.exit(1)
+        if stop:
+            call(path, {"op": "shutdown"})
+            console.print(f"[green]Stopped the daemon (pid {info['pid']}).[/green]")
+            return
+        console.print(f"[bold]Daemon on {path}[/bold]")
+        console.print(f"  pid {info['pid']}, version {info['version']}, up {info['uptime']:.0f}s, "
+                      f"{info['requests']:,} requests")
+        console.print(f"  Configured providers: {', '.join(info['providers']) or 'none'}")
+        console.print(f"  Loaded: {', '.join(info['loaded']) or 'nothing yet'}")
+        return
+    
+    console.print(f"[green]Serving on {path} (Ctrl+C to stop)[/green]")
+    try:
+        asyncio.run(Daemon(path).serve())
+    except DaemonError as e:
+        console.print(f"[red]Error: {e}[/red]")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
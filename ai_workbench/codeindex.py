@@ -0,0 +1,448 @@
+"""Symbol and full-text index of a source tree, for retrieving code context.
+
+The files of a project (``git ls-files`` in a repository, otherwise a walk
+that skips the usual build and tool directories) are split into chunks:
+Python files along their top-level functions, classes and, in large
+classes, methods, found with ``ast``; other text files into windows of
+lines. Chunks go into an SQLite FTS5 table ranked with BM25, symbols into
+a table of their own.
+
+Updates are incremental: a file is only read again when its size or
+modification time changed, and only re-chunked when its hash changed too.
+Reading, hashing and parsing run in a process pool when many files
+changed. Retrieval ranks the chunks against a prompt and returns the best
+ones within a token budget; files of the hits that changed since they
+were indexed are re-indexed first.
+"""
+
+import ast
+import hashlib
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from ai_workbench.attachments import _walk, read_file
+
+# Lines per chunk of text files and of module-level Python code
+CHUNK_LINES = 60
+
+# Longest chunk of a function or class before it is split into windows
+MAX_CHUNK_LINES = 120
+
+# Files per task handed to a worker process
+BATCH_SIZE = 64
+
+# With fewer files to read than this, a process pool costs more than it saves
+POOL_MIN_FILES = 256
+
+# Chunks ranked per retrieval, before the budget is applied
+_CANDIDATES = 40
+
+# Prompt words too common to say anything about the code
+_STOPWORDS = frozenset(
+    "the and for are but not you all any can had her was one our out has him his how its may new now "
+    "see two who did get let put say she too use this that with from have what when where which why "
+    "will would could should there their them then than these those into about does code file files "
+    "please explain make like just want need some more also only here".split()
+)
+
+# (start line, end line, symbol, text) of a chunk, lines counted from 1
+Chunk = Tuple[int, int, str, str]
+# (name, kind, start line, end line) of a symbol
+Symbol = Tuple[str, str, int, int]
+
+
+def list_files(root: Path) -> List[str]:
+    """Paths of the project's files relative to ``root``.
+
+    In a git repository these are the tracked files and untracked ones
+    that aren't ignored.
+    """
+    if (root / ".git").exists():
+        try:
+            listing = subprocess.run(
+                ["git", "-C", str(root), "ls-files", "-z", "--cached", "--others", "--exclude-standard"],
+                capture_output=True, check=True,
+            ).stdout
+            return sorted({path for path in listing.decode("utf-8", "surrogateescape").split("\0") if path})
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    return [os.path.relpath(path, root) for path in _walk(str(root))]
+
+
+def _windows(lines: List[str], start: int, end: int, symbol: str, size: int) -> List[Chunk]:
+    """Chunks of at most ``size`` lines covering lines ``start`` to ``end``, blank ones left out."""
+    chunks = []
+    for first in range(start, end + 1, size):
+        last = min(first + size - 1, end)
+        text = "".join(lines[first - 1:last])
+        if text.strip():
+            chunks.append((first, last, symbol, text))
+    return chunks
+
+
+def _span(node) -> Tuple[int, int]:
+    """First and last line of a definition, decorators included."""
+    return min([node.lineno] + [d.lineno for d in node.decorator_list]), node.end_lineno
+
+
+def chunk_python(text: str) -> Tuple[List[Chunk], List[Symbol]]:
+    """Chunks and symbols of Python source; plain windows if it doesn't parse."""
+    lines = text.splitlines(keepends=True)
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return chunk_text(text), []
+    definitions = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    functions = (ast.FunctionDef, ast.AsyncFunctionDef)
+    chunks: List[Chunk] = []
+    symbols: List[Symbol] = []
+    gap = 1
+    for node in tree.body:
+        if not isinstance(node, definitions):
+            continue
+        start, end = _span(node)
+        chunks += _windows(lines, gap, start - 1, "", CHUNK_LINES)
+        gap = end + 1
+        if not isinstance(node, ast.ClassDef):
+            symbols.append((node.name, "function", start, end))
+            chunks += _windows(lines, start, end, node.name, MAX_CHUNK_LINES)
+            continue
+        symbols.append((node.name, "class", start, end))
+        methods = [n for n in node.body if isinstance(n, functions)]
+        for method in methods:
+            symbols.append((f"{node.name}.{method.name}", "method", *_span(method)))
+        if end - start < MAX_CHUNK_LINES:
+            chunks.append((start, end, node.name, "".join(lines[start - 1:end])))
+            continue
+        # Too large for one chunk: the class body between methods, and each method
+        cursor = start
+        for method in methods:
+            method_start, method_end = _span(method)
+            chunks += _windows(lines, cursor, method_start - 1, node.name, MAX_CHUNK_LINES)
+            chunks += _windows(lines, method_start, method_end, f"{node.name}.{method.name}", MAX_CHUNK_LINES)
+            cursor = method_end + 1
+        chunks += _windows(lines, cursor, end, node.name, MAX_CHUNK_LINES)
+    chunks += _windows(lines, gap, len(lines), "", CHUNK_LINES)
+    return chunks, symbols
+
+
+def chunk_text(text: str) -> List[Chunk]:
+    """Chunks of a text file, as windows of lines."""
+    lines = text.splitlines(keepends=True)
+    return _windows(lines, 1, len(lines), "", CHUNK_LINES)
+
+
+def _index_batch(batch: List[Tuple[str, str, Optional[str]]], max_bytes: int) -> List[Tuple[Any, ...]]:
+    """Read, hash and chunk files; run in worker processes.
+
+    Takes ``(absolute path, relative path, digest indexed before)`` and
+    returns ``(relative path, status, digest, chunks, symbols)`` for each.
+    """
+    results = []
+    for path, rel, known in batch:
+        status, digest, text, _ = read_file(path, max_bytes, (known,) if known else ())
+        chunks: List[Chunk] = []
+        symbols: List[Symbol] = []
+        if status == "ok":
+            if rel.endswith((".py", ".pyi")):
+                chunks, symbols = chunk_python(text)
+            else:
+                chunks = chunk_text(text)
+        results.append((rel, status, digest, chunks, symbols))
+    return results
+
+
+def _query_terms(text: str, limit: int = 24) -> Optional[str]:
+    """FTS5 query matching any distinctive word or identifier of ``text``."""
+    terms = []
+    for word in text.replace("`", " ").split():
+        word = word.strip(".,:;!?()[]{}<>\"'")
+        # An identifier like ``cache.get_key`` becomes the phrase "cache get key"
+        parts = "".join(c if c.isalnum() else " " for c in word).split()
+        if len(word) < 3 or word.lower() in _STOPWORDS or not parts:
+            continue
+        term = '"' + " ".join(parts) + '"'
+        if term not in terms:
+            terms.append(term)
+        if len(terms) == limit:
+            break
+    return " OR ".join(terms) or None
+
+
+class CodeIndex:
+    """Persistent index of the files under ``root``.
+
+    Args:
+        root: Directory indexed
+        path: SQLite database file of the index
+        max_bytes: Larger files are left out
+    """
+
+    def __init__(self, root: Path, path: Path, max_bytes: int = 512 * 1024):
+        self.root = Path(root).resolve()
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Updates may run in a worker thread of the REPL
+            conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, digest TEXT);"
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                " id INTEGER PRIMARY KEY, path TEXT NOT NULL, start INTEGER NOT NULL, end INTEGER NOT NULL,"
+                " symbol TEXT NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);"
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chunk_text USING fts5(path, symbol, text);"
+                "CREATE TABLE IF NOT EXISTS symbols ("
+                " name TEXT NOT NULL, kind TEXT NOT NULL, path TEXT NOT NULL, line INTEGER NOT NULL,"
+                " end_line INTEGER NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name);"
+                "CREATE INDEX IF NOT EXISTS symbols_path ON symbols (path);"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def exists(self) -> bool:
+        """Whether the index has been built."""
+        return self.path.exists()
+
+    def _remove(self, conn: sqlite3.Connection, paths: Iterable[str]):
+        for path in paths:
+            conn.execute("DELETE FROM chunk_text WHERE rowid IN (SELECT id FROM chunks WHERE path = ?)", (path,))
+            conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+            conn.execute("DELETE FROM symbols WHERE path = ?", (path,))
+
+    def _store(self, conn: sqlite3.Connection, results: Iterable[Tuple[Any, ...]], stats: Dict[str, int],
+               stamps: Dict[str, Tuple[int, int]]):
+        for rel, status, digest, chunks, symbols in results:
+            size, mtime_ns = stamps[rel]
+            if status == "unchanged":
+                conn.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?", (size, mtime_ns, rel))
+                continue
+            self._remove(conn, [rel])
+            # Skipped files are remembered too, so they aren't read again until they change
+            conn.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)",
+                         (rel, size, mtime_ns, digest if status == "ok" else None))
+            if status != "ok":
+                stats["skipped"] += 1
+                continue
+            stats["indexed"] += 1
+            first = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM chunks").fetchone()[0]
+            ids = range(first, first + len(chunks))
+            conn.executemany("INSERT INTO chunks (id, path, start, end, symbol) VALUES (?, ?, ?, ?, ?)",
+                             [(i, rel, start, end, symbol) for i, (start, end, symbol, _) in zip(ids, chunks)])
+            conn.executemany("INSERT INTO chunk_text (rowid, path, symbol, text) VALUES (?, ?, ?, ?)",
+                             [(i, rel, symbol, text) for i, (_, _, symbol, text) in zip(ids, chunks)])
+            conn.executemany("INSERT INTO symbols (name, kind, path, line, end_line) VALUES (?, ?, ?, ?, ?)",
+                             [(name, kind, rel, start, end) for name, kind, start, end in symbols])
+
+    def _stat(self, rel: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.root / rel)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def update(self, jobs: int = 0, progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, Any]:
+        """Bring the index up to date with the files under ``root``.
+
+        Args:
+            jobs: Worker processes (0: one per CPU)
+            progress: Called with (files done, files to read) as batches finish
+
+        Returns counts of the files found, read, (re)indexed, unchanged,
+        skipped and removed, and the seconds it took.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            conn = self._connect()
+            known = {path: (size, mtime_ns, digest)
+                     for path, size, mtime_ns, digest in conn.execute("SELECT path, size, mtime_ns, digest FROM files")}
+        files = list_files(self.root)
+        todo = []
+        stamps = {}
+        for rel in files:
+            stamp = self._stat(rel)
+            if stamp is None:
+                continue
+            stamps[rel] = stamp
+            entry = known.get(rel)
+            if entry is None or entry[:2] != stamp:
+                todo.append((str(self.root / rel), rel, entry[2] if entry else None))
+        removed = [path for path in known if path not in stamps]
+
+        stats = {"files": len(stamps), "read": len(todo), "indexed": 0, "skipped": 0, "removed": len(removed)}
+        batches = [todo[i:i + BATCH_SIZE] for i in range(0, len(todo), BATCH_SIZE)]
+        done = 0
+        with self._lock:
+            conn = self._connect()
+            self._remove(conn, removed)
+            conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+            if len(todo) < POOL_MIN_FILES or jobs == 1:
+                results = (_index_batch(batch, self.max_bytes) for batch in batches)
+                pool = None
+            else:
+                pool = ProcessPoolExecutor(max_workers=jobs or None)
+                results = pool.map(_index_batch, batches, [self.max_bytes] * len(batches))
+            try:
+                for batch in results:
+                    self._store(conn, batch, stats, stamps)
+                    done += len(batch)
+                    if progress is not None:
+                        progress(done, len(todo))
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+            conn.commit()
+        stats["unchanged"] = stats["read"] - stats["indexed"] - stats["skipped"]
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+    def _refresh(self, paths: Iterable[str]) -> bool:
+        """Re-index ``paths`` if they changed since they were indexed; returns whether any did."""
+        conn = self._connect()
+        stale = []
+        stamps = {}
+        for rel in paths:
+            row = conn.execute("SELECT size, mtime_ns, digest FROM files WHERE path = ?", (rel,)).fetchone()
+            stamp = self._stat(rel)
+            if stamp is None:
+                self._remove(conn, [rel])
+                conn.execute("DELETE FROM files WHERE path = ?", (rel,))
+                stale.append(None)
+            elif row is None or tuple(row[:2]) != stamp:
+                stamps[rel] = stamp
+                stale.append((str(self.root / rel), rel, row[2] if row else None))
+        todo = [entry for entry in stale if entry is not None]
+        if todo:
+            counts = {"indexed": 0, "skipped": 0}
+            self._store(conn, _index_batch(todo, self.max_bytes), counts, stamps)
+        conn.commit()
+        return bool(stale)
+
+    def _search(self, query: str) -> List[Tuple[int, str, int, int, str, str]]:
+        # Matches in the symbol name and path count more than in the code
+        return self._connect().execute(
+            "SELECT c.id, c.path, c.start, c.end, c.symbol, t.text FROM chunk_text t JOIN chunks c ON c.id = t.rowid"
+            " WHERE chunk_text MATCH ? ORDER BY bm25(chunk_text, 3.0, 5.0, 1.0) LIMIT ?",
+            (query, _CANDIDATES),
+        ).fetchall()
+
+    def retrieve(self, prompt: str, budget: int, count: Callable[[str], int]) -> List[Dict[str, Any]]:
+        """The chunks most relevant to ``prompt`` that fit in ``budget`` tokens.
+
+        Args:
+            prompt: Text to rank the chunks against
+            budget: Token budget for the chunks' text
+            count: Token counter for a text
+
+        Returns dicts with ``path``, ``start``, ``end``, ``symbol``,
+        ``text`` and ``tokens``, in file order.
+        """
+        query = _query_terms(prompt)
+        if query is None or budget <= 0:
+            return []
+        with self._lock:
+            rows = self._search(query)
+            if rows and self._refresh({row[1] for row in rows}):
+                rows = self._search(query)
+        selected = []
+        for _, path, start, end, symbol, text in rows:
+            tokens = count(text) + 12
+            if tokens > budget:
+                continue
+            budget -= tokens
+            selected.append({"path": path, "start": start, "end": end, "symbol": symbol, "text": text,
+                             "tokens": tokens})
+        selected.sort(key=lambda snippet: (snippet["path"], snippet["start"]))
+        return selected
+
+    def find_symbols(self, name: str, limit: int = 20) -> List[Tuple[str, str, str, int, int]]:
+        """Symbols named ``name`` or ending in ``.name``, as (name, kind, path, line, end line)."""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT name, kind, path, line, end_line FROM symbols WHERE name = ? OR name LIKE ? ESCAPE '\\'"
+                " ORDER BY path, line LIMIT ?",
+                (name, "%." + name.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"), limit),
+            ).fetchall()
+
+    def stats(self) -> Dict[str, Any]:
+        """Numbers of files, chunks and symbols in the index."""
+        with self._lock:
+            conn = self._connect()
+            files, indexed = conn.execute("SELECT COUNT(*), COUNT(digest) FROM files").fetchone()
+            chunks = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            symbols = conn.execute("SELECT COUNT(*) FROM symbols").fetchone()[0]
+        return {"root": str(self.root), "path": str(self.path), "files": files, "indexed": indexed,
+                "chunks": chunks, "symbols": symbols}
+
+    def clear(self):
+        """Empty the index, so the next update reads every file again."""
+        with self._lock:
+            conn = self._connect()
+            for table in ("files", "chunks", "chunk_text", "symbols"):
+                conn.execute(f"DELETE FROM {table}")
+            conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def index_file(data_dir: Path, root: Path) -> Path:
+    """Where the index of ``root`` is kept in the data directory."""
+    digest = hashlib.sha256(str(Path(root).resolve()).encode("utf-8")).hexdigest()[:16]
+    return Path(data_dir) / "index" / f"{Path(root).resolve().name}-{digest}.sqlite3"
+
+
+def format_context(snippets: List[Dict[str, Any]]) -> str:
+    """Retrieved snippets as a block to put before the prompt."""
+    parts = ["Code from the repository that may be relevant (retrieved automatically):"]
+    for snippet in snippets:
+        text = snippet["text"]
+        parts += [f'\n\n<code path="{snippet["path"]}" lines="{snippet["start"]}-{snippet["end"]}">\n', text,
+                  "" if text.endswith("\n") else "\n", "</code>"]
+    return "".join(parts)
+
+
+class ContextPrompt(dict):
+    """A user prompt with retrieved code before it.
+
+    A plain message dict, as it is sent; ``original`` is the message of
+    the conversation it was made from, for providers that keep the
+    history on their side (the Gemini chat) and match it against the
+    conversation.
+    """
+
+    __slots__ = ("original",)
+
+    def __init__(self, content: str, original: Dict[str, str]):
+        super().__init__(role="user", content=content)
+        self.original = original
+
+
+def with_context(messages: List[Dict[str, str]], snippets: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """A copy of the request with ``snippets`` before its final user prompt.
+
+    The conversation itself is left as it is, so the snippets are only
+    sent with the prompt they were retrieved for.
+    """
+    if not snippets or not messages or messages[-1]["role"] != "user":
+        return messages
+    prompt = messages[-1]
+    return messages[:-1] + [ContextPrompt(f"{format_context(snippets)}\n\n{prompt['content']}", prompt)]
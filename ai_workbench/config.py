@@ -1,16 +1,42 @@
 """Configuration management for AI Terminal Workbench."""
 
 import os
-from typing import Optional
+from typing import Any, Dict, Optional
 from pathlib import Path
-from dotenv import load_dotenv
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    """Read a boolean flag such as ``1``/``0`` or ``true``/``false`` from the environment."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
 
 
 class Config:
-    """Configuration manager for the application."""
+    """Configuration manager for the application.
+    
+    Settings are read lazily: the ``.env`` file is only searched for and
+    loaded the first time a setting is accessed, so importing this module
+    costs nothing.
+    """
     
     def __init__(self):
-        # Load environment variables
+        self._loaded = False
+    
+    def __getattr__(self, name: str):
+        # Only called for attributes that are not set yet, i.e. before the
+        # first load.
+        if name.startswith("_") or self._loaded:
+            raise AttributeError(name)
+        self._load()
+        return getattr(self, name)
+    
+    def _load(self):
+        """Load environment variables and populate the settings."""
+        self._loaded = True
+        
+        from dotenv import load_dotenv
         load_dotenv()
         
         # API Keys
@@ -18,6 +44,13 @@ class Config:
         self.anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
         self.google_api_key = os.getenv("GOOGLE_API_KEY")
         
+        # Alternative API endpoints (proxies, gateways, local stand-ins)
+        self.base_urls = {
+            "openai": os.getenv("OPENAI_BASE_URL"),
+            "anthropic": os.getenv("ANTHROPIC_BASE_URL"),
+            "google": os.getenv("GOOGLE_API_ENDPOINT"),
+        }
+        
         # Default settings
         self.default_provider = os.getenv("DEFAULT_PROVIDER", "openai")
         self.default_model = os.getenv("DEFAULT_MODEL", "gpt-4")
@@ -28,20 +61,231 @@ class Config:
             "anthropic": "claude-3-5-sonnet-20241022",
             "google": "gemini-2.0-flash-exp"
         }
+        
+        # Context window sizes in tokens, matched by longest model-name prefix
+        self.context_windows = {
+            "gpt-3.5-turbo": 16385,
+            "gpt-4": 8192,
+            "gpt-4-32k": 32768,
+            "gpt-4-turbo": 128000,
+            "gpt-4o": 128000,
+            "gpt-4.1": 1047576,
+            "o1": 200000,
+            "o3": 200000,
+            "o4": 200000,
+            "claude": 200000,
+            "gemini-pro": 32760,
+            "gemini-1.5-flash": 1048576,
+            "gemini-1.5-pro": 2097152,
+            "gemini-2": 1048576,
+        }
+        self.default_context_window = 8192
+        
+        # Model registry for routing (--route): provider, context window,
+        # maximum output tokens, cost in USD per million input and output
+        # tokens, and the time to first token (s) and output speed
+        # (tokens/s) assumed until they have been measured
+        self.models = {
+            "gpt-4o-mini": {"provider": "openai", "context_window": 128000, "max_output": 16384,
+                            "cost": (0.15, 0.6), "ttft": 0.4, "tokens_per_second": 90},
+            "gpt-4o": {"provider": "openai", "context_window": 128000, "max_output": 16384,
+                       "cost": (2.5, 10.0), "ttft": 0.5, "tokens_per_second": 70},
+            "gpt-4.1-mini": {"provider": "openai", "context_window": 1047576, "max_output": 32768,
+                             "cost": (0.4, 1.6), "ttft": 0.45, "tokens_per_second": 80},
+            "gpt-4.1": {"provider": "openai", "context_window": 1047576, "max_output": 32768,
+                        "cost": (2.0, 8.0), "ttft": 0.6, "tokens_per_second": 60},
+            "gpt-4": {"provider": "openai", "context_window": 8192, "max_output": 8192,
+                      "cost": (30.0, 60.0), "ttft": 0.8, "tokens_per_second": 25},
+            "claude-3-5-haiku-20241022": {"provider": "anthropic", "context_window": 200000, "max_output": 8192,
+                                          "cost": (0.8, 4.0), "ttft": 0.5, "tokens_per_second": 60},
+            "claude-3-5-sonnet-20241022": {"provider": "anthropic", "context_window": 200000, "max_output": 8192,
+                                           "cost": (3.0, 15.0), "ttft": 0.8, "tokens_per_second": 55},
+            "gemini-2.0-flash-exp": {"provider": "google", "context_window": 1048576, "max_output": 8192,
+                                     "cost": (0.1, 0.4), "ttft": 0.4, "tokens_per_second": 150},
+            "gemini-1.5-pro": {"provider": "google", "context_window": 2097152, "max_output": 8192,
+                               "cost": (1.25, 5.0), "ttft": 0.8, "tokens_per_second": 60},
+        }
+        
+        # Routing: policy (fastest, cheapest or auto; unset = off), the
+        # models routed between (default: every registry model of a
+        # configured provider), prompts up to this many tokens count as
+        # short questions under "auto", and the reply length assumed when
+        # predicting latency and cost
+        self.route = os.getenv("AWB_ROUTE") or None
+        self.route_models = [m.strip() for m in os.getenv("AWB_ROUTE_MODELS", "").split(",") if m.strip()]
+        self.route_short_tokens = int(os.getenv("AWB_ROUTE_SHORT_TOKENS", "2000"))
+        self.route_reply_tokens = int(os.getenv("AWB_ROUTE_REPLY_TOKENS", "500"))
+        
+        # Context management: token budget and how to stay under it
+        self.context_window_override = int(os.getenv("AWB_CONTEXT_WINDOW", "0")) or None
+        self.context_reserve = int(os.getenv("AWB_CONTEXT_RESERVE", "4096"))
+        self.context_policy = os.getenv("AWB_CONTEXT_POLICY", "pin")
+        
+        # Provider-side prompt caching: Anthropic cache breakpoints, stable
+        # OpenAI prefixes and (above a size) Gemini cached content
+        self.prompt_cache = _env_flag("AWB_PROMPT_CACHE", True)
+        # Share of the budget freed when history has to be dropped, so that
+        # requests keep a cacheable beginning for a while
+        self.context_slack = float(os.getenv("AWB_CONTEXT_SLACK", "0.2"))
+        self.gemini_cache_min_tokens = int(os.getenv("AWB_GEMINI_CACHE_MIN_TOKENS", "0"))
+        self.gemini_cache_ttl = float(os.getenv("AWB_GEMINI_CACHE_TTL", "3600"))
+        
+        # Race mode: seconds (or "p95") before backup requests are sent;
+        # unset races all providers at once
+        self.hedge_delay = os.getenv("AWB_HEDGE_DELAY") or None
+        
+        # Session journals
+        self.data_dir = Path(os.getenv("AWB_DATA_DIR", Path.home() / ".local" / "share" / "ai-workbench"))
+        self.sessions_enabled = _env_flag("AWB_SESSIONS", True)
+        self.resume_messages = int(os.getenv("AWB_RESUME_MESSAGES", "1000"))
+        
+        # Conversation memory: newest message content before the latest
+        # request window kept as is (the window always is), compressed
+        # messages kept in memory before the oldest are spilled to a segment
+        # file in the data directory, and the compression ("zlib" or "lzma")
+        self.memory_hot_kb = float(os.getenv("AWB_MEMORY_HOT_KB", "512"))
+        self.memory_cold_mb = float(os.getenv("AWB_MEMORY_COLD_MB", "16"))
+        self.memory_compression = os.getenv("AWB_MEMORY_COMPRESSION", "zlib").strip().lower()
+        
+        # Prompt history: kept per project ("project") or for all
+        # directories ("global"), recent prompts loaded for up-arrow and
+        # Ctrl-R, and prompts kept per project
+        self.history_enabled = _env_flag("AWB_HISTORY", True)
+        self.history_scope = os.getenv("AWB_HISTORY_SCOPE", "project").strip().lower()
+        self.history_load = int(os.getenv("AWB_HISTORY_LOAD", "10000"))
+        self.history_max = int(os.getenv("AWB_HISTORY_MAX", "200000"))
+        
+        # Shared daemon (ai-workbench serve): "auto" uses it when it is
+        # running, "1" requires it, "0" never uses it
+        self.daemon = os.getenv("AWB_DAEMON", "auto").strip().lower()
+        self.daemon_socket = Path(os.getenv("AWB_DAEMON_SOCKET") or self.data_dir / "daemon.sock").expanduser()
+        
+        # Saved conversation files (or directories of them) searched along
+        # with the sessions, separated like PATH
+        self.search_paths = [Path(p).expanduser() for p in os.getenv("AWB_SEARCH_PATHS", "").split(os.pathsep) if p]
+        
+        # /attach: files larger than this are skipped, and so are files past
+        # the total for all attachments of a conversation
+        self.attach_max_kb = float(os.getenv("AWB_ATTACH_MAX_KB", "512"))
+        self.attach_total_mb = float(os.getenv("AWB_ATTACH_TOTAL_MB", "8"))
+        
+        # Code index (/index, ai-workbench index): code retrieved for each
+        # prompt once the project is indexed, within this many tokens;
+        # larger files are left out, and indexing uses this many processes
+        # (0: one per CPU)
+        self.index_retrieve = _env_flag("AWB_INDEX", True)
+        self.index_budget = int(os.getenv("AWB_INDEX_BUDGET", "3000"))
+        self.index_max_kb = float(os.getenv("AWB_INDEX_MAX_KB", "512"))
+        self.index_jobs = int(os.getenv("AWB_INDEX_JOBS", "0"))
+        
+        # Local response cache
+        self.cache_enabled = _env_flag("AWB_CACHE", True)
+        self.cache_dir = Path(os.getenv("AWB_CACHE_DIR", Path.home() / ".cache" / "ai-workbench"))
+        self.cache_max_mb = float(os.getenv("AWB_CACHE_MAX_MB", "200"))
+        self.cache_ttl = float(os.getenv("AWB_CACHE_TTL", str(7 * 24 * 3600)))
+        
+        # HTTP connection pooling
+        self.http_max_connections = int(os.getenv("AWB_HTTP_MAX_CONNECTIONS", "20"))
+        self.http_max_keepalive = int(os.getenv("AWB_HTTP_MAX_KEEPALIVE", "10"))
+        self.http_keepalive_expiry = float(os.getenv("AWB_HTTP_KEEPALIVE_EXPIRY", "300"))
+        self.prewarm = _env_flag("AWB_PREWARM", True)
+        
+        # Maximum redraws per second while streaming a response
+        self.render_fps = float(os.getenv("AWB_RENDER_FPS", "15"))
+        
+        # Retries of transient errors (429, 5xx, dropped connections)
+        self.max_retries = int(os.getenv("AWB_MAX_RETRIES", "3"))
+        self.retry_base_delay = float(os.getenv("AWB_RETRY_BASE_DELAY", "0.5"))
+        self.retry_max_delay = float(os.getenv("AWB_RETRY_MAX_DELAY", "30"))
+        
+        # Client-side rate limits per provider (0 = unlimited), e.g.
+        # AWB_OPENAI_RPM=500, AWB_OPENAI_TPM=30000
+        self.rate_limits = {
+            name: (float(os.getenv(f"AWB_{name.upper()}_RPM", "0")), float(os.getenv(f"AWB_{name.upper()}_TPM", "0")))
+            for name in ("openai", "anthropic", "google")
+        }
+        
+        # Request telemetry exports (JSONL per request, Prometheus textfile)
+        self.metrics_file = os.getenv("AWB_METRICS_FILE") or None
+        self.prometheus_file = os.getenv("AWB_PROMETHEUS_FILE") or None
+        
+        # Cassettes: record every provider exchange into a directory, or
+        # replay them from one instead of the network, at this multiple of
+        # the recorded speed (0 = without delays)
+        self.record_dir = os.getenv("AWB_RECORD_DIR") or None
+        self.replay_dir = os.getenv("AWB_REPLAY_DIR") or None
+        self.replay_speed = float(os.getenv("AWB_REPLAY_SPEED", "1"))
+    
+    def override(self, **settings):
+        """Set settings, e.g. from command line options, over the loaded ones."""
+        if not self._loaded:
+            self._load()
+        for name, value in settings.items():
+            setattr(self, name, value)
     
     def get_api_key(self, provider: str) -> Optional[str]:
-        """Get API key for a specific provider."""
+        """Get API key for a specific provider.
+        
+        Replaying cassettes needs no keys; a placeholder stands in for
+        missing ones.
+        """
         keys = {
             "openai": self.openai_api_key,
             "anthropic": self.anthropic_api_key,
             "google": self.google_api_key
         }
-        return keys.get(provider)
+        key = keys.get(provider)
+        if key is None and self.replay_dir and provider in keys:
+            return "replay"
+        return key
+    
+    def get_provider_options(self, provider: str) -> Dict[str, Any]:
+        """Keyword arguments for a provider's constructor besides key and model."""
+        options: Dict[str, Any] = {"base_url": self.base_urls.get(provider), "prompt_cache": self.prompt_cache}
+        if provider == "google":
+            options["cache_min_tokens"] = self.gemini_cache_min_tokens
+            options["cache_ttl"] = self.gemini_cache_ttl
+        return options
+    
+    def provider_settings(self, provider: str) -> Dict[str, Any]:
+        """Settings that shape a provider's requests, as plain JSON values.
+        
+        The shared daemon only serves a client whose settings match its
+        own, so a terminal's key, endpoint and retry, rate limit and cache
+        settings are never silently replaced by the daemon's. The API key
+        is only included as a hash.
+        """
+        import hashlib
+        
+        key = self.get_api_key(provider)
+        return {
+            "api_key": hashlib.sha256(key.encode("utf-8")).hexdigest()[:16] if key else None,
+            **self.get_provider_options(provider),
+            "max_retries": self.max_retries,
+            "retry_base_delay": self.retry_base_delay,
+            "retry_max_delay": self.retry_max_delay,
+            "rate_limits": list(self.rate_limits.get(provider, (0, 0))),
+            "cache_enabled": self.cache_enabled,
+            "cache_dir": str(self.cache_dir),
+            "cache_max_mb": self.cache_max_mb,
+            "cache_ttl": self.cache_ttl,
+        }
     
     def get_default_model(self, provider: str) -> str:
         """Get default model for a provider."""
         return self.provider_models.get(provider, self.default_model)
     
+    def get_context_window(self, model: str) -> int:
+        """Get the context window size of a model in tokens."""
+        if self.context_window_override:
+            return self.context_window_override
+        if model in self.models:
+            return self.models[model]["context_window"]
+        matches = [prefix for prefix in self.context_windows if model.startswith(prefix)]
+        if not matches:
+            return self.default_context_window
+        return self.context_windows[max(matches, key=len)]
+    
     def is_configured(self, provider: str) -> bool:
         """Check if a provider is configured with an API key."""
         return self.get_api_key(provider) is not None
@@ -0,0 +1,178 @@
+"""Keep requests within a model's context window."""
+
+import bisect
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from ai_workbench.conversation import Conversation
+from ai_workbench.tokens import TokenEstimator
+
+# Available context policies:
+#   sliding   - keep the newest messages that fit
+#   pin       - always keep the first exchange, then the newest messages
+#   summarize - collapse old turns into a summary instead of dropping them
+POLICIES = ("sliding", "pin", "summarize")
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below so it can replace the original messages "
+    "as context for continuing it. Keep facts, decisions, requirements, file "
+    "names, identifiers and code that later turns may depend on. Be concise."
+)
+
+
+class ContextWindow:
+    """Select the messages of a conversation that fit in a token budget.
+
+    Token counts come from the conversation's per-message cache, and the cut
+    point is found by binary search over cumulative counts, so fitting a
+    long conversation costs O(new messages + log n) per turn.
+
+    With ``slack`` (a fraction of the budget), a history that has to be cut
+    is cut short enough to leave that much room, and the cut then stays put
+    until the history outgrows it again. Requests keep the same beginning
+    for many turns instead of losing a message every turn, so providers'
+    prompt caches keep matching.
+    """
+
+    def __init__(self, estimator: TokenEstimator, context_window: int, reserve: int, policy: str = "pin",
+                 slack: float = 0.0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown context policy '{policy}' (choose from {', '.join(POLICIES)})")
+        self.estimator = estimator
+        self.context_window = context_window
+        self.policy = policy
+        # Room left for the system message and history after reserving the reply
+        self.budget = max(context_window - reserve, 0)
+        self.slack = slack
+        # (id of the conversation, index of the first message sent) of the
+        # last cut, kept while it still fits
+        self._last_cut: Optional[Tuple[int, int]] = None
+        self.last_usage: Optional[Dict[str, object]] = None
+
+    def _system_suffix(self, conversation: Conversation) -> str:
+        if self.policy == "summarize" and conversation.summary:
+            return f"\n\nSummary of the earlier conversation:\n{conversation.summary}"
+        return ""
+
+    def _pinned_count(self, conversation: Conversation) -> int:
+        """Number of leading messages that are always sent."""
+        messages = conversation.messages
+        # Pin the first exchange so the kept history still starts with a user
+        # turn after it
+        if self.policy == "pin" and len(messages) > 2 and messages[1]["role"] == "assistant":
+            return 2
+        return 0
+
+    def _cut(self, conversation: Conversation, available: int, floor: int) -> int:
+        """Index of the first message to send so that the rest fits in ``available`` tokens."""
+        messages = conversation.messages
+        sums = conversation.token_sums(self.estimator)
+        n = len(messages)
+        start = bisect.bisect_left(sums, sums[n] - available, floor, n)
+        # The current prompt is always sent, even if it alone is over budget
+        start = min(start, max(n - 1, floor))
+        # Providers expect the history to start with a user turn
+        while start < n - 1 and messages[start]["role"] != "user":
+            start += 1
+        return start
+
+    def _stable_cut(self, conversation: Conversation, available: int, floor: int, start: int) -> int:
+        """Cut point for a history that does not fit, moved as rarely as possible."""
+        messages = conversation.messages
+        n = len(messages)
+        if self._last_cut is not None and self._last_cut[0] == id(conversation):
+            previous = self._last_cut[1]
+            # The previous cut is at or after ``start`` exactly when what
+            # follows it still fits
+            if start <= previous < n and messages[previous]["role"] == "user":
+                return previous
+        start = max(start, self._cut(conversation, int(available * (1 - self.slack)), floor))
+        self._last_cut = (id(conversation), start)
+        return start
+
+    def fit(self, conversation: Conversation, extra: int = 0) -> List[Dict[str, str]]:
+        """Return the request messages (system message first) within the budget.
+
+        Also records token usage in ``last_usage``.
+
+        Args:
+            conversation: The conversation to send
+            extra: Tokens to leave room for, for text added to the request
+                besides the conversation (retrieved code)
+        """
+        messages = conversation.messages
+        sums = conversation.token_sums(self.estimator)
+        n = len(messages)
+
+        suffix = self._system_suffix(conversation)
+        system = conversation.system_content(suffix)
+        system_tokens = conversation.system_tokens(self.estimator, suffix)
+        pinned = self._pinned_count(conversation)
+        summarized = min(conversation.summarized_count, n) if self.policy == "summarize" else 0
+        # Messages before ``floor`` are pinned or replaced by the summary
+        floor = max(pinned, summarized)
+        available = self.budget - system_tokens - sums[pinned] - extra
+        start = self._cut(conversation, available, floor)
+        if self.slack and start > floor:
+            start = self._stable_cut(conversation, available, floor, start)
+
+        self.last_usage = {
+            "policy": self.policy,
+            "context_window": self.context_window,
+            "budget": self.budget,
+            "tokens": system_tokens + sums[pinned] + sums[n] - sums[start] + extra,
+            "system_tokens": system_tokens,
+            "attachments": len(conversation.attachments),
+            "attachment_tokens": conversation.attachment_tokens(self.estimator),
+            "history_tokens": sums[n],
+            "retrieved_tokens": extra,
+            "messages_total": n,
+            "messages_sent": pinned + n - start,
+            "messages_dropped": start - floor,
+            "messages_summarized": summarized,
+            "exact": self.estimator.exact,
+        }
+        return [{"role": "system", "content": system}] + messages[:pinned] + messages.request_window(start)
+
+    async def summarize(self, conversation: Conversation, summarizer: Callable[[List[Dict[str, str]]], Awaitable[str]]) -> bool:
+        """Collapse old turns into the conversation summary if they no longer fit.
+
+        Turns are collapsed until the remaining history fits in half of the
+        budget, so the summary is only regenerated after the conversation has
+        grown by that much again.
+
+        Args:
+            conversation: The conversation to summarize
+            summarizer: Async callable that takes request messages and returns
+                the model's reply, e.g. a provider's ``agenerate_response``
+
+        Returns:
+            True if a new summary was produced
+        """
+        if self.policy != "summarize":
+            return False
+
+        messages = conversation.messages
+        sums = conversation.token_sums(self.estimator)
+        n = len(messages)
+        floor = min(conversation.summarized_count, n)
+        system_tokens = conversation.system_tokens(self.estimator, self._system_suffix(conversation))
+        if system_tokens + sums[n] - sums[floor] <= self.budget:
+            return False
+
+        start = self._cut(conversation, (self.budget - system_tokens) // 2, floor)
+        # The summary request itself has to fit in the window; whatever is
+        # left over is dropped for now and summarized on a later turn.
+        limit = sums[floor] + self.budget - self.estimator.count(SUMMARY_PROMPT)
+        start = min(start, bisect.bisect_right(sums, limit, floor, n + 1) - 1)
+        if start <= floor:
+            return False
+
+        transcript = "\n\n".join(f"{msg['role']}: {msg['content']}" for msg in messages[floor:start])
+        if conversation.summary:
+            transcript = f"Summary so far:\n{conversation.summary}\n\n{transcript}"
+        conversation.summary = await summarizer([
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ])
+        conversation.summarized_count = start
+        return True
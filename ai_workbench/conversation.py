@@ -1,49 +1,275 @@
 """Conversation history management."""
 
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+import hashlib
 import json
+import time
 from pathlib import Path
 
+from ai_workbench.memory import Message, MessageStore
+
 
 class Conversation:
-    """Manages conversation history."""
+    """Manages conversation history.
+    
+    Change ``messages`` through the methods below: they bump ``version``,
+    which invalidates what is memoized from the history.
     
-    def __init__(self):
-        self.messages: List[Dict[str, str]] = []
+    Args:
+        messages: Empty store to keep the history in (see ``MessageStore``
+            for how older messages are compressed); default limits if None
+    """
+    
+    def __init__(self, messages: Optional[MessageStore] = None):
+        self.messages: MessageStore = messages if messages is not None else MessageStore()
+        # Incremented on every change to the history
+        self.version = 0
+        self._request = None
+        self._request_key = None
         self.system_message = "You are an expert coding assistant helping developers with terminal-based tasks. Provide clear, concise, and accurate code solutions."
+        # Summary of the first ``summarized_count`` messages, used by the
+        # summarizing context policy
+        self.summary = None
+        self.summarized_count = 0
+        # Cumulative token counts per estimator key: sums[i] is the number
+        # of tokens in messages[:i]
+        self._token_sums: Dict[str, List[int]] = {}
+        # Attached files: path -> content digest, in the order attached,
+        # and the content of each digest, held once however many paths
+        # (or re-attachments) refer to it
+        self.attachments: Dict[str, str] = {}
+        self.blobs: Dict[str, str] = {}
+        self._blob_refs: Dict[str, int] = {}
+        # Incremented on every change to the attachments
+        self.attachments_version = 0
+        self._system: Tuple[Optional[tuple], str] = (None, "")
+        # Token counts per estimator key and digest, and the memoized sum
+        self._blob_tokens: Dict[str, Dict[str, int]] = {}
+        self._attachment_tokens: Dict[str, Tuple[int, int]] = {}
+        # Whether the last message is a reply that was interrupted before
+        # it was complete (see add_assistant_message)
+        self.truncated = False
+        # Optional SessionJournal that every change is appended to
+        self.journal = None
+    
+    def _record(self, record: Dict[str, str]):
+        """Append a change to the session journal, if there is one."""
+        if self.journal is not None:
+            record["ts"] = time.time()
+            self.journal.append(record)
     
     def add_system_message(self, content: str):
         """Add or update the system message."""
         self.system_message = content
+        self._record({"type": "system", "content": content})
+    
+    def _append(self, role: str, content: str):
+        self.version += 1
+        self.messages.append(Message(role, content, self.version))
+        self.truncated = False
     
     def add_user_message(self, content: str):
         """Add a user message to the conversation."""
-        self.messages.append({"role": "user", "content": content})
+        self._append("user", content)
+        self._record({"type": "message", "role": "user", "content": content})
+    
+    def add_assistant_message(self, content: str, truncated: bool = False):
+        """Add an assistant message to the conversation.
+        
+        ``truncated`` marks a reply that was cut short (e.g. cancelled),
+        which can then be continued.
+        """
+        self._append("assistant", content)
+        record = {"type": "message", "role": "assistant", "content": content}
+        if truncated:
+            self.truncated = True
+            record["truncated"] = True
+        self._record(record)
+    
+    def pop_message(self) -> Dict[str, str]:
+        """Remove and return the last message."""
+        message = self.messages.pop()
+        self.version += 1
+        self.truncated = False
+        self._record({"type": "pop"})
+        for sums in self._token_sums.values():
+            del sums[len(self.messages) + 1:]
+        if self.summarized_count > len(self.messages):
+            self.summary = None
+            self.summarized_count = 0
+        return message
     
-    def add_assistant_message(self, content: str):
-        """Add an assistant message to the conversation."""
-        self.messages.append({"role": "assistant", "content": content})
+    def token_sums(self, estimator) -> List[int]:
+        """Get cumulative token counts of the messages for an estimator.
+        
+        Counts are cached, so each call only estimates messages added since
+        the previous one.
+        """
+        sums = self._token_sums.setdefault(estimator.key, [0])
+        if len(sums) > len(self.messages) + 1:
+            # Messages were removed behind our back; drop the stale counts
+            del sums[len(self.messages) + 1:]
+        for msg in self.messages[len(sums) - 1:]:
+            sums.append(sums[-1] + estimator.count_message(msg))
+        return sums
+    
+    def attach(self, path: str, digest: str, content: Optional[str] = None) -> bool:
+        """Attach a file's content, sent with the system message.
+        
+        ``content`` may be omitted when a blob with ``digest`` is already
+        held: attaching the same content again only adds a reference.
+        Returns False if ``path`` was already attached with this content.
+        """
+        if self.attachments.get(path) == digest:
+            return False
+        if digest not in self.blobs:
+            if content is None:
+                raise ValueError(f"No content for attachment {path}")
+            self.blobs[digest] = content
+            if self.journal is not None:
+                self.journal.store_blob(digest, content)
+        previous = self.attachments.get(path)
+        self.attachments[path] = digest
+        self._blob_refs[digest] = self._blob_refs.get(digest, 0) + 1
+        self._release(previous)
+        self.attachments_version += 1
+        self._record({"type": "attach", "path": path, "digest": digest})
+        return True
+    
+    def detach(self, path: str) -> bool:
+        """Detach a file; returns False if it wasn't attached."""
+        digest = self.attachments.pop(path, None)
+        if digest is None:
+            return False
+        self._release(digest)
+        self.attachments_version += 1
+        self._record({"type": "detach", "path": path})
+        return True
+    
+    def _release(self, digest: Optional[str]):
+        """Drop a reference to a blob, and the blob with the last one."""
+        if digest is None:
+            return
+        self._blob_refs[digest] -= 1
+        if not self._blob_refs[digest]:
+            del self._blob_refs[digest]
+            del self.blobs[digest]
+            for counts in self._blob_tokens.values():
+                counts.pop(digest, None)
+    
+    def attachment_tokens(self, estimator) -> int:
+        """Tokens of the attached files; each content is only counted once."""
+        version, total = self._attachment_tokens.get(estimator.key, (-1, 0))
+        if version != self.attachments_version:
+            counts = self._blob_tokens.setdefault(estimator.key, {})
+            total = 0
+            for path, digest in self.attachments.items():
+                count = counts.get(digest)
+                if count is None:
+                    count = counts[digest] = estimator.count(self.blobs[digest])
+                # Plus the file's tag and path
+                total += count + estimator.count(path) + 8
+            self._attachment_tokens[estimator.key] = (self.attachments_version, total)
+        return total
+    
+    def system_content(self, suffix: str = "") -> str:
+        """The system message with the attached files and ``suffix`` after it.
+        
+        Memoized, and built with a single join, so the attached files are
+        held once in the request rather than copied on every turn.
+        """
+        key = (self.system_message, self.attachments_version, suffix)
+        if self._system[0] != key:
+            parts = [self.system_message]
+            if self.attachments:
+                parts.append("\n\nAttached files:")
+                for path, digest in self.attachments.items():
+                    content = self.blobs[digest]
+                    parts += ['\n\n<file path="', path, '">\n', content,
+                              "" if content.endswith("\n") else "\n", "</file>"]
+            parts.append(suffix)
+            # Release the previous content before building the new one
+            self._system = (None, "")
+            self._system = (key, "".join(parts))
+        return self._system[1]
+    
+    def system_tokens(self, estimator, suffix: str = "") -> int:
+        """Tokens of ``system_content(suffix)`` as a system message."""
+        base = estimator.count_message({"role": "system", "content": self.system_message + suffix})
+        return base + self.attachment_tokens(estimator)
     
     def get_messages(self) -> List[Dict[str, str]]:
-        """Get all messages including system message."""
-        return [{"role": "system", "content": self.system_message}] + self.messages
+        """Get all messages including system message.
+        
+        The list is rebuilt only after the conversation changes, so the
+        same list is returned until then; don't modify it.
+        """
+        key = (self.version, id(self.messages), len(self.messages), self.system_message, self.attachments_version)
+        if self._request_key != key:
+            self._request = [{"role": "system", "content": self.system_content()}] + self.messages[:]
+            self._request_key = key
+        return self._request
+    
+    def replace_messages(self, messages: List[Dict[str, str]]):
+        """Replace the history with ``messages`` (dicts with role and content)."""
+        self.version += 1
+        self.messages.clear()
+        for msg in messages:
+            self.version += 1
+            message = Message(msg["role"], msg["content"], self.version)
+            if len(msg) > 2:
+                # Keep any extra keys a saved file may have
+                message.update(msg)
+            self.messages.append(message)
+        self.truncated = False
+        self.summary = None
+        self.summarized_count = 0
+        self._token_sums = {}
     
     def clear(self):
-        """Clear conversation history."""
-        self.messages = []
+        """Clear conversation history (attached files stay attached)."""
+        self.version += 1
+        self.messages.clear()
+        self.truncated = False
+        self.summary = None
+        self.summarized_count = 0
+        self._token_sums = {}
+        self._record({"type": "clear"})
     
     def save(self, filepath: Path):
         """Save conversation to a file."""
         data = {
             "system_message": self.system_message,
-            "messages": self.messages
+            "messages": []
         }
+        if self.truncated:
+            data["truncated"] = True
+        if self.attachments:
+            data["attachments"] = [
+                {"path": path, "content": self.blobs[digest]} for path, digest in self.attachments.items()
+            ]
+        # The messages are written one at a time, so cold ones are only
+        # decompressed while they are written; the output is what
+        # json.dump(data, f, indent=2) writes with them in place
+        head, tail = json.dumps(data, indent=2).split('\n  "messages": []', 1)
         with open(filepath, "w") as f:
-            json.dump(data, f, indent=2)
+            f.write(head + '\n  "messages": [')
+            separator = "\n    "
+            for message in self.messages:
+                f.write(separator + json.dumps(message, indent=2).replace("\n", "\n    "))
+                separator = ",\n    "
+            f.write("]" if separator == "\n    " else "\n  ]")
+            f.write(tail)
     
     def load(self, filepath: Path):
         """Load conversation from a file."""
         with open(filepath, "r") as f:
             data = json.load(f)
         self.system_message = data.get("system_message", self.system_message)
-        self.messages = data.get("messages", [])
+        self.replace_messages(data.get("messages", []))
+        self.truncated = bool(data.get("truncated"))
+        for path in list(self.attachments):
+            self.detach(path)
+        for attachment in data.get("attachments", []):
+            content = attachment["content"]
+            self.attach(attachment["path"], hashlib.sha256(content.encode("utf-8")).hexdigest(), content)
@@ -0,0 +1,389 @@
+"""Shared daemon serving provider requests over a Unix domain socket.
+
+``ai-workbench serve`` keeps the providers, their pooled connections, the
+response cache, the rate limiters and the request telemetry in one
+long-lived process. While it runs, every ``ai-workbench`` talks to it
+through ``RemoteProvider`` instead of importing the vendor SDKs and
+opening connections of its own. Conversations, sessions, context
+management and rendering stay in the client, so the daemon holds no
+per-terminal state.
+
+The daemon builds providers from its own environment, so every request
+carries the client's ``Config.provider_settings`` (the API key as a hash,
+the endpoint, the retry, rate limit and cache settings). A request whose
+settings differ from the daemon's is refused with ``SettingsMismatch``,
+and the client uses a provider of its own instead: a terminal pointed at
+another key or a local gateway never has its prompts sent elsewhere.
+
+The protocol is newline-delimited JSON with one request per connection:
+
+- ``{"op": "ping"}``: the daemon's pid, version and configured providers
+- ``{"op": "open", "provider", "model", "use_cache", "settings"}``:
+  validates a provider and returns its name and model
+- ``{"op": "generate", ..., "messages", "stream", "kwargs"}``: the reply
+  as ``{"chunk"}`` lines (or one ``{"text"}`` line), then
+  ``{"done": true, "usage", "cached"}``
+- ``{"op": "continuation", ..., "messages", "partial"}``: the provider's
+  ``continuation_messages``
+- ``{"op": "prewarm", ...}`` and ``{"op": "shutdown"}``
+
+Failures are replied as ``{"error": message}``, plus ``"mismatch": true``
+for differing settings. A client cancels a
+request by closing the connection, which cancels the request in the
+daemon and closes its upstream stream.
+"""
+
+import asyncio
+import json
+import os
+import signal
+import socket
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from ai_workbench.providers import AIProvider
+
+# Longest protocol line: requests carry the whole request history
+_LINE_LIMIT = 1 << 28
+
+
+class DaemonError(Exception):
+    """Error reported by the daemon."""
+
+
+class SettingsMismatch(DaemonError):
+    """The daemon's provider settings differ from the client's."""
+
+
+def _encode(data: Dict[str, Any]) -> bytes:
+    return json.dumps(data, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+def _decode(line: bytes) -> Dict[str, Any]:
+    reply = json.loads(line)
+    if "error" in reply:
+        raise (SettingsMismatch if reply.get("mismatch") else DaemonError)(reply["error"])
+    return reply
+
+
+def call(path: Path, payload: Dict[str, Any], timeout: Optional[float] = 10.0) -> Dict[str, Any]:
+    """Send a request to the daemon and return its (single-line) reply."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall(_encode(payload))
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise DaemonError("The daemon closed the connection")
+    return _decode(line)
+
+
+def ping(path: Path) -> Optional[Dict[str, Any]]:
+    """Status of the daemon listening on ``path``, or None if there is none."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    try:
+        return call(path, {"op": "ping"}, timeout=2.0)
+    except (OSError, ValueError, DaemonError):
+        return None
+
+
+class RemoteProvider(AIProvider):
+    """Provider whose requests are served by the daemon.
+
+    Creating one asks the daemon to set up the provider, so an unknown or
+    unconfigured provider fails here with ``DaemonError``, and one whose
+    settings differ from the daemon's with ``SettingsMismatch``.
+
+    Args:
+        path: Socket of the daemon
+        provider: Registry name of the provider to use
+        model: Model, or None for the daemon's default
+        use_cache: Whether the daemon's response cache is used
+        settings: The client's ``Config.provider_settings`` for the
+            provider, checked by the daemon on every request
+    """
+
+    def __init__(self, path: Path, provider: str, model: Optional[str] = None, use_cache: bool = True,
+                 settings: Optional[Dict[str, Any]] = None):
+        self.path = Path(path)
+        self.use_cache = use_cache
+        self.settings = settings or {}
+        opened = call(self.path, {"op": "open", "provider": provider, "model": model, "use_cache": use_cache,
+                                  "settings": self.settings})
+        super().__init__(None, opened["model"])
+        self.name = opened["name"]
+        # Whether the last reply came from the daemon's response cache
+        self.last_hit = False
+
+    def _payload(self, op: str, **fields) -> Dict[str, Any]:
+        return {"op": op, "provider": self.name, "model": self.model, "use_cache": self.use_cache,
+                "settings": self.settings, **fields}
+
+    def _done(self, reply: Dict[str, Any]):
+        from ai_workbench.telemetry import report_usage
+        report_usage(**reply.get("usage", {}))
+        self.last_hit = bool(reply.get("cached"))
+
+    def _replies(self, payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(self.path))
+            sock.sendall(_encode(payload))
+            with sock.makefile("rb") as f:
+                for line in f:
+                    reply = _decode(line)
+                    yield reply
+                    if reply.get("done"):
+                        return
+        raise DaemonError("The daemon closed the connection")
+
+    async def _areplies(self, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        reader, writer = await asyncio.open_unix_connection(str(self.path), limit=_LINE_LIMIT)
+        try:
+            writer.write(_encode(payload))
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise DaemonError("The daemon closed the connection")
+                reply = _decode(line)
+                yield reply
+                if reply.get("done"):
+                    return
+        finally:
+            # Also how a request is cancelled
+            writer.close()
+
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response through the daemon."""
+        text = ""
+        for reply in self._replies(self._payload("generate", messages=messages, stream=False, kwargs=kwargs)):
+            if "text" in reply:
+                text = reply["text"]
+            elif reply.get("done"):
+                self._done(reply)
+        return text
+
+    def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Generate a streaming response through the daemon."""
+        for reply in self._replies(self._payload("generate", messages=messages, stream=True, kwargs=kwargs)):
+            if "chunk" in reply:
+                yield reply["chunk"]
+            elif reply.get("done"):
+                self._done(reply)
+
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response through the daemon."""
+        text = ""
+        async for reply in self._areplies(self._payload("generate", messages=messages, stream=False, kwargs=kwargs)):
+            if "text" in reply:
+                text = reply["text"]
+            elif reply.get("done"):
+                self._done(reply)
+        return text
+
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Asynchronously generate a streaming response through the daemon."""
+        replies = self._areplies(self._payload("generate", messages=messages, stream=True, kwargs=kwargs))
+        try:
+            async for reply in replies:
+                if "chunk" in reply:
+                    yield reply["chunk"]
+                elif reply.get("done"):
+                    self._done(reply)
+        finally:
+            await replies.aclose()
+
+    def continuation_messages(self, messages: List[Dict[str, str]], partial: str):
+        """Continuation messages of the provider in the daemon."""
+        return call(self.path, self._payload("continuation", messages=messages, partial=partial))["messages"]
+
+    async def aprewarm(self):
+        """Have the daemon pre-warm the provider's connection."""
+        async for _ in self._areplies(self._payload("prewarm")):
+            pass
+
+
+class _Recorder:
+    """Telemetry that keeps the metrics of one request for its reply."""
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.metrics = None
+
+    def record(self, metrics):
+        self.metrics = metrics
+        self.telemetry.record(metrics)
+
+
+class Daemon:
+    """Serves provider requests from ``ai-workbench`` clients.
+
+    Providers are built on first use, with the same layers as in the CLI
+    (retries and rate limiting, response cache), and shared by every
+    client.
+
+    Args:
+        path: Socket to listen on
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._providers: Dict[Tuple[str, str, bool], AIProvider] = {}
+        self._stop: Optional[asyncio.Event] = None
+        self._tasks = set()
+        self.started = time.time()
+        self.requests = 0
+
+    def _provider(self, request: Dict[str, Any]) -> AIProvider:
+        from ai_workbench import cli
+        from ai_workbench.config import config
+        from ai_workbench.providers import PROVIDERS
+
+        name = str(request.get("provider") or config.default_provider).lower()
+        if name not in PROVIDERS:
+            raise DaemonError(f"Unknown provider '{name}'")
+        if not config.is_configured(name):
+            raise DaemonError(f"Provider '{name}' is not configured on the daemon")
+        settings = request.get("settings") or {}
+        differing = [setting for setting, value in config.provider_settings(name).items()
+                     if settings.get(setting) != value
+                     # A client without a key of its own uses the daemon's
+                     and not (setting == "api_key" and settings.get(setting) is None)]
+        if differing:
+            raise SettingsMismatch(f"The daemon's {name} settings differ from this terminal's: {', '.join(differing)}")
+        model = request.get("model") or config.get_default_model(name)
+        key = (name, model, bool(request.get("use_cache", True)))
+        provider = self._providers.get(key)
+        if provider is None:
+            provider = self._providers[key] = cli.build_provider(name, model, key[2])
+        return provider
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                handler = getattr(self, f"_op_{request.get('op')}", None)
+                if handler is None:
+                    raise DaemonError(f"Unknown operation {request.get('op')!r}")
+                await handler(request, reader, writer)
+            except Exception as e:
+                reply = {"error": str(e) or type(e).__name__}
+                if isinstance(e, SettingsMismatch):
+                    reply["mismatch"] = True
+                writer.write(_encode(reply))
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # The client went away, or the daemon is stopping
+            pass
+        finally:
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _op_ping(self, request, reader, writer):
+        from ai_workbench import __version__
+        from ai_workbench.config import config
+        from ai_workbench.providers import PROVIDERS
+
+        writer.write(_encode({
+            "pid": os.getpid(),
+            "version": __version__,
+            "uptime": time.time() - self.started,
+            "requests": self.requests,
+            "providers": [name for name in PROVIDERS if config.is_configured(name)],
+            "loaded": [f"{name}/{model}" for name, model, _ in self._providers],
+        }))
+
+    async def _op_open(self, request, reader, writer):
+        provider = self._provider(request)
+        writer.write(_encode({"name": provider.name, "model": provider.model}))
+
+    async def _op_continuation(self, request, reader, writer):
+        provider = self._provider(request)
+        writer.write(_encode({"messages": provider.continuation_messages(request["messages"], request["partial"])}))
+
+    async def _op_prewarm(self, request, reader, writer):
+        await self._provider(request).aprewarm()
+        writer.write(_encode({"done": True}))
+
+    async def _op_shutdown(self, request, reader, writer):
+        writer.write(_encode({}))
+        self._stop.set()
+
+    async def _op_generate(self, request, reader, writer):
+        from ai_workbench.cli import get_telemetry
+        from ai_workbench.telemetry import InstrumentedProvider
+
+        recorder = _Recorder(get_telemetry())
+        provider = InstrumentedProvider(self._provider(request), recorder)
+        messages = request["messages"]
+        kwargs = request.get("kwargs") or {}
+        self.requests += 1
+
+        async def run():
+            if request.get("stream", True):
+                async for chunk in provider.agenerate_stream(messages, **kwargs):
+                    writer.write(_encode({"chunk": chunk}))
+                    await writer.drain()
+            else:
+                writer.write(_encode({"text": await provider.agenerate_response(messages, **kwargs)}))
+
+        generation = asyncio.ensure_future(run())
+        # Nothing else is sent on the connection: end of file means the
+        # client cancelled (or died)
+        closed = asyncio.ensure_future(reader.read(1))
+        try:
+            await asyncio.wait({generation, closed}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            closed.cancel()
+            if not generation.done():
+                generation.cancel()
+                await asyncio.gather(generation, return_exceptions=True)
+                return
+        generation.result()
+        metrics = recorder.metrics
+        usage = {key: getattr(metrics, key) for key in
+                 ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")}
+        writer.write(_encode({"done": True, "usage": usage, "cached": metrics.cached}))
+
+    async def serve(self):
+        """Listen until stopped by ``shutdown``, SIGINT or SIGTERM."""
+        if ping(self.path) is not None:
+            raise DaemonError(f"A daemon is already listening on {self.path}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # Left behind by a daemon that didn't exit cleanly
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        # Only the user may connect: the daemon uses their API keys
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self._handle, path=str(self.path), limit=_LINE_LIMIT)
+        finally:
+            os.umask(umask)
+
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self._stop.set)
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,283 @@
+"""Persistent prompt history shared by every REPL.
+
+Prompts are kept in an SQLite database in the data directory, one row per
+distinct prompt and project, ordered by the prompt text itself (the table
+is its own sorted index, so prefix lookups are range scans) and indexed
+by the time they were last used:
+
+- entering a prompt is a single upsert, so several terminals can write at
+  once and a repeated prompt only moves to the front
+- up-arrow and Ctrl-R page through the most recent prompts, which are
+  loaded in a background thread while the first prompt is already shown
+- auto-suggestions and ``/history`` look through the whole history of the
+  project with a query each, without loading it
+
+Prompts are scoped by project: the nearest directory above the working
+directory holding a ``.git``, ``.hg`` or ``.svn``, or the working
+directory itself. Old entries beyond the maximum are pruned, and the file
+compacted, in a background thread about once a day.
+"""
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+from prompt_toolkit.auto_suggest import AutoSuggest, Suggestion
+from prompt_toolkit.history import History, ThreadedHistory
+
+# Directories marking the root of a project
+_PROJECT_MARKERS = (".git", ".hg", ".svn")
+
+# Seconds between compactions
+_COMPACT_INTERVAL = 24 * 3600
+
+# Greater than any character that can follow a prefix, to bound prefix scans
+_MAX_CHAR = "\U0010ffff"
+
+# Fuzzy matches ranked per /history search, newest first
+_FUZZY_CANDIDATES = 5000
+
+
+def project_key(directory) -> str:
+    """The project a directory belongs to, as the path of its root."""
+    directory = Path(directory).resolve()
+    for candidate in (directory, *directory.parents):
+        if any((candidate / marker).exists() for marker in _PROJECT_MARKERS):
+            return str(candidate)
+    return str(directory)
+
+
+def _like_pattern(query: str) -> str:
+    """LIKE pattern matching the characters of ``query`` in order, with anything between."""
+    chars = ["\\" + c if c in "\\%_" else c for c in query if not c.isspace()]
+    return "%" + "%".join(chars) + "%"
+
+
+def _fuzzy_span(query: str, text: str) -> Optional[int]:
+    """Length of a tight window of ``text`` holding ``query``'s characters in order.
+
+    Case-insensitive and ignoring whitespace in ``query``; None if they
+    don't occur in order.
+    """
+    query = "".join(query.lower().split())
+    text = text.lower()
+    position = 0
+    for char in query:
+        position = text.find(char, position)
+        if position < 0:
+            return None
+        position += 1
+    end = position
+    # Walk back from the end for the latest start that still matches
+    for char in reversed(query):
+        position = text.rfind(char, 0, position)
+    return end - position
+
+
+class HistoryStore:
+    """SQLite-backed prompt history of one project.
+
+    Args:
+        path: SQLite database file, shared by all projects
+        project: Project key (see ``project_key``); "" shares one history
+            between all directories
+        max_entries: Prompts kept per project when compacting
+    """
+
+    def __init__(self, path: Path, project: str = "", max_entries: int = 200000):
+        self.path = Path(path)
+        self.project = project
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False)
+        # Must be set before the first table is created to take effect
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " project TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " used REAL NOT NULL,"
+            " count INTEGER NOT NULL DEFAULT 1,"
+            " PRIMARY KEY (project, text)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS history_used ON history (project, used)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+        return conn
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # prompt_toolkit loads and suggests from worker threads, hence the
+            # shared connection guarded by our own lock.
+            self._conn = self._open()
+        return self._conn
+
+    def add(self, text: str):
+        """Record a prompt, or move it to the front if it was entered before."""
+        text = text.rstrip()
+        if not text:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO history (project, text, used) VALUES (?, ?, ?)"
+                " ON CONFLICT (project, text) DO UPDATE SET used = excluded.used, count = count + 1",
+                (self.project, text, time.time()),
+            )
+            conn.commit()
+
+    def recent(self, limit: int) -> Iterator[str]:
+        """Yield up to ``limit`` prompts, most recently used first."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT text FROM history WHERE project = ? ORDER BY used DESC LIMIT ?",
+                (self.project, limit),
+            ).fetchall()
+        for (text,) in rows:
+            yield text
+
+    def suggest(self, prefix: str) -> Optional[str]:
+        """The most recently used prompt that extends ``prefix``."""
+        if not prefix:
+            return None
+        # "+used" keeps SQLite from walking the whole history newest first
+        # when the prefix is rare; the prefix range is scanned instead
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT text FROM history WHERE project = ? AND text > ? AND text < ?"
+                " ORDER BY +used DESC LIMIT 1",
+                (self.project, prefix, prefix + _MAX_CHAR),
+            ).fetchone()
+        return row[0] if row else None
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[str, float]]:
+        """Prompts fuzzily matching ``query``, as (text, last used).
+
+        A prompt matches when it holds the query's characters in order.
+        Tight matches come first (a substring before scattered letters),
+        then the more recently used.
+        """
+        if not query.strip():
+            return []
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT text, used FROM history WHERE project = ? AND text LIKE ? ESCAPE '\\'"
+                " ORDER BY used DESC LIMIT ?",
+                (self.project, _like_pattern(query), _FUZZY_CANDIDATES),
+            ).fetchall()
+        ranked = []
+        for text, used in rows:
+            span = _fuzzy_span(query, text)
+            if span is not None:
+                ranked.append((span, -used, text))
+        ranked.sort()
+        return [(text, -used) for _, used, text in ranked[:limit]]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM history WHERE project = ?", (self.project,)
+            ).fetchone()[0]
+
+    def compact(self):
+        """Prune every project to ``max_entries`` prompts and shrink the file.
+
+        Uses its own connection, so it can run in a thread of its own.
+        """
+        conn = self._open()
+        try:
+            projects = [row[0] for row in conn.execute("SELECT DISTINCT project FROM history")]
+            for project in projects:
+                conn.execute(
+                    "DELETE FROM history WHERE project = ? AND used < ("
+                    " SELECT used FROM history WHERE project = ? ORDER BY used DESC LIMIT 1 OFFSET ?)",
+                    (project, project, self.max_entries - 1),
+                )
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('compacted', ?)", (str(time.time()),))
+            conn.commit()
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+
+    def compact_in_background(self) -> Optional[threading.Thread]:
+        """Start compacting in a daemon thread if it is due; returns the thread."""
+        with self._lock:
+            row = self._connect().execute("SELECT value FROM meta WHERE key = 'compacted'").fetchone()
+        if row is not None and time.time() - float(row[0]) < _COMPACT_INTERVAL:
+            return None
+        thread = threading.Thread(target=self._compact_quietly, name="history-compaction", daemon=True)
+        thread.start()
+        return thread
+
+    def _compact_quietly(self):
+        try:
+            self.compact()
+        except sqlite3.Error:
+            # Another process holds the database; it is tried again next time
+            pass
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class _StoreHistory(History):
+    """prompt_toolkit history reading from and writing to a ``HistoryStore``."""
+
+    def __init__(self, store: HistoryStore, load: int):
+        super().__init__()
+        self.store = store
+        self.load_limit = load
+
+    def load_history_strings(self):
+        return self.store.recent(self.load_limit)
+
+    def store_string(self, string: str):
+        self.store.add(string)
+
+
+class PromptHistory(ThreadedHistory):
+    """History of a ``PromptSession``, backed by a ``HistoryStore``.
+
+    The ``load`` most recent prompts are read in a background thread for
+    up-arrow and Ctrl-R; a prompt entered again replaces its older copy.
+
+    Args:
+        store: The history store
+        load: Number of recent prompts to load
+    """
+
+    def __init__(self, store: HistoryStore, load: int = 10000):
+        super().__init__(_StoreHistory(store, load))
+        self.store = store
+
+    def append_string(self, string: str):
+        with self._lock:
+            # Not while loading, which reads the list by position
+            if self._loaded and string in self._loaded_strings:
+                self._loaded_strings.remove(string)
+        super().append_string(string)
+
+
+class HistorySuggest(AutoSuggest):
+    """Suggest the most recent prompt of the whole history that extends the input."""
+
+    def __init__(self, store: HistoryStore):
+        self.store = store
+
+    def get_suggestion(self, buffer, document) -> Optional[Suggestion]:
+        text = document.text
+        if not text.strip() or "\n" in text:
+            return None
+        match = self.store.suggest(text)
+        return Suggestion(match[len(text):]) if match else None
@@ -0,0 +1,293 @@
+"""Tiered storage of conversation messages.
+
+A REPL left open for days accumulates every pasted log and code answer of
+its conversation. ``MessageStore`` keeps the newest messages in memory as
+they are (hot); older ones are compressed (cold), and once the compressed
+messages outgrow their limit, the oldest are moved to a segment file read
+through a memory mapping (spilled), whose pages the OS can drop and read
+back as needed.
+
+The store is a sequence of ``Message``: indexing and slicing give the
+messages as they were added. A cold message is only decompressed when it
+is read (for the pinned turns of a request, for ``save()``), and the same
+object is returned for as long as anything (the request, a provider's
+memoized wire format) still holds it.
+
+Messages from the start of the latest request window (``request_window``)
+on are never moved down a tier, since the request and the providers hold them as they are
+anyway: compressing them would only add a copy. The hot limit applies to
+the messages before the window, and cold messages a window reaches back
+to again (a larger context window) move back up. A long request thus
+costs a list slice per turn.
+"""
+
+import mmap
+import os
+import sys
+import weakref
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+# Newest messages always kept hot, however large
+MIN_HOT = 4
+
+
+def _codec(name: str):
+    """(compress, decompress) functions of a compression by name."""
+    if name == "zlib":
+        return zlib.compress, zlib.decompress
+    if name == "lzma":
+        # Only imported when asked for; slower, but smaller for large logs
+        import lzma
+        return lzma.compress, lzma.decompress
+    raise ValueError(f"Unknown compression '{name}' (zlib or lzma)")
+
+
+class Message(dict):
+    """A conversation message.
+
+    A plain ``{"role": ..., "content": ...}`` dict, so it can be handed to
+    SDKs and serialized as is, that also records the conversation version
+    it was added at. Messages are never modified after they are added,
+    which lets providers memoize their wire format. ``__slots__`` keeps
+    the instances free of a per-object ``__dict__``; the weak reference
+    slot lets a ``MessageStore`` hand out the same object for a cold
+    message while it is in use.
+    """
+
+    __slots__ = ("version", "__weakref__")
+
+    def __init__(self, role: str, content: str, version: int = 0):
+        super().__init__(role=role, content=content)
+        self.version = version
+
+
+class _Cold:
+    """A message kept as (possibly compressed) UTF-8, in memory or in the segment file."""
+
+    __slots__ = ("role", "version", "extra", "packed", "data", "offset", "length", "size")
+
+    def __init__(self, message: Message, compress):
+        self.role = message["role"]
+        self.version = message.version
+        # Keys besides role and content that a saved file brought along
+        self.extra = {k: v for k, v in message.items() if k not in ("role", "content")} or None
+        content = message["content"]
+        self.size = sys.getsizeof(content)
+        # Lone surrogates (from JSON files) must survive the round trip
+        raw = content.encode("utf-8", "surrogatepass")
+        packed = compress(raw)
+        self.packed = len(packed) < len(raw)
+        self.data: Optional[bytes] = packed if self.packed else raw
+        self.offset = self.length = 0
+
+
+class MessageStore:
+    """Sequence of conversation messages, held in tiers by age.
+
+    Args:
+        hot_bytes: Content of the newest messages kept as they are, besides
+            the latest request window; older messages are compressed
+        cold_bytes: Compressed messages kept in memory; beyond it, the
+            oldest go to the segment file
+        compression: "zlib" or "lzma"
+        spill_dir: Directory of the (unnamed, deleted on exit) segment
+            file; the system's temporary directory if not given
+    """
+
+    def __init__(self, hot_bytes: int = 512 * 1024, cold_bytes: int = 16 * 1024 * 1024,
+                 compression: str = "zlib", spill_dir: Optional[Path] = None):
+        self.hot_bytes = hot_bytes
+        self.cold_bytes = cold_bytes
+        self.compression = compression
+        self._compress, self._decompress = _codec(compression)
+        self.spill_dir = spill_dir
+        # Cold entries first: entries[:first_hot] are _Cold, the rest Message;
+        # of the cold ones, entries[:first_in_memory] are spilled
+        self._entries: List[Union[Message, _Cold]] = []
+        self._first_hot = 0
+        self._first_in_memory = 0
+        self._hot_size = 0
+        self._cold_size = 0
+        # Cold messages handed out and still referenced, by version
+        self._loaded = weakref.WeakValueDictionary()
+        # Start of the latest request window (a slice to the end), before
+        # which messages may be demoted; None before the first request
+        self._window_start: Optional[int] = None
+        self._segment = None
+        self._segment_size = 0
+        self._map: Optional[mmap.mmap] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[Message]:
+        for i in range(len(self._entries)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._entries))
+            if step == 1 and (start >= self._first_hot or stop <= start):
+                # All hot: no per-message work
+                return self._entries[start:stop]
+            if step != 1:
+                return [self._get(i) for i in range(start, stop, step)]
+            cold = [self._get(i) for i in range(start, min(stop, self._first_hot))]
+            return cold + self._entries[self._first_hot:stop]
+        return self._get(index)
+
+    def request_window(self, start: int) -> List[Message]:
+        """``self[start:]``, sent as the history of a request.
+
+        Messages from ``start`` on stay hot from now on (cold ones are
+        promoted), and the ones before it may be demoted.
+        """
+        start = min(start, len(self._entries))
+        window = self[start:]
+        self._window_start = start
+        if start < self._first_hot:
+            self._promote(start, window[:self._first_hot - start])
+        self._demote()
+        return window
+
+    def _promote(self, start: int, messages: List[Message]):
+        """Make the cold ``entries[start:first_hot]`` (read as ``messages``) hot again."""
+        for entry in self._entries[start:self._first_hot]:
+            # Spilled bytes stay in the segment file until clear()
+            if entry.data is not None:
+                self._cold_size -= len(entry.data)
+        self._entries[start:self._first_hot] = messages
+        self._hot_size += sum(sys.getsizeof(message["content"]) for message in messages)
+        self._first_hot = start
+        self._first_in_memory = min(self._first_in_memory, start)
+
+    def _get(self, index: int) -> Message:
+        entry = self._entries[index]
+        if type(entry) is not _Cold:
+            return entry
+        message = self._loaded.get(entry.version)
+        if message is None:
+            data = entry.data if entry.data is not None else self._read(entry.offset, entry.length)
+            raw = self._decompress(data) if entry.packed else data
+            message = Message(entry.role, str(raw, "utf-8", "surrogatepass"), entry.version)
+            if entry.extra:
+                message.update(entry.extra)
+            self._loaded[entry.version] = message
+        return message
+
+    def append(self, message: Message):
+        """Add the newest message, moving older ones down a tier as needed."""
+        self._entries.append(message)
+        self._hot_size += sys.getsizeof(message["content"])
+        self._demote()
+
+    def pop(self) -> Message:
+        """Remove and return the newest message."""
+        message = self._get(-1)
+        entry = self._entries.pop()
+        n = len(self._entries)
+        if type(entry) is _Cold:
+            if entry.data is not None:
+                self._cold_size -= len(entry.data)
+            # Spilled bytes stay in the segment file until clear()
+            self._first_hot = n
+            self._first_in_memory = min(self._first_in_memory, n)
+        else:
+            self._hot_size -= sys.getsizeof(entry["content"])
+        return message
+
+    def clear(self):
+        """Remove every message and drop the segment file."""
+        self._entries = []
+        self._first_hot = self._first_in_memory = 0
+        self._hot_size = self._cold_size = 0
+        self._loaded = weakref.WeakValueDictionary()
+        self._window_start = None
+        self.close()
+
+    def _demote(self):
+        # The newest MIN_HOT, and the latest request window
+        end = len(self._entries) - MIN_HOT
+        if self._window_start is not None:
+            end = min(end, self._window_start)
+        while self._hot_size > self.hot_bytes and self._first_hot < end:
+            message = self._entries[self._first_hot]
+            cold = _Cold(message, self._compress)
+            self._entries[self._first_hot] = cold
+            # Whoever holds the message (the last request) keeps getting it
+            self._loaded[message.version] = message
+            self._hot_size -= sys.getsizeof(message["content"])
+            self._cold_size += len(cold.data)
+            self._first_hot += 1
+        if self._cold_size > self.cold_bytes:
+            self._spill()
+
+    def _spill(self):
+        """Move the oldest compressed messages to the segment file, in one write."""
+        if self._segment is None:
+            import tempfile
+            if self.spill_dir is not None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._segment = tempfile.TemporaryFile(prefix="awb-messages-", dir=self.spill_dir)
+        chunks = []
+        # Down to half the limit, so spilling doesn't happen on every turn
+        while self._cold_size > self.cold_bytes // 2 and self._first_in_memory < self._first_hot:
+            entry = self._entries[self._first_in_memory]
+            entry.offset, entry.length = self._segment_size + sum(map(len, chunks)), len(entry.data)
+            chunks.append(entry.data)
+            self._cold_size -= entry.length
+            entry.data = None
+            self._first_in_memory += 1
+        self._segment.seek(self._segment_size)
+        self._segment.write(b"".join(chunks))
+        self._segment.flush()
+        self._segment_size += sum(map(len, chunks))
+
+    def _read(self, offset: int, length: int) -> bytes:
+        if self._map is None or len(self._map) < offset + length:
+            # The file has grown since it was mapped
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._segment.fileno(), self._segment_size, access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length]
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Messages and bytes per tier.
+
+        ``bytes`` is the memory (or, when spilled, disk) the tier takes;
+        ``content`` is the memory its messages take once decompressed.
+        ``loaded`` are cold messages that were decompressed and are still
+        referenced, typically by the last request.
+        """
+        tiers = {name: {"messages": 0, "bytes": 0, "content": 0}
+                 for name in ("hot", "compressed", "spilled", "loaded")}
+        for entry in self._entries[:self._first_hot]:
+            tier = tiers["compressed" if entry.data is not None else "spilled"]
+            tier["messages"] += 1
+            tier["bytes"] += sys.getsizeof(entry.data) + sys.getsizeof(entry) if entry.data is not None else entry.length
+            tier["content"] += entry.size
+        for message in self._entries[self._first_hot:]:
+            tiers["hot"]["messages"] += 1
+            tiers["hot"]["bytes"] += sys.getsizeof(message) + sys.getsizeof(message["content"])
+            tiers["hot"]["content"] += sys.getsizeof(message["content"])
+        newest_cold = self._entries[self._first_hot - 1].version if self._first_hot else -1
+        for message in list(self._loaded.values()):
+            if message.version > newest_cold:
+                # Still hot, or popped
+                continue
+            tiers["loaded"]["messages"] += 1
+            tiers["loaded"]["bytes"] += sys.getsizeof(message) + sys.getsizeof(message["content"])
+            tiers["loaded"]["content"] += sys.getsizeof(message["content"])
+        return tiers
+
+    def close(self):
+        """Release the segment file (spilled messages can't be read after this)."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        self._segment_size = 0
@@ -0,0 +1,140 @@
+"""Non-interactive output for ``ai-workbench ask`` in shell pipelines.
+
+Replies are written to standard output as raw text, chunk by chunk as
+they arrive, without Rich, Markdown rendering or Python's buffered text
+layer. Pipes, sockets and terminals are written through an asyncio pipe
+transport: when the reader falls behind (``| less``), writing waits for
+it to catch up, so the reply stream is paused instead of piling up in
+memory. Regular files are written to directly.
+"""
+
+import asyncio
+import os
+import stat
+from typing import Dict, List, Optional, Sequence, TextIO
+
+# Bytes buffered for a slow reader before the reply stream is paused
+HIGH_WATER = 64 * 1024
+
+
+def read_prompt(args: Sequence[str], stdin: TextIO) -> Optional[str]:
+    """The prompt from the command line arguments and piped-in standard input.
+
+    With both, the arguments come first, as the instruction, followed by
+    the input (``git diff | ai-workbench ask "review this"``). Returns None
+    if there is neither.
+    """
+    parts = []
+    if args:
+        parts.append(" ".join(args))
+    if not stdin.isatty():
+        # Undecodable bytes (binary files in a diff) must not abort the request
+        data = stdin.buffer.read().decode("utf-8", "replace")
+        if data.strip():
+            parts.append(data)
+    return "\n\n".join(parts) or None
+
+
+class _FlowControl(asyncio.Protocol):
+    """Pauses writing while the transport's buffer is above its high-water mark."""
+
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = asyncio.Event()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def connection_lost(self, exc: Optional[BaseException]):
+        self.writable.set()
+        self.closed.set()
+
+
+class RawWriter:
+    """Unbuffered writer of text to a file descriptor, with backpressure.
+
+    ``write`` raises BrokenPipeError once the reader has gone away
+    (``| head``).
+
+    Args:
+        fd: File descriptor to write to
+    """
+
+    def __init__(self, fd: int = 1):
+        self.fd = fd
+        self._transport: Optional[asyncio.WriteTransport] = None
+        self._flow: Optional[_FlowControl] = None
+        self._blocking = True
+
+    async def open(self):
+        """Set up the pipe transport if ``fd`` is a pipe, socket or terminal."""
+        mode = os.fstat(self.fd).st_mode
+        if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stat.S_ISCHR(mode)):
+            return
+        self._blocking = os.get_blocking(self.fd)
+        loop = asyncio.get_running_loop()
+        pipe = os.fdopen(os.dup(self.fd), "wb", buffering=0)
+        self._transport, self._flow = await loop.connect_write_pipe(_FlowControl, pipe)
+        self._transport.set_write_buffer_limits(high=HIGH_WATER)
+
+    async def write(self, text: str):
+        """Write ``text``, waiting while the reader is behind."""
+        data = text.encode("utf-8", "replace")
+        if self._transport is None:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            return
+        if self._transport.is_closing():
+            raise BrokenPipeError("The reader closed the pipe")
+        self._transport.write(data)
+        await self._flow.writable.wait()
+        if self._transport.is_closing():
+            raise BrokenPipeError("The reader closed the pipe")
+
+    async def close(self):
+        """Wait until everything is written, then release the pipe."""
+        if self._transport is None:
+            return
+        self._transport.close()
+        await self._flow.closed.wait()
+        # The transport made the (shared) file description non-blocking
+        try:
+            os.set_blocking(self.fd, self._blocking)
+        except OSError:
+            pass
+
+
+async def write_reply(provider, messages: List[Dict[str, str]], no_stream: bool = False, fd: int = 1):
+    """Generate a reply and write it to ``fd`` as raw text, as it arrives.
+
+    A newline is added if the reply doesn't end with one, as shell tools
+    expect.
+    """
+    writer = RawWriter(fd)
+    await writer.open()
+    last = "\n"
+    try:
+        if no_stream:
+            text = await provider.agenerate_response(messages)
+            if text:
+                await writer.write(text)
+                last = text[-1]
+        else:
+            stream = provider.agenerate_stream(messages)
+            try:
+                async for chunk in stream:
+                    if chunk:
+                        await writer.write(chunk)
+                        last = chunk[-1]
+            finally:
+                # Also stops the upstream request when the reader has gone
+                await stream.aclose()
+        if last != "\n":
+            await writer.write("\n")
+    finally:
+        await writer.close()
@@ -1,15 +1,220 @@
 """Base provider interface for AI providers."""
 
+import asyncio
+import bisect
+import contextvars
+import functools
+import importlib
+import threading
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any
+from typing import AsyncIterator, Callable, Iterator, List, Dict, Any, Optional, Tuple
 
 
+# Provider name -> (module, class). Modules are imported on first use so that
+# only the vendor SDK of the provider actually selected is ever loaded.
+PROVIDERS = {
+    "openai": ("ai_workbench.providers.openai_provider", "OpenAIProvider"),
+    "anthropic": ("ai_workbench.providers.anthropic_provider", "AnthropicProvider"),
+    "google": ("ai_workbench.providers.google_provider", "GoogleProvider"),
+}
+
+
+def get_provider_class(name: str):
+    """Import and return the provider class registered under ``name``.
+    
+    Returns None if no provider with that name is registered.
+    """
+    entry = PROVIDERS.get(name)
+    if entry is None:
+        return None
+    module_name, class_name = entry
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)
+
+
+async def iterate_in_thread(make_iterator: Callable[[], Iterator[Any]],
+                            cancel: Optional[Callable[[], None]] = None) -> AsyncIterator[Any]:
+    """Drive a blocking iterator in a worker thread and yield its items asynchronously.
+    
+    The iterator is created and consumed in the worker thread. If the consumer
+    stops early, the worker stops after the item it is currently waiting for
+    and closes the iterator; ``cancel``, if given, is called from the
+    consumer's side right away to end that wait (e.g. by closing the HTTP
+    response the worker reads from).
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+    
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # Event loop already closed; nobody is listening any more
+            pass
+    
+    def pump():
+        iterator = None
+        try:
+            iterator = make_iterator()
+            for item in iterator:
+                if stop.is_set():
+                    break
+                put((item, None))
+        except BaseException as exc:
+            put((done, exc))
+            return
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        put((done, None))
+    
+    # Run in a copy of the caller's context so per-request state (telemetry)
+    # is visible to the provider in the worker thread
+    loop.run_in_executor(None, contextvars.copy_context().run, pump)
+    finished = False
+    try:
+        while True:
+            item, exc = await queue.get()
+            if item is done:
+                finished = True
+                if exc is not None:
+                    raise exc
+                break
+            yield item
+    finally:
+        stop.set()
+        if not finished and cancel is not None:
+            cancel()
+
+
+class IncrementalFormatter:
+    """Memoized conversion of message lists to a provider's wire format.
+    
+    Conversation messages carry a rising ``version`` stamp and are never
+    modified after they are added, so the wire form of one can be reused by
+    every later request that sends the same object. The formatter keeps the
+    stamped messages of the previous request (up to the first one without
+    a stamp: a prompt with retrieved code added, a prefilled reply) with
+    their wire forms, and only converts the messages of a request that are
+    not among them.
+    
+    A request is the pinned turns plus a run of its conversation, so it
+    shares a beginning with the previous request and may then pick it up
+    again further on, after the messages a moved context window dropped.
+    Two runs with the same first and last message at the same distance are
+    the same run, so each is found with O(1) identity checks: the shared
+    beginning by binary search, the point where the previous request is
+    picked up again by bisecting the stamps. Converting is thus O(new
+    messages + log n) per turn. The list returned is still a copy of the
+    whole request (as is dropping messages from the middle), a C-level
+    pointer copy that is small next to serializing the request, which is
+    O(messages) anyway.
+    
+    System messages are not converted; the content of the last one is
+    returned separately, since every provider takes it apart from the
+    history.
+    
+    Args:
+        convert: Maps a non-system message to its wire form
+    """
+    
+    def __init__(self, convert: Callable[[Dict[str, str]], Any]):
+        self.convert = convert
+        # Memoized messages, their wire forms and their stamps (for bisect)
+        self._source: List[Dict[str, str]] = []
+        self._wire: List[Any] = []
+        self._versions: List[int] = []
+        self._lock = threading.Lock()
+    
+    def _same(self, messages: List[Dict[str, str]], start: int, position: int, count: int) -> bool:
+        """Whether ``messages[start:start + count]`` are the memoized messages from ``position``."""
+        return (messages[start] is self._source[position]
+                and messages[start + count - 1] is self._source[position + count - 1])
+    
+    def _reuse(self, messages: List[Dict[str, str]], start: int) -> int:
+        """Keep the memoized messages ``messages[start:]`` begins with; return how many there are."""
+        count = min(len(messages) - start, len(self._source))
+        shared = 0
+        if count and self._same(messages, start, 0, count):
+            shared = count
+        elif count:
+            # Longest shared beginning: 0 <= shared < high
+            high = count
+            while high - shared > 1:
+                middle = (shared + high) // 2
+                if self._same(messages, start, 0, middle):
+                    shared = middle
+                else:
+                    high = middle
+            resume = self._resume(messages, start + shared, shared)
+            if resume is not None:
+                # Drop what the request skips; it continues through the rest
+                del self._source[shared:resume], self._wire[shared:resume], self._versions[shared:resume]
+                return len(self._source)
+        del self._source[shared:], self._wire[shared:], self._versions[shared:]
+        return shared
+    
+    def _resume(self, messages: List[Dict[str, str]], index: int, low: int) -> Optional[int]:
+        """Position from which the memoized messages, to the last, go on at ``messages[index]``."""
+        if index >= len(messages):
+            return None
+        version = getattr(messages[index], "version", None)
+        if version is None:
+            return None
+        position = bisect.bisect_left(self._versions, version, low)
+        count = len(self._source) - position
+        if position == len(self._source) or len(messages) - index < count:
+            return None
+        return position if self._same(messages, index, position, count) else None
+    
+    def format(self, messages: List[Dict[str, str]]) -> Tuple[Optional[str], List[Any]]:
+        """Return ``(system content or None, wire messages)`` for ``messages``.
+        
+        A new list is returned every time, which the caller may modify.
+        """
+        with self._lock:
+            system = None
+            start = 0
+            if messages and messages[0]["role"] == "system":
+                system = messages[0]["content"]
+                start = 1
+            memoize = True
+            tail: List[Any] = []
+            for msg in messages[start + self._reuse(messages, start):]:
+                if msg["role"] == "system":
+                    system = msg["content"]
+                    # The memoized messages have to line up with the request's
+                    memoize = False
+                    continue
+                wire = self.convert(msg)
+                version = getattr(msg, "version", None)
+                memoize = memoize and version is not None
+                if memoize:
+                    self._source.append(msg)
+                    self._wire.append(wire)
+                    self._versions.append(version)
+                else:
+                    tail.append(wire)
+            return system, self._wire + tail
+    
+
 class AIProvider(ABC):
     """Abstract base class for AI providers."""
     
-    def __init__(self, api_key: str, model: str = None):
+    # Registry name of the provider, e.g. "openai"
+    name: str = None
+    
+    def __init__(self, api_key: str, model: str = None, base_url: str = None, prompt_cache: bool = True):
         self.api_key = api_key
         self.model = model
+        # Alternative API endpoint (proxy, gateway or local stand-in server)
+        self.base_url = base_url
+        # Lay requests out for the provider's prompt caching (cache
+        # breakpoints, stable prefixes, cached contents)
+        self.prompt_cache = prompt_cache
     
     @abstractmethod
     def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
@@ -36,3 +241,85 @@ class AIProvider(ABC):
             Response chunks as they arrive
         """
         pass
+    
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response from the AI model.
+        
+        The default implementation runs ``generate_response`` in a worker
+        thread; providers whose SDK has an async client override this.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, contextvars.copy_context().run, functools.partial(self.generate_response, messages, **kwargs)
+        )
+    
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        """Asynchronously generate a streaming response from the AI model.
+        
+        The default implementation drives ``generate_stream`` in a worker
+        thread; providers whose SDK has an async client override this.
+        """
+        async for chunk in iterate_in_thread(lambda: self.generate_stream(messages, **kwargs)):
+            yield chunk
+    
+    def continuation_messages(self, messages: List[Dict[str, str]], partial: str):
+        """Messages asking the model to continue a partial reply.
+        
+        Used to resume a stream that broke off after ``partial`` was
+        received. Returns None if the provider cannot continue a reply,
+        which is the default.
+        """
+        return None
+    
+    async def aprewarm(self):
+        """Open a connection to the API ahead of the first request.
+        
+        Called in the background while the user is still typing. The default
+        implementation does nothing.
+        """
+        pass
+
+
+class ProviderWrapper(AIProvider):
+    """Base class for layers that add behaviour around another provider.
+    
+    Subclasses override the ``generate_*`` methods they care about; anything
+    else (``model``, ``api_key``, provider-specific attributes) is forwarded
+    to the wrapped provider.
+    """
+    
+    def __init__(self, provider: AIProvider):
+        self.provider = provider
+    
+    @property
+    def name(self) -> str:
+        return self.provider.name
+    
+    def __getattr__(self, name: str) -> Any:
+        if name == "provider":
+            raise AttributeError(name)
+        return getattr(self.provider, name)
+    
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response through the wrapped provider."""
+        return self.provider.generate_response(messages, **kwargs)
+    
+    def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Generate a streaming response through the wrapped provider."""
+        return self.provider.generate_stream(messages, **kwargs)
+    
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response through the wrapped provider."""
+        return await self.provider.agenerate_response(messages, **kwargs)
+    
+    def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        """Asynchronously generate a streaming response through the wrapped provider."""
+        return self.provider.agenerate_stream(messages, **kwargs)
+    
+    def continuation_messages(self, messages: List[Dict[str, str]], partial: str):
+        """Continuation messages of the wrapped provider."""
+        return self.provider.continuation_messages(messages, partial)
+    
+    async def aprewarm(self):
+        """Pre-warm the wrapped provider."""
+        await self.provider.aprewarm()
@@ -1,58 +1,160 @@
 """Anthropic Claude provider implementation."""
 
-from typing import List, Dict
-from anthropic import Anthropic
-from ai_workbench.providers import AIProvider
+from typing import Any, List, Dict, Tuple, Union
+from anthropic import Anthropic, AsyncAnthropic, DefaultAsyncHttpxClient, DefaultHttpxClient
+from ai_workbench.providers import AIProvider, IncrementalFormatter
+from ai_workbench.providers.pool import client_pool, get_http_client, prewarm_connection
+from ai_workbench.telemetry import report_usage
+
+# Cache breakpoint: the prompt up to and including the marked block is cached
+CACHE_CONTROL = {"type": "ephemeral"}
 
 
 class AnthropicProvider(AIProvider):
     """Anthropic Claude API provider."""
     
+    name = "anthropic"
+    
     DEFAULT_SYSTEM_MESSAGE = "You are a helpful coding assistant."
     
-    def __init__(self, api_key: str, model: str = "claude-3-5-sonnet-20241022"):
-        super().__init__(api_key, model)
-        self.client = Anthropic(api_key=api_key)
+    def __init__(self, api_key: str, model: str = "claude-3-5-sonnet-20241022", base_url: str = None,
+                 prompt_cache: bool = True):
+        super().__init__(api_key, model, base_url, prompt_cache)
+        # Clients are shared across provider instances with the same key, so
+        # switching models keeps the warm connection pool.
+        self.client = client_pool.get(
+            ("anthropic", api_key, base_url),
+            # Retries are done by ResilientProvider, which shares rate limits
+            # and resumes streams
+            lambda: Anthropic(api_key=api_key, base_url=base_url, max_retries=0,
+                           http_client=get_http_client("anthropic", api_key, DefaultHttpxClient)),
+        )
+        # Wire-format view of the history, extended as the conversation grows
+        self._formatter = IncrementalFormatter(lambda msg: {"role": msg["role"], "content": msg["content"]})
     
-    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
-        """Generate a response using Anthropic API."""
-        # Extract system message if present
-        system_message = None
-        formatted_messages = []
+    @property
+    def _async_http_client(self) -> DefaultAsyncHttpxClient:
+        return get_http_client("anthropic", self.api_key, DefaultAsyncHttpxClient)
+    
+    @property
+    def async_client(self) -> AsyncAnthropic:
+        """Pooled async client, created on first use."""
+        return client_pool.get(
+            ("anthropic", self.api_key, self.base_url, "async"),
+            lambda: AsyncAnthropic(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                   http_client=self._async_http_client),
+        )
+    
+    async def aprewarm(self):
+        """Open a connection to the API host on the pooled async client."""
+        await prewarm_connection(self._async_http_client, str(self.async_client.base_url))
+    
+    def _split_system(self, messages: List[Dict[str, str]]) -> Tuple[str, List[Dict[str, str]]]:
+        """Extract the system message, which Anthropic takes as a separate parameter.
         
-        for msg in messages:
-            if msg["role"] == "system":
-                system_message = msg["content"]
-            else:
-                formatted_messages.append(msg)
+        Memoized: when the request continues the previous one, only the
+        messages added since are converted.
+        """
+        system_message, formatted_messages = self._formatter.format(messages)
+        return system_message if system_message else self.DEFAULT_SYSTEM_MESSAGE, formatted_messages
+    
+    @staticmethod
+    def _cached(message: Dict[str, str]) -> Dict[str, Any]:
+        """``message`` as a text block carrying a cache breakpoint."""
+        return {"role": message["role"],
+                "content": [{"type": "text", "text": message["content"], "cache_control": CACHE_CONTROL}]}
+    
+    def _prepare(self, messages: List[Dict[str, str]]) -> Tuple[Union[str, List[Dict[str, Any]]], List[Dict[str, Any]]]:
+        """System prompt and messages of a request, with cache breakpoints.
+        
+        Breakpoints go on the system prompt, on the newest message (so the
+        next turn can read the whole history from the cache) and on the
+        previous turn's prompt (so this turn reads what the last one
+        wrote). Three of the four breakpoints the API allows are used;
+        prompts below the model's minimum cacheable length are simply not
+        cached.
+        """
+        system_message, formatted_messages = self._split_system(messages)
+        if not self.prompt_cache:
+            return system_message, formatted_messages
+        system = [{"type": "text", "text": system_message, "cache_control": CACHE_CONTROL}]
+        if not formatted_messages:
+            return system, formatted_messages
+        # The list is this request's own, but its messages are shared with
+        # later requests, so the marked ones are copies
+        last = len(formatted_messages) - 1
+        formatted_messages[last] = self._cached(formatted_messages[last])
+        for i in range(last - 1, -1, -1):
+            if formatted_messages[i]["role"] == "user":
+                formatted_messages[i] = self._cached(formatted_messages[i])
+                break
+        return system, formatted_messages
+    
+    @staticmethod
+    def _report_usage(usage):
+        # input_tokens only counts the uncached part of the prompt
+        read = getattr(usage, "cache_read_input_tokens", None) or 0
+        written = getattr(usage, "cache_creation_input_tokens", None) or 0
+        report_usage(usage.input_tokens + read + written, usage.output_tokens,
+                     cache_read_tokens=read, cache_write_tokens=written)
+    
+    def continuation_messages(self, messages: List[Dict[str, str]], partial: str) -> List[Dict[str, str]]:
+        """Continue a partial reply by prefilling it as the assistant's turn.
         
+        The API rejects a prefill ending in whitespace, so it is trimmed.
+        """
+        return messages + [{"role": "assistant", "content": partial.rstrip()}]
+    
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response using Anthropic API."""
+        system_message, formatted_messages = self._prepare(messages)
         response = self.client.messages.create(
             model=self.model,
             max_tokens=4096,
-            system=system_message if system_message else self.DEFAULT_SYSTEM_MESSAGE,
+            system=system_message,
             messages=formatted_messages,
             **kwargs
         )
+        self._report_usage(response.usage)
         return response.content[0].text
     
     def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
         """Generate a streaming response using Anthropic API."""
-        # Extract system message if present
-        system_message = None
-        formatted_messages = []
-        
-        for msg in messages:
-            if msg["role"] == "system":
-                system_message = msg["content"]
-            else:
-                formatted_messages.append(msg)
-        
+        system_message, formatted_messages = self._prepare(messages)
         with self.client.messages.stream(
             model=self.model,
             max_tokens=4096,
-            system=system_message if system_message else self.DEFAULT_SYSTEM_MESSAGE,
+            system=system_message,
             messages=formatted_messages,
             **kwargs
         ) as stream:
             for text in stream.text_stream:
                 yield text
+            self._report_usage(stream.get_final_message().usage)
+    
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response using Anthropic API."""
+        system_message, formatted_messages = self._prepare(messages)
+        response = await self.async_client.messages.create(
+            model=self.model,
+            max_tokens=4096,
+            system=system_message,
+            messages=formatted_messages,
+            **kwargs
+        )
+        self._report_usage(response.usage)
+        return response.content[0].text
+    
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Asynchronously generate a streaming response using Anthropic API."""
+        system_message, formatted_messages = self._prepare(messages)
+        async with self.async_client.messages.stream(
+            model=self.model,
+            max_tokens=4096,
+            system=system_message,
+            messages=formatted_messages,
+            **kwargs
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            self._report_usage((await stream.get_final_message()).usage)
@@ -1,64 +1,326 @@
 """Google Gemini provider implementation."""
 
-from typing import List, Dict
+import asyncio
+import datetime
+import hashlib
+import threading
+import time
+from typing import Any, AsyncIterator, List, Dict, Optional, Tuple
 import google.generativeai as genai
-from ai_workbench.providers import AIProvider
+from ai_workbench.cassettes import get_store
+from ai_workbench.providers import AIProvider, IncrementalFormatter, iterate_in_thread
+from ai_workbench.telemetry import report_usage
+
+
+# Models without system instructions; the system message is prepended to
+# the prompt for them instead
+LEGACY_MODELS = ("gemini-pro", "gemini-1.0")
+
+# Key, endpoint and cassette store the SDK's global client is configured
+# for; a provider with other ones reconfigures it before its requests
+_configured: Optional[Tuple[Any, ...]] = None
+_configure_lock = threading.Lock()
 
 
 class GoogleProvider(AIProvider):
-    """Google Gemini API provider."""
+    """Google Gemini API provider.
     
-    def __init__(self, api_key: str, model: str = "gemini-2.0-flash-exp"):
-        super().__init__(api_key, model)
-        genai.configure(api_key=api_key)
-        self.model_instance = genai.GenerativeModel(model)
+    Streams are read through the SDK's asyncio client with its default
+    gRPC transport (see ``agenerate_stream``); otherwise the async methods
+    fall back to the thread-offloading defaults of ``AIProvider``.
     
-    def _format_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
-        """Format messages for Gemini API."""
-        formatted = []
-        for msg in messages:
-            role = msg["role"]
-            # Map roles for Gemini
-            if role == "system":
-                # Prepend system message to first user message
-                continue
-            elif role == "assistant":
-                role = "model"
-            formatted.append({"role": role, "parts": [msg["content"]]})
-        return formatted
+    Args:
+        cache_min_tokens: With prompt caching on, store the system
+            instruction and the first exchange (the pinned context, e.g. a
+            pasted file) as Gemini cached content once they reach this many
+            tokens; 0 never creates cached content
+        cache_ttl: Seconds a cached content lives
+    """
     
-    def _prepare_chat(self, messages: List[Dict[str, str]]):
-        """Prepare chat with history and return chat instance and final message."""
-        # Extract system message if present
-        system_message = None
-        formatted_messages = []
+    name = "google"
+    
+    def __init__(self, api_key: str, model: str = "gemini-2.0-flash-exp", base_url: str = None,
+                 prompt_cache: bool = True, cache_min_tokens: int = 0, cache_ttl: float = 3600):
+        super().__init__(api_key, model, base_url, prompt_cache)
+        self.cache_min_tokens = cache_min_tokens
+        self.cache_ttl = cache_ttl
+        self._configure()
+        self.model_instance = genai.GenerativeModel(model)
+        self._system_model = None
+        # Wire-format view of the history, extended as the conversation grows
+        self._formatter = IncrementalFormatter(self._format_message)
+        # Persistent chat session and the request messages (plus reply) its
+        # history holds
+        self._chat = None
+        self._chat_model = None
+        self._chat_source: List[Dict[str, str]] = []
+        self._chat_lock = threading.Lock()
+        # Cached content of the pinned context: the (system, messages) it was
+        # made from, the model using it (None if it could not be created) and
+        # its expiry. Replaced contents are left to expire on the server.
+        self._pinned: Optional[Tuple[Tuple[Any, ...], Any, float]] = None
+        # Size of newly created cached content, until it is reported once
+        self._pinned_written: Optional[int] = None
+    
+    def _configure(self):
+        """Point the SDK's global client at this provider's key and endpoint.
         
-        for msg in messages:
-            if msg["role"] == "system":
-                system_message = msg["content"]
+        The SDK keeps one client per process, which models pick up on
+        their first request, so it is reconfigured whenever another key or
+        endpoint was configured since (switching providers A, B, then A
+        again). Recording and replaying cassettes needs the REST transport,
+        whose HTTP session the cassette store is mounted on.
+        """
+        global _configured
+        store = get_store()
+        with _configure_lock:
+            if _configured == (self.api_key, self.base_url, store):
+                return
+            if self._rest:
+                genai.configure(api_key=self.api_key, transport="rest",
+                                client_options={"api_endpoint": self.base_url} if self.base_url else None)
             else:
-                formatted_messages.append(msg)
+                genai.configure(api_key=self.api_key)
+            if store is not None:
+                from google.generativeai import client
+                for get_client in (client.get_default_generative_client, client.get_default_cache_client):
+                    store.mount(get_client()._transport._session)
+            _configured = (self.api_key, self.base_url, store)
+    
+    @property
+    def _rest(self) -> bool:
+        """Whether the SDK uses its REST transport, which has no asyncio client."""
+        return bool(self.base_url) or get_store() is not None
+    
+    @staticmethod
+    def _format_message(msg: Dict[str, str]) -> Dict[str, Any]:
+        """Format one message for Gemini API."""
+        # Map roles for Gemini
+        role = "model" if msg["role"] == "assistant" else msg["role"]
+        return {"role": role, "parts": [msg["content"]]}
+    
+    def _format_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """Format messages for Gemini API, leaving out system messages."""
+        return self._formatter.format(messages)[1]
+    
+    def _model_for(self, system_message: Optional[str]):
+        """Model instance carrying ``system_message`` as its system instruction."""
+        if not system_message or self.model.startswith(LEGACY_MODELS):
+            return self.model_instance
+        if self._system_model is None or self._system_model[0] != system_message:
+            self._system_model = (system_message, genai.GenerativeModel(self.model, system_instruction=system_message))
+        return self._system_model[1]
+    
+    def _pinned_count(self, formatted: List[Dict[str, Any]]) -> int:
+        """Number of leading messages stored in cached content (0 for none)."""
+        if not self.prompt_cache or not self.cache_min_tokens or len(formatted) < 3:
+            return 0
+        # The first exchange, as pinned by the context window, when there
+        # is history after it
+        return 2 if formatted[0]["role"] == "user" and formatted[1]["role"] == "model" else 0
+    
+    def _cached_model(self, system_message: Optional[str], pinned: List[Dict[str, Any]]):
+        """Model reading ``system_message`` and ``pinned`` from cached content.
         
-        # Create chat with history
-        chat = self.model_instance.start_chat(history=self._format_messages(formatted_messages[:-1]))
+        Returns None when they are below ``cache_min_tokens`` or the cached
+        content cannot be created (e.g. the model does not support it).
+        """
+        key = (system_message,) + tuple(pinned)
+        entry = self._pinned
+        # The formatter hands out the same message objects every turn
+        if entry is not None and len(entry[0]) == len(key) and all(a is b for a, b in zip(entry[0], key)):
+            if entry[1] is None or time.time() < entry[2]:
+                return entry[1]
         
-        # Prepare the last message
-        message_content = formatted_messages[-1]["content"]
-        if system_message:
-            message_content = f"{system_message}\n\n{message_content}"
+        from ai_workbench.tokens import get_estimator
+        estimator = get_estimator(self.name, self.model)
+        tokens = estimator.count(system_message or "") + sum(estimator.count(msg["parts"][0]) for msg in pinned)
+        model = None
+        if tokens >= self.cache_min_tokens:
+            digest = hashlib.sha256(repr((self.model,) + key).encode("utf-8")).hexdigest()[:16]
+            try:
+                cached = genai.caching.CachedContent.create(
+                    model=self.model,
+                    display_name=f"ai-workbench-{digest}",
+                    system_instruction=system_message or None,
+                    contents=pinned,
+                    ttl=datetime.timedelta(seconds=self.cache_ttl),
+                )
+                model = genai.GenerativeModel.from_cached_content(cached)
+                usage = getattr(cached, "usage_metadata", None)
+                self._pinned_written = getattr(usage, "total_token_count", None) or tokens
+            except Exception:
+                model = None
+        # Renew a little before the server drops it
+        self._pinned = (key, model, time.time() + self.cache_ttl - 60)
+        return model
+    
+    def _chat_setup(self, system_message: Optional[str], formatted: List[Dict[str, Any]]):
+        """Model and history to start a chat for ``formatted`` with."""
+        count = self._pinned_count(formatted)
+        if count:
+            model = self._cached_model(system_message, formatted[:count])
+            if model is not None:
+                return model, formatted[count:-1]
+        return self._model_for(system_message), formatted[:-1]
+    
+    def _prepare_chat(self, messages: List[Dict[str, str]]):
+        """Prepare chat with history and return chat instance, final message and
+        whether the chat is the persistent one.
+        
+        The persistent chat is reused when ``messages`` continue exactly the
+        exchange it already holds, so only the new prompt is sent through
+        it. Otherwise a chat is started from the history, which is formatted
+        incrementally. With cached content, the chat only holds the history
+        after the pinned context.
+        """
+        self._configure()
+        system_message, formatted = self._formatter.format(messages)
+        message_content = messages[-1]["content"]
+        if self.model.startswith(LEGACY_MODELS):
+            # No system instructions: prepend it to the prompt, and don't keep
+            # the chat, whose history would then repeat it every turn
+            if system_message:
+                message_content = f"{system_message}\n\n{message_content}"
+            return self.model_instance.start_chat(history=formatted[:-1]), message_content, False
         
-        return chat, message_content
+        # A concurrent request to the same instance gets a chat of its own
+        if not self._chat_lock.acquire(blocking=False):
+            model, history = self._chat_setup(system_message, formatted)
+            return model.start_chat(history=history), message_content, False
+        try:
+            model, history = self._chat_setup(system_message, formatted)
+            source = self._chat_source
+            if (self._chat is None or model is not self._chat_model
+                    or len(source) != len(messages) - 1 or messages[:-1] != source):
+                self._chat = model.start_chat(history=history)
+                self._chat_model = model
+        except BaseException:
+            self._chat_lock.release()
+            raise
+        return self._chat, message_content, True
+    
+    def _finish_chat(self, persistent: bool, messages: List[Dict[str, str]], reply: Optional[str]):
+        """Record what the persistent chat now holds (None if it failed) and release it.
+        
+        A prompt sent with retrieved code (see ``codeindex.with_context``)
+        is replaced by the conversation's prompt, in the chat's history
+        too: the code is only sent with the prompt it was retrieved for,
+        and the next request's history holds the prompt without it.
+        """
+        if not persistent:
+            return
+        try:
+            if reply is None:
+                self._chat = None
+                self._chat_source = []
+                return
+            prompt = getattr(messages[-1], "original", None)
+            if prompt is not None:
+                history = self._chat.history
+                history[-2] = genai.protos.Content(role="user", parts=[genai.protos.Part(text=prompt["content"])])
+                messages = messages[:-1] + [prompt]
+            self._chat_source = list(messages) + [{"role": "assistant", "content": reply}]
+        finally:
+            self._chat_lock.release()
+    
+    def _report_usage(self, response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            # Cached content is reported as written once, by the request
+            # that created it
+            written, self._pinned_written = self._pinned_written, None
+            report_usage(usage.prompt_token_count, usage.candidates_token_count,
+                         cache_read_tokens=getattr(usage, "cached_content_token_count", None) or 0,
+                         cache_write_tokens=written)
     
     def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """Generate a response using Google Gemini API."""
-        chat, message_content = self._prepare_chat(messages)
-        response = chat.send_message(message_content)
-        return response.text
+        chat, message_content, persistent = self._prepare_chat(messages)
+        reply = None
+        try:
+            response = chat.send_message(message_content)
+            self._report_usage(response)
+            reply = response.text
+        finally:
+            self._finish_chat(persistent, messages, reply)
+        return reply
     
     def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
         """Generate a streaming response using Google Gemini API."""
-        chat, message_content = self._prepare_chat(messages)
-        response = chat.send_message(message_content, stream=True)
-        for chunk in response:
-            if chunk.text:
-                yield chunk.text
+        return self._stream(messages, [])
+    
+    def _stream(self, messages: List[Dict[str, str]], responses: List[Any]):
+        """``generate_stream``, adding its response to ``responses`` once it has one."""
+        chat, message_content, persistent = self._prepare_chat(messages)
+        reply = None
+        try:
+            response = chat.send_message(message_content, stream=True)
+            responses.append(response)
+            parts = []
+            for chunk in response:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            self._report_usage(response)
+            reply = "".join(parts)
+        finally:
+            # An interrupted stream leaves the chat's history incomplete
+            self._finish_chat(persistent, messages, reply)
+    
+    @staticmethod
+    def _cancel(responses: List[Any]):
+        """End the HTTP streams of ``responses`` now (from any thread).
+        
+        Closing the response would wait for the read the worker thread is
+        blocked in, so the socket is shut down first, which ends that read.
+        """
+        import socket
+        
+        for response in responses:
+            # The SDK's response reads the transport's stream iterator, which
+            # holds the requests response
+            stream = getattr(response, "_iterator", None)
+            raw = getattr(getattr(stream, "_response", None), "raw", None)
+            sock = getattr(getattr(raw, "connection", None), "sock", None)
+            try:
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR)
+                if stream is not None and hasattr(stream, "cancel"):
+                    stream.cancel()
+            except OSError:
+                pass
+    
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        """Generate a streaming response asynchronously.
+        
+        With the gRPC transport the stream is read through the SDK's
+        asyncio client, so cancelling the consumer cancels the call at
+        once, while waiting for the first chunk too. The REST transport (a
+        custom endpoint, cassettes) is read in a worker thread, and
+        cancelling closes its HTTP response from here; the SDK waits for
+        the first chunk before handing the response out, so only that wait
+        runs to its end.
+        """
+        if self._rest:
+            responses: List[Any] = []
+            async for chunk in iterate_in_thread(lambda: self._stream(messages, responses),
+                                                 lambda: self._cancel(responses)):
+                yield chunk
+            return
+        
+        # Creating cached content is a blocking request
+        chat, message_content, persistent = await asyncio.get_running_loop().run_in_executor(
+            None, self._prepare_chat, messages)
+        reply = None
+        try:
+            response = await chat.send_message_async(message_content, stream=True)
+            parts = []
+            async for chunk in response:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            self._report_usage(response)
+            reply = "".join(parts)
+        finally:
+            self._finish_chat(persistent, messages, reply)
@@ -1,34 +1,175 @@
 """OpenAI provider implementation."""
 
-from typing import List, Dict
-from openai import OpenAI
-from ai_workbench.providers import AIProvider
+import hashlib
+from typing import Any, List, Dict
+from openai import AsyncOpenAI, BadRequestError, OpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient
+from ai_workbench.providers import AIProvider, IncrementalFormatter
+from ai_workbench.providers.pool import client_pool, get_http_client, prewarm_connection
+from ai_workbench.telemetry import report_usage
 
 
 class OpenAIProvider(AIProvider):
-    """OpenAI API provider."""
+    """OpenAI API provider.
     
-    def __init__(self, api_key: str, model: str = "gpt-4"):
-        super().__init__(api_key, model)
-        self.client = OpenAI(api_key=api_key)
+    Streams ask for token usage (``stream_options``). A compatible endpoint
+    (``base_url``) that rejects the option is asked once more without it,
+    and from then on streams from it report no usage.
+    """
+    
+    name = "openai"
+    
+    def __init__(self, api_key: str, model: str = "gpt-4", base_url: str = None, prompt_cache: bool = True):
+        super().__init__(api_key, model, base_url, prompt_cache)
+        # Clients are shared across provider instances with the same key, so
+        # switching models keeps the warm connection pool.
+        self.client = client_pool.get(
+            ("openai", api_key, base_url),
+            # Retries are done by ResilientProvider, which shares rate limits
+            lambda: OpenAI(api_key=api_key, base_url=base_url, max_retries=0,
+                           http_client=get_http_client("openai", api_key, DefaultHttpxClient)),
+        )
+        # Wire-format view of the history, extended as the conversation grows
+        self._formatter = IncrementalFormatter(lambda msg: {"role": msg["role"], "content": msg["content"]})
+        # Whether streams ask for usage; cleared once a compatible endpoint
+        # rejected the option
+        self._stream_usage = True
+    
+    @property
+    def _async_http_client(self) -> DefaultAsyncHttpxClient:
+        return get_http_client("openai", self.api_key, DefaultAsyncHttpxClient)
+    
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        """Pooled async client, created on first use."""
+        return client_pool.get(
+            ("openai", self.api_key, self.base_url, "async"),
+            lambda: AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                http_client=self._async_http_client),
+        )
+    
+    def _prepare(self, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> List[Dict[str, str]]:
+        """Lay the request out for OpenAI's automatic prefix caching.
+        
+        The cache matches on the exact bytes of the prompt's beginning, so
+        every message is sent as ``{"role", "content"}`` in that order
+        (dropping extra keys a loaded session may carry), the system message
+        first. ``prompt_cache_key`` routes the turns of one conversation to
+        the same cache; it goes in ``extra_body``, which SDKs older than the
+        parameter pass through too, and only to OpenAI itself, since
+        compatible gateways (``base_url``) may reject unknown fields.
+        """
+        if not self.prompt_cache:
+            return messages
+        system, formatted = self._formatter.format(messages)
+        if system is not None:
+            formatted = [{"role": "system", "content": system}] + formatted
+        if formatted:
+            first = formatted[1] if len(formatted) > 1 and system is not None else formatted[0]
+            digest = hashlib.sha256(f"{self.model}\0{system}\0{first['content']}".encode("utf-8")).hexdigest()
+            if self.base_url is None:
+                extra_body = dict(kwargs.get("extra_body") or {})
+                extra_body.setdefault("prompt_cache_key", f"awb-{digest[:32]}")
+                kwargs["extra_body"] = extra_body
+        return formatted
+    
+    def _stream_request(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """Keyword arguments of a streaming request, asking for usage if the endpoint takes it."""
+        if self._stream_usage and "stream_options" not in kwargs:
+            return dict(kwargs, stream_options={"include_usage": True})
+        return kwargs
+    
+    @staticmethod
+    def _report_usage(usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) if details is not None else None
+        report_usage(usage.prompt_tokens, usage.completion_tokens, cache_read_tokens=cached)
+    
+    async def aprewarm(self):
+        """Open a connection to the API host on the pooled async client."""
+        await prewarm_connection(self._async_http_client, str(self.async_client.base_url))
     
     def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
         """Generate a response using OpenAI API."""
+        messages = self._prepare(messages, kwargs)
         response = self.client.chat.completions.create(
             model=self.model,
             messages=messages,
             **kwargs
         )
+        self._report_usage(response.usage)
         return response.choices[0].message.content
     
     def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
         """Generate a streaming response using OpenAI API."""
-        stream = self.client.chat.completions.create(
+        messages = self._prepare(messages, kwargs)
+        request = self._stream_request(kwargs)
+        try:
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                **request
+            )
+        except BadRequestError:
+            # Compatible endpoints may not know stream_options
+            if request is kwargs or self.base_url is None:
+                raise
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                **kwargs
+            )
+            self._stream_usage = False
+        # Closing the stream (also when the consumer stops early) closes the
+        # HTTP response, so the server stops generating
+        with stream:
+            for chunk in stream:
+                # With include_usage the final chunk carries usage and no choices
+                self._report_usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
+    
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response using OpenAI API."""
+        messages = self._prepare(messages, kwargs)
+        response = await self.async_client.chat.completions.create(
             model=self.model,
             messages=messages,
-            stream=True,
             **kwargs
         )
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+        self._report_usage(response.usage)
+        return response.choices[0].message.content
+    
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Asynchronously generate a streaming response using OpenAI API."""
+        messages = self._prepare(messages, kwargs)
+        request = self._stream_request(kwargs)
+        try:
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                **request
+            )
+        except BadRequestError:
+            # Compatible endpoints may not know stream_options
+            if request is kwargs or self.base_url is None:
+                raise
+            stream = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                **kwargs
+            )
+            self._stream_usage = False
+        # Closing the stream (also on cancellation) closes the HTTP
+        # response, so the server stops generating
+        async with stream:
+            async for chunk in stream:
+                # With include_usage the final chunk carries usage and no choices
+                self._report_usage(chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
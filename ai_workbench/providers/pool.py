@@ -0,0 +1,100 @@
+"""Process-wide pool of long-lived API clients.
+
+Provider instances are cheap and are recreated on every ``/provider`` or
+``/model`` switch, but the SDK clients behind them own HTTP connection
+pools. Keeping one client per (provider, api_key) means a switch only
+changes the model name and the next request reuses a warm connection.
+"""
+
+import sys
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+from ai_workbench.cassettes import http_transport
+from ai_workbench.config import config
+from ai_workbench.telemetry import http_event_hooks
+
+
+class ClientPool:
+    """Thread-safe cache of clients keyed by an arbitrary hashable key."""
+    
+    def __init__(self):
+        self._clients: Dict[Hashable, Any] = {}
+        # Re-entrant: client factories fetch their pooled HTTP client
+        self._lock = threading.RLock()
+    
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """Return the client stored under ``key``, creating it with ``factory`` if needed."""
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = factory()
+                self._clients[key] = client
+            return client
+    
+    def __len__(self) -> int:
+        return len(self._clients)
+    
+    def clear(self):
+        """Forget all pooled clients."""
+        with self._lock:
+            self._clients.clear()
+
+
+# Global client pool
+client_pool = ClientPool()
+
+
+def _http_module(client_class: type):
+    """The HTTP library an httpx-style client class is built on.
+    
+    Types passed to the client (limits, transports) are taken from it, so
+    they always match the client.
+    """
+    base = next(klass for klass in client_class.__mro__ if klass.__name__ in ("Client", "AsyncClient"))
+    return sys.modules[base.__module__.split(".")[0]]
+
+
+def _limits(http):
+    """Build connection limits from config with the HTTP library ``http``."""
+    return http.Limits(
+        max_connections=config.http_max_connections,
+        max_keepalive_connections=config.http_max_keepalive,
+        keepalive_expiry=config.http_keepalive_expiry,
+    )
+
+
+def get_http_client(provider: str, api_key: str, client_class: type):
+    """Return the pooled HTTP client for a provider, key and client class.
+    
+    Args:
+        provider: Provider name, part of the pool key
+        api_key: API key, part of the pool key
+        client_class: The SDK's default HTTP client class, e.g.
+            ``openai.DefaultHttpxClient`` or ``openai.DefaultAsyncHttpxClient``
+    """
+    is_async = any(klass.__name__ == "AsyncClient" for klass in client_class.__mro__)
+    
+    def factory():
+        http = _http_module(client_class)
+        options = {"limits": _limits(http), "event_hooks": http_event_hooks(is_async)}
+        # Recording or replaying cassettes (--record, --replay)
+        transport = http_transport(http, is_async, options["limits"])
+        if transport is not None:
+            options["transport"] = transport
+        return client_class(**options)
+    
+    return client_pool.get((provider, api_key, client_class), factory)
+
+
+async def prewarm_connection(http_client, url: str):
+    """Open (and keep alive) a connection to ``url``'s host.
+    
+    Any response, even an error status, leaves a warm TCP+TLS connection in
+    the client's pool; failures are ignored since this is only an optimisation.
+    """
+    try:
+        response = await http_client.head(url)
+        await response.aclose()
+    except Exception:
+        pass
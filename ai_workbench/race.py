@@ -0,0 +1,177 @@
+"""Racing and hedged requests across several providers."""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+from ai_workbench.providers import AIProvider
+
+# Hedge delay used until enough first-token times have been observed
+DEFAULT_HEDGE_DELAY = 2.0
+
+# Observations needed before the adaptive hedge delay is trusted
+_MIN_SAMPLES = 10
+
+
+async def _first_chunk(stream: AsyncIterator[str]) -> str:
+    return await stream.__anext__()
+
+
+class RaceProvider(AIProvider):
+    """Send the same request to several providers and keep the fastest.
+
+    In race mode every provider is asked at once. In hedged mode the first
+    provider is asked alone and the others are only asked if it has not
+    produced a first token after ``hedge_delay`` seconds (or as soon as it
+    fails). Either way the first provider to produce a token wins, and the
+    requests of the others are cancelled immediately.
+
+    ``hedge_delay`` may be a number of seconds, ``"p95"`` to use the 95th
+    percentile of recently observed time-to-first-token, or None to race.
+
+    Racing needs concurrency, so only the async methods race; the blocking
+    methods use the first provider.
+    """
+
+    name = "race"
+
+    def __init__(self, providers: List[AIProvider], hedge_delay: Any = None):
+        super().__init__(providers[0].api_key, providers[0].model)
+        self.providers = providers
+        self.hedge_delay = hedge_delay
+        self.last_winner: Optional[AIProvider] = None
+        self.last_ttft: Optional[float] = None
+        self._ttfts: Deque[float] = deque(maxlen=200)
+        self._cleanup = set()
+
+    def current_hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before sending backup requests, or None to race."""
+        if self.hedge_delay is None:
+            return None
+        if self.hedge_delay != "p95":
+            return float(self.hedge_delay)
+        if len(self._ttfts) < _MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        ordered = sorted(self._ttfts)
+        return ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)]
+
+    def describe(self) -> str:
+        """Human-readable list of the contenders and the mode."""
+        contenders = ", ".join(f"{p.name}/{p.model}" for p in self.providers)
+        delay = self.current_hedge_delay()
+        mode = "race" if delay is None else f"hedged after {delay:.2f}s"
+        return f"{contenders} ({mode})"
+
+    async def _run(self, start: Callable[[AIProvider], Tuple[Any, Any]]):
+        """Run contenders until one succeeds.
+
+        Args:
+            start: Called with a provider, returns ``(awaitable, stream)``
+                where the awaitable yields the first result and ``stream``
+                is the async generator to close if the contender loses
+
+        Returns:
+            ``(provider, result, stream)`` of the winner
+        """
+        pending: Dict[asyncio.Future, Tuple[AIProvider, Any]] = {}
+        backups = list(self.providers[1:])
+        delay = self.current_hedge_delay()
+        started = time.monotonic()
+
+        def launch(provider: AIProvider):
+            awaitable, stream = start(provider)
+            pending[asyncio.ensure_future(awaitable)] = (provider, stream)
+
+        launch(self.providers[0])
+        if delay is None:
+            for provider in backups:
+                launch(provider)
+            backups = []
+
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = None
+                if backups:
+                    timeout = max(delay - (time.monotonic() - started), 0)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Hedge delay expired without a first token
+                    for provider in backups:
+                        launch(provider)
+                    backups = []
+                    continue
+
+                for task in done:
+                    provider, stream = pending.pop(task)
+                    exc = task.exception()
+                    if exc is None or isinstance(exc, StopAsyncIteration):
+                        self._ttfts.append(time.monotonic() - started)
+                        self.last_ttft = time.monotonic() - started
+                        self.last_winner = provider
+                        return provider, None if exc else task.result(), stream
+                    error = exc
+
+                if not pending and backups:
+                    # Everything in flight failed; don't wait for the delay
+                    for provider in backups:
+                        launch(provider)
+                    backups = []
+            raise error
+        finally:
+            self._cancel(pending)
+
+    def _cancel(self, pending: Dict[asyncio.Future, Tuple[AIProvider, Any]]):
+        """Cancel losing contenders and close their streams in the background."""
+        if not pending:
+            return
+        for task in pending:
+            task.cancel()
+
+        async def close():
+            await asyncio.gather(*pending, return_exceptions=True)
+            for _, stream in pending.values():
+                if stream is not None:
+                    try:
+                        await stream.aclose()
+                    except Exception:
+                        pass
+
+        task = asyncio.ensure_future(close())
+        self._cleanup.add(task)
+        task.add_done_callback(self._cleanup.discard)
+
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response with the first provider."""
+        return self.providers[0].generate_response(messages, **kwargs)
+
+    def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Generate a streaming response with the first provider."""
+        return self.providers[0].generate_stream(messages, **kwargs)
+
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Race complete responses and return the first one."""
+        _, response, _ = await self._run(lambda p: (p.agenerate_response(messages, **kwargs), None))
+        return response
+
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Race for the first token, then stream the winner's response."""
+        def start(provider: AIProvider):
+            stream = provider.agenerate_stream(messages, **kwargs)
+            return _first_chunk(stream), stream
+
+        _, first, stream = await self._run(start)
+        if first is None:
+            # The winner produced an empty response
+            return
+        try:
+            yield first
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    async def aprewarm(self):
+        """Pre-warm every contender."""
+        await asyncio.gather(*(p.aprewarm() for p in self.providers), return_exceptions=True)
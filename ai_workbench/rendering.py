@@ -0,0 +1,220 @@
+"""Incremental rendering of streamed Markdown responses."""
+
+import asyncio
+import re
+import time
+from typing import List, Optional
+
+from rich.console import Console
+
+
+# A list item marker at the start of a line
+_LIST_ITEM = re.compile(r"(?:[-+*]|\d{1,9}[.)])(?:[ \t]|$)")
+
+
+class StreamRenderer:
+    """Render a streamed Markdown reply at a capped frame rate.
+
+    Chunks are collected in a list and drawn at most ``fps`` times per
+    second. The reply is split into Markdown blocks as it arrives: every
+    completed block (one ended by a blank line or a closing code fence, once
+    the next line starts a new block at column 0) is rendered once and
+    printed permanently, and only the unfinished trailing block is re-parsed
+    on each frame, in a ``rich.live`` region. A list or blockquote stays in
+    the trailing block until something other than it follows, so loose
+    lists and multi-paragraph items are rendered as one.
+
+    When the console is not a terminal, chunks are written through as plain
+    text instead.
+
+    Usage::
+
+        with StreamRenderer(console) as renderer:
+            for chunk in stream:
+                renderer.feed(chunk)
+        text = renderer.text
+    """
+
+    def __init__(self, console: Console, fps: float = 15):
+        self.console = console
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.live_enabled = console.is_terminal
+        # Every chunk received, joined only once at the end
+        self._parts: List[str] = []
+        # Chunks received since the last frame
+        self._pending: List[str] = []
+        # Unfinished trailing block and how far it has been scanned
+        self._tail = ""
+        self._scan = 0
+        # Fence string (``` or ~~~, possibly longer) of an open code block,
+        # and where its opening line starts in the trailing text
+        self._fence: Optional[str] = None
+        self._fence_start = 0
+        # Whether a blank line or closing fence ended the scanned text; it is
+        # cut off once the next line turns out to start a new block
+        self._ended = False
+        # Whether a block has been printed, which the next is spaced from
+        self._printed = False
+        self._last_draw = 0.0
+        self._timer = None
+        self._live = None
+
+    def __enter__(self) -> "StreamRenderer":
+        if self.live_enabled:
+            from rich.live import Live
+            self._live = Live(
+                console=self.console,
+                auto_refresh=False,
+                transient=True,
+                vertical_overflow="crop",
+            )
+            self._live.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finish()
+        return False
+
+    @property
+    def text(self) -> str:
+        """Full text received so far."""
+        return "".join(self._parts)
+
+    def feed(self, chunk: str):
+        """Add a chunk, redrawing if the last frame is older than the frame interval."""
+        self._parts.append(chunk)
+        if not self.live_enabled:
+            self.console.file.write(chunk)
+            self.console.file.flush()
+            return
+
+        self._pending.append(chunk)
+        elapsed = time.monotonic() - self._last_draw
+        if elapsed >= self.interval:
+            self._draw()
+        elif self._timer is None:
+            # Make sure the chunk is shown even if the stream pauses now
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._timer = loop.call_later(self.interval - elapsed, self._draw)
+
+    def finish(self):
+        """Render whatever is left and stop the live region."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.live_enabled:
+            self.console.file.write("\n")
+            self.console.file.flush()
+            return
+        if self._live is None:
+            return
+
+        self._tail += "".join(self._pending)
+        self._pending = []
+        self._live.update("", refresh=True)
+        self._live.stop()
+        self._live = None
+        for block in self._take_completed_blocks():
+            self._print_block(block)
+        if self._tail.strip():
+            self._print_block(self._tail)
+        self._tail = ""
+        self._scan = 0
+        self._ended = False
+
+    def _draw(self):
+        """Flush completed blocks and redraw the trailing block."""
+        self._timer = None
+        if self._live is None:
+            return
+        self._last_draw = time.monotonic()
+        self._tail += "".join(self._pending)
+        self._pending = []
+
+        for block in self._take_completed_blocks():
+            self._print_block(block)
+        self._live.update(self._render(self._visible_tail()), refresh=True)
+
+    def _take_completed_blocks(self) -> List[str]:
+        """Split finished Markdown blocks off the front of the trailing text.
+
+        A block is only cut off before a line at column 0 that follows a
+        blank line or closing fence and doesn't go on with a list or
+        blockquote: until then, the lines after the gap may still belong
+        to it. Only complete lines after the previous scan position are
+        examined, so the work per frame is proportional to the newly
+        received text.
+        """
+        blocks = []
+        while True:
+            newline = self._tail.find("\n", self._scan)
+            if newline == -1:
+                break
+            line_start = self._scan
+            raw = self._tail[line_start:newline]
+            line = raw.strip()
+            self._scan = newline + 1
+
+            if self._fence is not None:
+                # A closing fence uses the same character, at least as many times
+                if line.startswith(self._fence) and not line.strip(self._fence[0]):
+                    self._fence = None
+                    self._ended = True
+                continue
+
+            if not line:
+                if self._tail[:self._scan].strip():
+                    self._ended = True
+                continue
+            if (self._ended and not raw[0].isspace()
+                    and not line.startswith(">") and not _LIST_ITEM.match(line)):
+                blocks.append(self._cut(line_start))
+                line_start = 0
+            self._ended = False
+
+            if line.startswith("```") or line.startswith("~~~"):
+                marker = line[0]
+                self._fence = marker * (len(line) - len(line.lstrip(marker)))
+                self._fence_start = line_start
+        return blocks
+
+    def _cut(self, end: int) -> str:
+        """Remove and return the trailing text up to ``end``."""
+        block = self._tail[:end]
+        self._tail = self._tail[end:]
+        self._scan -= end
+        return block
+
+    def _visible_tail(self) -> str:
+        """The part of the trailing block that fits on screen.
+
+        Long blocks (typically a big code block still being written) are
+        cropped to their last lines so the live region never outgrows the
+        terminal; an open code fence is kept so the crop still renders as code.
+        """
+        max_lines = max(self.console.height - 4, 4)
+        start = len(self._tail)
+        for _ in range(max_lines):
+            start = self._tail.rfind("\n", 0, start)
+            if start == -1:
+                return self._tail
+        visible = self._tail[start + 1:]
+        if self._fence is not None and self._fence_start <= start:
+            fence_end = self._tail.find("\n", self._fence_start)
+            visible = self._tail[self._fence_start:fence_end + 1] + visible
+        return visible
+
+    def _render(self, text: str):
+        from rich.markdown import Markdown
+        return Markdown(text)
+
+    def _print_block(self, block: str):
+        if block.strip():
+            # The blank line Markdown puts between blocks of one document
+            if self._printed:
+                self.console.print()
+            self.console.print(self._render(block))
+            self._printed = True
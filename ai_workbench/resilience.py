@@ -0,0 +1,365 @@
+"""Client-side rate limiting and retries shared by all providers.
+
+``ResilientProvider`` wraps a provider so that every request first takes
+its share of a per-provider token bucket (requests and tokens per minute)
+and transient failures (429, 5xx, dropped connections) are retried with
+exponential backoff and full jitter, honouring ``Retry-After``. A stream
+that fails after it has started is resumed where the provider supports
+continuing a partial reply; otherwise the error is raised.
+
+Rate limiters are process-wide and keyed by provider name, so every
+provider instance, REPL switch and batch worker draws from the same
+budget. A 429 pauses the whole bucket for the time the server asked for,
+which keeps concurrent requests from retrying in lockstep.
+"""
+
+import asyncio
+import contextvars
+import email.utils
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from ai_workbench.providers import AIProvider, ProviderWrapper
+
+# HTTP statuses worth retrying; 529 is Anthropic's "overloaded"
+RETRY_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504, 529})
+
+# Name fragments of transport errors without a status (the SDKs'
+# APIConnectionError and APITimeoutError, httpx's ConnectError, ReadError,
+# RemoteProtocolError, ...), matched by name so no SDK is imported here
+_TRANSIENT_NAMES = ("Connection", "Timeout", "Network", "ReadError", "RemoteProtocol")
+
+# Error types worth retrying of an error event in a stream that began with
+# a 200 response (Anthropic's SDK raises it with that status)
+_TRANSIENT_ERROR_TYPES = frozenset({"overloaded_error", "api_error", "rate_limit_error"})
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``per_minute / 60`` per second.
+
+    Callers reserve what they need up front and are told how long to wait
+    for it, so waiters are served in arrival order and the level may go
+    negative. A ``per_minute`` of 0 disables the bucket.
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.level = per_minute
+        self._rate = per_minute / 60.0
+        self._updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take ``amount`` and return the seconds until it is covered."""
+        if not self.per_minute:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self._updated) * self._rate)
+        self._updated = now
+        # A single request larger than the bucket waits for a full bucket
+        # rather than forever
+        self.level -= min(amount, self.capacity)
+        return max(-self.level / self._rate, 0.0)
+
+    def charge(self, amount: float):
+        """Take ``amount`` after the fact (e.g. tokens of a finished reply)."""
+        if self.per_minute:
+            self.level -= amount
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute limits for one provider."""
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.requests.per_minute or self.tokens.per_minute)
+
+    def reserve(self, tokens: int) -> float:
+        """Reserve one request and ``tokens`` and return the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now))
+            return max(wait, self._blocked_until - now)
+
+    def charge(self, tokens: int):
+        with self._lock:
+            self.tokens.charge(tokens)
+
+    def block(self, seconds: float):
+        """Hold back every request to this provider for ``seconds``."""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str, requests_per_minute: float = 0, tokens_per_minute: float = 0) -> RateLimiter:
+    """Return the process-wide rate limiter of a provider, creating it on first use."""
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            _limiters[provider] = limiter
+        return limiter
+
+
+def _status(error: BaseException) -> Optional[int]:
+    """HTTP status of a provider error, if it has one."""
+    for attribute in ("status_code", "code"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def _error_type(error: BaseException) -> Optional[str]:
+    """Type of a provider error from its body, e.g. ``overloaded_error``."""
+    body = getattr(error, "body", None)
+    detail = body.get("error") if isinstance(body, dict) else None
+    return detail.get("type") if isinstance(detail, dict) else None
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether ``error`` is worth retrying."""
+    status = _status(error)
+    if status is not None and 200 <= status < 300:
+        # An error event mid-stream: the response's status says nothing
+        return _error_type(error) in _TRANSIENT_ERROR_TYPES
+    if status is not None:
+        return status in RETRY_STATUSES
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    return any(word in klass.__name__ for klass in type(error).__mro__ for word in _TRANSIENT_NAMES)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait, from ``Retry-After`` headers."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(float(value) / 1000, 0.0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+# Set by callers that report how many attempts a request took (batch
+# results): a one-item list that every retry made in the context adds to
+retry_counter: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("retry_counter", default=None)
+
+
+def is_resilient(provider: AIProvider) -> bool:
+    """Whether ``provider`` retries transient errors itself, through a ``ResilientProvider`` layer."""
+    while provider is not None:
+        if isinstance(provider, ResilientProvider):
+            return True
+        provider = provider.__dict__.get("provider")
+    return False
+
+
+class ResilientProvider(ProviderWrapper):
+    """Provider wrapper adding rate limiting, retries and stream resumption.
+
+    Args:
+        provider: Provider to wrap
+        limiter: Rate limiter shared by every instance of this provider
+        max_retries: Retries after the first attempt; 0 disables retrying
+        base_delay: Backoff before the first retry, doubled for each retry
+        max_delay: Upper bound of the backoff (``Retry-After`` may exceed it)
+        on_retry: Called with ``(provider, attempt, delay, error)`` before
+            sleeping for a retry
+    """
+
+    def __init__(self, provider: AIProvider, limiter: Optional[RateLimiter] = None, max_retries: int = 3,
+                 base_delay: float = 0.5, max_delay: float = 30.0,
+                 on_retry: Optional[Callable[[AIProvider, int, float, BaseException], None]] = None):
+        super().__init__(provider)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_retry = on_retry
+
+    def _estimate(self, messages: List[Dict[str, str]]) -> int:
+        if self.limiter is None or not self.limiter.tokens.per_minute:
+            return 0
+        from ai_workbench.tokens import get_estimator
+        estimator = get_estimator(self.provider.name, self.provider.model)
+        return sum(estimator.count_message(message) for message in messages)
+
+    def _charge_reply(self, text: str):
+        if self.limiter is not None and self.limiter.tokens.per_minute and text:
+            from ai_workbench.tokens import get_estimator
+            self.limiter.charge(get_estimator(self.provider.name, self.provider.model).count(text))
+
+    def _admission(self, messages: List[Dict[str, str]]) -> float:
+        """Seconds to wait before sending ``messages``."""
+        if self.limiter is None or not self.limiter.enabled:
+            return 0.0
+        return self.limiter.reserve(self._estimate(messages))
+
+    def _backoff(self, attempt: int, error: BaseException) -> Optional[float]:
+        """Delay before retry number ``attempt``, or None to give up."""
+        if attempt > self.max_retries or not is_transient(error):
+            return None
+        requested = retry_after(error)
+        if requested is not None:
+            if _status(error) == 429 and self.limiter is not None:
+                self.limiter.block(requested)
+            # A little jitter so that clients told the same time don't
+            # all come back in the same instant
+            delay = requested + random.uniform(0, min(requested * 0.1, 1.0))
+        else:
+            # Full jitter: uniform between 0 and the exponential bound
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        counter = retry_counter.get()
+        if counter is not None:
+            counter[0] += 1
+        if self.on_retry is not None:
+            self.on_retry(self.provider, attempt, delay, error)
+        return delay
+
+    def _resume(self, messages: List[Dict[str, str]], partial: str) -> Optional[List[Dict[str, str]]]:
+        """Messages that continue ``partial``, or None if it cannot be resumed."""
+        if not partial:
+            return messages
+        return self.provider.continuation_messages(messages, partial)
+
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response, waiting for the rate limit and retrying transient errors."""
+        attempt = 0
+        while True:
+            time.sleep(self._admission(messages))
+            try:
+                response = self.provider.generate_response(messages, **kwargs)
+            except Exception as e:
+                attempt += 1
+                delay = self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._charge_reply(response)
+            return response
+
+    def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Generate a streaming response, retrying and resuming after transient errors."""
+        attempt = 0
+        partial = ""
+        request = messages
+        while True:
+            time.sleep(self._admission(request))
+            try:
+                for chunk in _skip_overlap(self.provider.generate_stream(request, **kwargs), partial):
+                    partial += chunk
+                    yield chunk
+            except Exception as e:
+                attempt += 1
+                resumed = self._resume(messages, partial)
+                delay = None if resumed is None else self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                request = resumed
+                time.sleep(delay)
+                continue
+            self._charge_reply(partial)
+            return
+
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response, waiting for the rate limit and retrying transient errors."""
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._admission(messages))
+            try:
+                response = await self.provider.agenerate_response(messages, **kwargs)
+            except Exception as e:
+                attempt += 1
+                delay = self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._charge_reply(response)
+            return response
+
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Asynchronously generate a streaming response, retrying and resuming after transient errors."""
+        attempt = 0
+        partial = ""
+        request = messages
+        while True:
+            await asyncio.sleep(self._admission(request))
+            stream = self.provider.agenerate_stream(request, **kwargs)
+            try:
+                async for chunk in _askip_overlap(stream, partial):
+                    partial += chunk
+                    yield chunk
+            except Exception as e:
+                attempt += 1
+                resumed = self._resume(messages, partial)
+                delay = None if resumed is None else self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                request = resumed
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                await stream.aclose()
+            self._charge_reply(partial)
+            return
+
+
+def _overlap(partial: str) -> str:
+    """Whitespace the continuation of ``partial`` may repeat.
+
+    Providers reject a partial reply that ends in whitespace, so it is sent
+    without it, and the continuation usually starts by producing it again.
+    """
+    return partial[len(partial.rstrip()):]
+
+
+def _skip_overlap(chunks, partial: str):
+    pending = _overlap(partial)
+    for chunk in chunks:
+        if pending:
+            common = len(chunk) - len(chunk.lstrip())
+            skip = min(common, len(pending))
+            chunk, pending = chunk[skip:], ""
+            if not chunk:
+                continue
+        yield chunk
+
+
+async def _askip_overlap(chunks, partial: str):
+    pending = _overlap(partial)
+    async for chunk in chunks:
+        if pending:
+            common = len(chunk) - len(chunk.lstrip())
+            skip = min(common, len(pending))
+            chunk, pending = chunk[skip:], ""
+            if not chunk:
+                continue
+        yield chunk
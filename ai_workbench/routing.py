@@ -0,0 +1,325 @@
+"""Routing requests between models by prompt size, cost and measured speed.
+
+``RoutedProvider`` picks the model of every request from the model
+registry (``config.models``). Only models whose context window holds the
+request are considered, and the policy ranks them:
+
+- ``fastest``: the shortest predicted time to the whole reply, from the
+  time to first token and the output speed
+- ``cheapest``: the lowest predicted cost of the request
+- ``auto``: the fastest model for short prompts, the cheapest model that
+  holds the request for long ones
+
+Speeds start out at the registry's figures and follow the measurements of
+the request telemetry (see ``observe``), shared by every router. A model
+whose request fails, after the retries of its own stack, or whose time to
+first token has degraded far beyond its usual one, is put on a cooldown
+that doubles with every further failure, and the request fails over to
+the next model in the ranking, as long as nothing was streamed yet.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ai_workbench.providers import AIProvider
+from ai_workbench.tokens import MESSAGE_OVERHEAD
+
+POLICIES = ("fastest", "cheapest", "auto")
+
+# Weight of the newest measurement in the moving averages
+_ALPHA = 0.3
+
+# Seconds a failed model is skipped, doubled per consecutive failure, and the cap
+_COOLDOWN = 30.0
+_MAX_COOLDOWN = 600.0
+
+# A model counts as degraded when its average time to first token exceeds
+# the registry's figure this many times
+_DEGRADED = 4.0
+
+# Characters per token when sizing a request; on the low side, so that a
+# request is rather sent to a larger window than to one it overflows
+_CHARS_PER_TOKEN = 3.5
+
+
+class ModelStats:
+    """Measured performance and health of a model.
+
+    Args:
+        ttft: Time to first token (seconds) assumed until measured
+        tokens_per_second: Output speed assumed until measured
+    """
+
+    def __init__(self, ttft: float, tokens_per_second: float):
+        self.expected_ttft = ttft
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.samples = 0
+        self.failures = 0
+        self.down_until = 0.0
+        self._lock = threading.Lock()
+
+    def measured(self, ttft: Optional[float], tokens_per_second: Optional[float]):
+        """Fold a successful request's measurements into the averages."""
+        with self._lock:
+            self.samples += 1
+            self.failures = 0
+            if ttft is not None:
+                self.ttft += _ALPHA * (ttft - self.ttft)
+            if tokens_per_second:
+                self.tokens_per_second += _ALPHA * (tokens_per_second - self.tokens_per_second)
+            if self.ttft > self.expected_ttft * _DEGRADED:
+                # Skip it for a while, and give it a fresh start afterwards
+                self._cool_down()
+                self.ttft = self.expected_ttft
+
+    def failed(self):
+        """Record a failed request."""
+        with self._lock:
+            self._cool_down()
+
+    def _cool_down(self):
+        self.failures += 1
+        self.down_until = time.monotonic() + min(_COOLDOWN * 2 ** (self.failures - 1), _MAX_COOLDOWN)
+
+    def available(self, now: float) -> bool:
+        """Whether the model is outside its cooldown."""
+        return now >= self.down_until
+
+
+# Stats per (provider, model), shared by every router
+_stats: Dict[Tuple[str, str], ModelStats] = {}
+_stats_lock = threading.Lock()
+
+
+def get_model_stats(provider: str, model: str, info: Dict[str, Any]) -> ModelStats:
+    """Return the shared stats of a model, created from its registry entry."""
+    with _stats_lock:
+        stats = _stats.get((provider, model))
+        if stats is None:
+            stats = _stats[(provider, model)] = ModelStats(info["ttft"], info["tokens_per_second"])
+        return stats
+
+
+def observe(metrics):
+    """Telemetry listener feeding request measurements into the model stats."""
+    stats = _stats.get((metrics.provider, metrics.model))
+    if stats is None or metrics.cached or metrics.status != "ok" or metrics.mode != "stream":
+        return
+    ttft = metrics.ttft_ms / 1000 if metrics.ttft_ms is not None else None
+    tokens_per_second = None
+    streaming = (metrics.duration_ms - (metrics.ttft_ms or 0)) / 1000
+    # Short replies say more about the first token than about the speed
+    if metrics.chunks > 10 and streaming > 0:
+        tokens = metrics.output_tokens or metrics.chars / 4
+        tokens_per_second = tokens / streaming
+    stats.measured(ttft, tokens_per_second)
+
+
+class ModelRoute:
+    """A model that requests can be routed to.
+
+    Args:
+        model: Model name
+        info: Its registry entry (``provider``, ``context_window``,
+            ``max_output``, ``cost``, ``ttft``, ``tokens_per_second``)
+        make: Called with the provider name and model to create the
+            provider, on the first request routed to it
+    """
+
+    def __init__(self, model: str, info: Dict[str, Any], make: Callable[[str, str], AIProvider]):
+        self.model = model
+        self.provider_name = info["provider"]
+        self.context_window = info["context_window"]
+        self.max_output = info["max_output"]
+        self.cost = tuple(info["cost"])
+        self.stats = get_model_stats(self.provider_name, model, info)
+        self._make = make
+        self._provider: Optional[AIProvider] = None
+
+    @property
+    def provider(self) -> AIProvider:
+        if self._provider is None:
+            self._provider = self._make(self.provider_name, self.model)
+        return self._provider
+
+    def seconds(self, reply_tokens: int) -> float:
+        """Predicted time to a complete reply."""
+        return self.stats.ttft + min(reply_tokens, self.max_output) / self.stats.tokens_per_second
+
+    def price(self, prompt_tokens: int, reply_tokens: int) -> float:
+        """Predicted cost of a request in USD."""
+        return (prompt_tokens * self.cost[0] + min(reply_tokens, self.max_output) * self.cost[1]) / 1e6
+
+
+class RoutedProvider(AIProvider):
+    """Send every request to the model that suits it best.
+
+    ``model`` and ``last_route`` are those of the latest request, and
+    ``last_reason`` says why it was chosen. ``context_window`` is the
+    largest window of the routes, so that callers keep as much history
+    as some model can take.
+
+    Args:
+        routes: Models to route between
+        policy: ``fastest``, ``cheapest`` or ``auto``
+        short_tokens: Prompts up to this size count as short under ``auto``
+        reply_tokens: Reply length assumed for the predictions
+        on_failover: Called with ``(failed route, next route, error)``
+            before a request fails over
+    """
+
+    name = "route"
+
+    def __init__(self, routes: List[ModelRoute], policy: str = "auto", short_tokens: int = 2000,
+                 reply_tokens: int = 500,
+                 on_failover: Optional[Callable[[ModelRoute, ModelRoute, BaseException], None]] = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown routing policy '{policy}' (choose from {', '.join(POLICIES)})")
+        super().__init__(None, routes[0].model)
+        self.routes = routes
+        self.policy = policy
+        self.short_tokens = short_tokens
+        self.reply_tokens = reply_tokens
+        self.on_failover = on_failover
+        self.context_window = max(route.context_window for route in routes)
+        self.last_route: Optional[ModelRoute] = None
+        self.last_reason = ""
+
+    def describe(self) -> str:
+        """Human-readable policy and models."""
+        return f"{self.policy} between " + ", ".join(f"{r.provider_name}/{r.model}" for r in self.routes)
+
+    def rank(self, messages: List[Dict[str, str]]) -> Tuple[List[ModelRoute], str]:
+        """Routes to try for ``messages``, best first, and why the first one."""
+        prompt = sum(int(len(m["content"]) / _CHARS_PER_TOKEN) + MESSAGE_OVERHEAD for m in messages)
+        reply = self.reply_tokens
+        fitting = [r for r in self.routes if prompt + min(reply, r.max_output) <= r.context_window]
+        if not fitting:
+            # Nothing holds it; the largest windows come closest
+            fitting = sorted(self.routes, key=lambda r: -r.context_window)
+        policy = self.policy
+        if policy == "auto":
+            policy = "fastest" if prompt <= self.short_tokens else "cheapest"
+        if policy == "fastest":
+            ranked = sorted(fitting, key=lambda r: r.seconds(reply))
+        else:
+            ranked = sorted(fitting, key=lambda r: r.price(prompt, reply))
+        now = time.monotonic()
+        # Models in their cooldown are only tried last, the soonest back first
+        cooling = sorted((r for r in ranked if not r.stats.available(now)), key=lambda r: r.stats.down_until)
+        ranked = [r for r in ranked if r.stats.available(now)] + cooling
+        return ranked, f"{policy}, ~{prompt:,} prompt tokens, {len(fitting)} of {len(self.routes)} models fit"
+
+    def _chosen(self, route: ModelRoute, reason: str):
+        self.last_route = route
+        self.last_reason = reason
+        self.model = route.model
+
+    def _fail_over(self, route: ModelRoute, rest: List[ModelRoute], error: BaseException) -> Optional[List[ModelRoute]]:
+        """Record a failure and return the routes left to try, or None if there are none.
+
+        The other providers' models are tried first, in case the whole
+        provider is down.
+        """
+        route.stats.failed()
+        if not rest:
+            return None
+        rest = [r for r in rest if r.provider_name != route.provider_name] + \
+               [r for r in rest if r.provider_name == route.provider_name]
+        if self.on_failover is not None:
+            self.on_failover(route, rest[0], error)
+        return rest
+
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response with the best model, failing over on errors."""
+        ranked, reason = self.rank(messages)
+        while ranked:
+            route, ranked = ranked[0], ranked[1:]
+            try:
+                response = route.provider.generate_response(messages, **kwargs)
+            except Exception as e:
+                ranked = self._fail_over(route, ranked, e)
+                if ranked is None:
+                    raise
+                continue
+            self._chosen(route, reason)
+            return response
+
+    def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Generate a streaming response with the best model, failing over until the first chunk."""
+        ranked, reason = self.rank(messages)
+        while ranked:
+            route, ranked = ranked[0], ranked[1:]
+            stream = route.provider.generate_stream(messages, **kwargs)
+            try:
+                try:
+                    first = next(stream, None)
+                except Exception as e:
+                    ranked = self._fail_over(route, ranked, e)
+                    if ranked is None:
+                        raise
+                    continue
+                self._chosen(route, reason)
+                if first is None:
+                    return
+                yield first
+                try:
+                    yield from stream
+                except Exception:
+                    route.stats.failed()
+                    raise
+                return
+            finally:
+                stream.close()
+
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response with the best model, failing over on errors."""
+        ranked, reason = self.rank(messages)
+        while ranked:
+            route, ranked = ranked[0], ranked[1:]
+            try:
+                response = await route.provider.agenerate_response(messages, **kwargs)
+            except Exception as e:
+                ranked = self._fail_over(route, ranked, e)
+                if ranked is None:
+                    raise
+                continue
+            self._chosen(route, reason)
+            return response
+
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Asynchronously stream a response from the best model, failing over until the first chunk."""
+        ranked, reason = self.rank(messages)
+        while ranked:
+            route, ranked = ranked[0], ranked[1:]
+            stream = route.provider.agenerate_stream(messages, **kwargs)
+            try:
+                try:
+                    first = await stream.__anext__()
+                except StopAsyncIteration:
+                    first = None
+                except Exception as e:
+                    ranked = self._fail_over(route, ranked, e)
+                    if ranked is None:
+                        raise
+                    continue
+                self._chosen(route, reason)
+                if first is None:
+                    return
+                yield first
+                try:
+                    async for chunk in stream:
+                        yield chunk
+                except Exception:
+                    route.stats.failed()
+                    raise
+                return
+            finally:
+                await stream.aclose()
+
+    async def aprewarm(self):
+        """Pre-warm the model a short question would go to."""
+        ranked, _ = self.rank([])
+        await ranked[0].provider.aprewarm()
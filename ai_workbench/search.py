@@ -0,0 +1,321 @@
+"""Full-text search over saved conversations.
+
+Messages are kept in an SQLite FTS5 index (an inverted index with BM25
+ranking and snippets) in the data directory. The index is brought up to
+date before every search, incrementally:
+
+- session journals are read from the last record indexed onwards,
+  located through their offset index, so a search only parses what was
+  said since the previous one
+- ``Conversation.save`` files are re-read only when their size or
+  modification time changed
+
+Several processes may search (and so update the index) at once; each
+source is updated in its own write transaction.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from ai_workbench.sessions import SessionStore
+
+# Delimiters of matched terms in snippets
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# A quoted phrase or a single word (possibly ending in * for a prefix)
+_QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+_WORD = re.compile(r"\w+")
+
+
+def build_query(text: str, operator: str = "AND") -> Optional[str]:
+    """Turn free text into an FTS5 query joining its terms with ``operator``.
+
+    Words are quoted so that FTS5 syntax in the text can't cause errors;
+    ``"quoted phrases"`` are kept together and a trailing ``*`` makes a
+    word a prefix. Returns None if the text has no words.
+    """
+    terms = []
+    for phrase, word in _QUERY_PART.findall(text):
+        if phrase:
+            words = _WORD.findall(phrase)
+            if words:
+                terms.append('"' + " ".join(words) + '"')
+            continue
+        words = _WORD.findall(word)
+        terms.extend(f'"{w}"' for w in words)
+        if words and word.endswith("*"):
+            terms[-1] += "*"
+    return f" {operator} ".join(terms) if terms else None
+
+
+def _title(messages: Iterable[Dict[str, Any]]) -> Optional[str]:
+    for message in messages:
+        if message.get("role") == "user":
+            return " ".join(str(message.get("content", "")).split())[:80]
+    return None
+
+
+class SearchIndex:
+    """Persistent full-text index of sessions and saved conversation files.
+
+    Args:
+        path: SQLite database file of the index
+        store: Session store whose journals are indexed
+        paths: ``Conversation.save`` files, or directories of them
+            (``*.json``), to index as well
+    """
+
+    def __init__(self, path: Path, store: Optional[SessionStore] = None, paths: Iterable[Path] = ()):
+        self.path = Path(path)
+        self.store = store
+        self.paths = [Path(p).expanduser() for p in paths]
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.path), timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sources ("
+                " source TEXT PRIMARY KEY,"
+                " title TEXT,"
+                # Journal records indexed (sessions), or size and mtime (files)
+                " position INTEGER NOT NULL DEFAULT 0,"
+                " size INTEGER NOT NULL DEFAULT 0,"
+                " mtime REAL NOT NULL DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " id INTEGER PRIMARY KEY,"
+                " source TEXT NOT NULL,"
+                " role TEXT NOT NULL,"
+                " ts REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_source ON entries (source, id)")
+            # The text itself lives in the FTS table, keyed by entries.id
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(content, tokenize='porter unicode61')"
+            )
+            self._conn = conn
+        return self._conn
+
+    # -- updating ------------------------------------------------------------
+
+    def refresh(self) -> Dict[str, int]:
+        """Bring the index up to date.
+        
+        Returns the number of sources updated and removed, and the change in
+        the number of messages.
+        """
+        counts = {"sources": 0, "messages": 0, "removed": 0}
+        with self._lock:
+            conn = self._connect()
+            positions = dict(conn.execute("SELECT source, position FROM sources"))
+            seen = set()
+            if self.store is not None:
+                # Sizes of the offset indexes tell which journals grew,
+                # without opening any of them
+                for session_id, total in self.store.record_counts().items():
+                    source = f"session:{session_id}"
+                    seen.add(source)
+                    if positions.get(source) == total:
+                        continue
+                    counts["sources"] += 1
+                    counts["messages"] += self._index_session(conn, source, session_id, total)
+            for path in self._files():
+                source = f"file:{path}"
+                seen.add(source)
+                added = self._index_file(conn, source, path)
+                if added is not None:
+                    counts["sources"] += 1
+                    counts["messages"] += added
+            for source in set(positions) - seen:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._remove(conn, source)
+                    conn.execute("DELETE FROM sources WHERE source = ?", (source,))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                counts["removed"] += 1
+        return counts
+
+    def rebuild(self) -> Dict[str, int]:
+        """Drop the index and build it again from scratch."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM sources")
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM messages")
+            conn.execute("COMMIT")
+        return self.refresh()
+
+    def _files(self) -> List[Path]:
+        files = []
+        for path in self.paths:
+            if path.is_dir():
+                files.extend(sorted(p.resolve() for p in path.glob("*.json")))
+            elif path.is_file():
+                files.append(path.resolve())
+        return files
+
+    @staticmethod
+    def _remove(conn: sqlite3.Connection, source: str):
+        conn.execute("DELETE FROM messages WHERE rowid IN (SELECT id FROM entries WHERE source = ?)", (source,))
+        conn.execute("DELETE FROM entries WHERE source = ?", (source,))
+
+    @staticmethod
+    def _add(conn: sqlite3.Connection, source: str, role: str, content: str, ts: Optional[float]):
+        cursor = conn.execute("INSERT INTO entries (source, role, ts) VALUES (?, ?, ?)", (source, role, ts))
+        conn.execute("INSERT INTO messages (rowid, content) VALUES (?, ?)", (cursor.lastrowid, content))
+
+    def _index_session(self, conn: sqlite3.Connection, source: str, session_id: str, total: int) -> int:
+        """Index a session's journal records up to ``total``; return the change in messages."""
+        meta = self.store.get_meta(session_id) or {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have got here first, and seen more records
+            row = conn.execute("SELECT position FROM sources WHERE source = ?", (source,)).fetchone()
+            position = row[0] if row is not None else 0
+            total = max(total, self.store.record_count(session_id))
+            if position > total:
+                # The journal was replaced; start over
+                self._remove(conn, source)
+                position = 0
+            added = 0
+            if position < total:
+                for record in self.store.read_records(session_id, position, total):
+                    kind = record.get("type")
+                    if kind == "message":
+                        self._add(conn, source, record["role"], record["content"], record.get("ts"))
+                        added += 1
+                    elif kind == "pop":
+                        # The message was taken back (e.g. it failed); so is its entry
+                        last = conn.execute("SELECT id FROM entries WHERE source = ? ORDER BY id DESC LIMIT 1",
+                                            (source,)).fetchone()
+                        if last is not None:
+                            conn.execute("DELETE FROM messages WHERE rowid = ?", last)
+                            conn.execute("DELETE FROM entries WHERE id = ?", last)
+                            added -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO sources (source, title, position) VALUES (?, ?, ?)",
+                (source, meta.get("title"), total),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def _index_file(self, conn: sqlite3.Connection, source: str, path: Path) -> Optional[int]:
+        """(Re-)index a saved conversation file if it changed; None if it didn't."""
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        row = conn.execute("SELECT size, mtime FROM sources WHERE source = ?", (source,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            messages = data.get("messages") if isinstance(data, dict) else None
+        except (OSError, ValueError):
+            messages = None
+        if not isinstance(messages, list):
+            # Not a conversation; remembered so it isn't parsed again
+            messages = []
+        messages = [m for m in messages if isinstance(m, dict) and isinstance(m.get("content"), str)]
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._remove(conn, source)
+            for message in messages:
+                self._add(conn, source, str(message.get("role", "")), message["content"], stat.st_mtime)
+            conn.execute(
+                "INSERT OR REPLACE INTO sources (source, title, position, size, mtime) VALUES (?, ?, 0, ?, ?)",
+                (source, _title(messages), stat.st_size, stat.st_mtime),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(messages)
+
+    # -- querying ------------------------------------------------------------
+
+    def search(self, text: str, limit: int = 20, role: Optional[str] = None,
+               refresh: bool = True) -> List[Dict[str, Any]]:
+        """Best matches for ``text``, best first.
+
+        All words have to match; if no message has them all, messages with
+        any of them are ranked instead. Each result has ``kind``
+        (``session`` or ``file``), ``id`` (session id or file path),
+        ``title``, ``role``, ``ts``, ``score`` (BM25, higher is better) and
+        ``snippet``, in which matched terms are enclosed in
+        ``MATCH_START`` and ``MATCH_END``.
+        """
+        if refresh:
+            self.refresh()
+        for operator in ("AND", "OR"):
+            query = build_query(text, operator)
+            if query is None:
+                return []
+            results = self._query(query, limit, role)
+            if results:
+                return results
+        return []
+
+    def _query(self, query: str, limit: int, role: Optional[str]) -> List[Dict[str, Any]]:
+        sql = (
+            "SELECT e.source, e.role, e.ts, s.title, snippet(messages, 0, ?, ?, '…', 24), bm25(messages)"
+            " FROM messages JOIN entries e ON e.id = messages.rowid"
+            " LEFT JOIN sources s ON s.source = e.source"
+            " WHERE messages MATCH ?"
+        )
+        params: List[Any] = [MATCH_START, MATCH_END, query]
+        if role:
+            sql += " AND e.role = ?"
+            params.append(role)
+        sql += " ORDER BY bm25(messages) LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        results = []
+        for source, message_role, ts, title, snippet, rank in rows:
+            kind, _, identifier = source.partition(":")
+            results.append({
+                "kind": kind,
+                "id": identifier,
+                "title": title,
+                "role": message_role,
+                "ts": ts,
+                # FTS5's bm25() is negated so that lower sorts first
+                "score": -rank,
+                "snippet": " ".join(snippet.split()),
+            })
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """Number of indexed sources and messages, and the index size."""
+        with self._lock:
+            conn = self._connect()
+            sources = conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+            messages = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        size = sum(p.stat().st_size for p in self.path.parent.glob(self.path.name + "*") if p.is_file())
+        return {"path": str(self.path), "sources": sources, "messages": messages, "size_bytes": size}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,340 @@
+"""Append-only, journaled conversation storage.
+
+Each session is stored in the sessions directory as three files:
+
+- ``<id>.jsonl``: the journal, one JSON record per line, appended as the
+  conversation changes (messages, system message changes, pops, clears)
+- ``<id>.idx``: the byte offset of every journal record as a little-endian
+  unsigned 64-bit integer, so any record can be located without parsing
+  the ones before it
+- ``index/<id>.json``: session metadata (provider, model, title, ...); one
+  small file per session so that concurrent processes never contend
+
+Attached files are journaled by content digest; each content is written
+once to ``blobs/<digest>``, shared by every session that attaches it.
+"""
+
+import json
+import os
+import secrets
+import struct
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from ai_workbench.conversation import Conversation
+
+OFFSET = struct.Struct("<Q")
+
+# Number of records read per step when resuming from the end of a journal
+_READ_BATCH = 256
+
+
+class SessionJournal:
+    """Appends records to a session journal and its offset index.
+
+    Every record is written through to the OS immediately; ``fsync`` is
+    batched and happens every ``fsync_every`` records, after
+    ``fsync_interval`` seconds, and on close.
+    """
+
+    def __init__(self, store: "SessionStore", session_id: str, fsync_every: int = 16, fsync_interval: float = 2.0):
+        self.store = store
+        self.session_id = session_id
+        meta = store.get_meta(session_id) or {}
+        self._titled = bool(meta.get("title"))
+        self._attachments: Dict[str, str] = meta.get("attachments", {})
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._data = open(store.journal_path(session_id), "ab")
+        self._index = open(store.index_path(session_id), "ab")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def append(self, record: Dict[str, Any]):
+        """Append a record to the journal."""
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        offset = self._data.tell()
+        self._data.write(line)
+        self._data.flush()
+        self._index.write(OFFSET.pack(offset))
+        self._index.flush()
+
+        if not self._titled and record.get("role") == "user":
+            # Sessions are listed under their first prompt
+            self._titled = True
+            self.store.update_meta(self.session_id, title=" ".join(record["content"].split())[:80])
+        kind = record.get("type")
+        if kind == "system":
+            self.store.update_meta(self.session_id, system_message=record["content"])
+        elif kind in ("attach", "detach"):
+            # The current attachments are kept in the metadata like the
+            # system message, so restoring needn't replay the whole journal
+            if kind == "attach":
+                self._attachments[record["path"]] = record["digest"]
+            else:
+                self._attachments.pop(record["path"], None)
+            self.store.update_meta(self.session_id, attachments=self._attachments)
+
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def store_blob(self, digest: str, content: str):
+        """Store the content of an attachment before it is journaled."""
+        self.store.write_blob(digest, content)
+    
+    def sync(self):
+        """Force journal and index to disk."""
+        if self._unsynced:
+            os.fsync(self._data.fileno())
+            os.fsync(self._index.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """Sync and close the journal."""
+        if self._data.closed:
+            return
+        self.sync()
+        self._data.close()
+        self._index.close()
+        if self.store.record_count(self.session_id):
+            self.store.touch(self.session_id)
+        else:
+            # Nothing was said; don't keep an empty session around
+            self.store.delete(self.session_id)
+
+
+class SessionStore:
+    """Directory of journaled sessions with a metadata index."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.meta_dir = self.root / "index"
+        self.blobs_dir = self.root / "blobs"
+
+    def journal_path(self, session_id: str) -> Path:
+        return self.root / f"{session_id}.jsonl"
+
+    def index_path(self, session_id: str) -> Path:
+        return self.root / f"{session_id}.idx"
+
+    def meta_path(self, session_id: str) -> Path:
+        return self.meta_dir / f"{session_id}.json"
+
+    def blob_path(self, digest: str) -> Path:
+        return self.blobs_dir / digest
+
+    def create(self, provider: str, model: str, system_message: str) -> str:
+        """Create a new, empty session and return its id."""
+        self.meta_dir.mkdir(parents=True, exist_ok=True)
+        session_id = time.strftime("%Y%m%d-%H%M%S") + "-" + secrets.token_hex(2)
+        now = time.time()
+        self._write_meta({
+            "id": session_id,
+            "created": now,
+            "updated": now,
+            "provider": provider,
+            "model": model,
+            "title": None,
+            "system_message": system_message,
+        })
+        return session_id
+
+    def open_journal(self, session_id: str) -> SessionJournal:
+        """Open a session's journal for appending."""
+        return SessionJournal(self, session_id)
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Return a session's metadata, or None if it does not exist."""
+        try:
+            with open(self.meta_path(session_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def update_meta(self, session_id: str, **fields):
+        """Update fields of a session's metadata."""
+        meta = self.get_meta(session_id)
+        if meta is None:
+            return
+        meta.update(fields)
+        meta["updated"] = time.time()
+        self._write_meta(meta)
+
+    def touch(self, session_id: str):
+        """Record that a session was just used."""
+        self.update_meta(session_id)
+
+    def delete(self, session_id: str):
+        """Delete a session and its metadata."""
+        for path in (self.journal_path(session_id), self.index_path(session_id), self.meta_path(session_id)):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _write_meta(self, meta: Dict[str, Any]):
+        path = self.meta_path(meta["id"])
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    def write_blob(self, digest: str, content: str):
+        """Store attachment content under its digest, unless it is there already."""
+        path = self.blob_path(digest)
+        if path.exists():
+            return
+        self.blobs_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+    def read_blob(self, digest: str) -> Optional[str]:
+        """Attachment content stored under ``digest``, or None if it is missing."""
+        try:
+            with open(self.blob_path(digest), "r", encoding="utf-8", newline="") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def record_count(self, session_id: str) -> int:
+        """Number of records in a session's journal."""
+        try:
+            return self.index_path(session_id).stat().st_size // OFFSET.size
+        except OSError:
+            return 0
+
+    def record_counts(self) -> Dict[str, int]:
+        """Number of journal records of every session, from one directory scan."""
+        counts = {}
+        try:
+            entries = os.scandir(self.root)
+        except OSError:
+            return counts
+        with entries:
+            for entry in entries:
+                if entry.name.endswith(".idx"):
+                    try:
+                        counts[entry.name[:-4]] = entry.stat().st_size // OFFSET.size
+                    except OSError:
+                        continue
+        return counts
+
+    def list(self) -> List[Dict[str, Any]]:
+        """Metadata of all sessions, most recently updated first."""
+        if not self.meta_dir.exists():
+            return []
+        sessions = []
+        for path in self.meta_dir.glob("*.json"):
+            meta = self.get_meta(path.stem)
+            if meta is not None:
+                meta["records"] = self.record_count(meta["id"])
+                sessions.append(meta)
+        return sorted(sessions, key=lambda meta: meta["updated"], reverse=True)
+
+    def resolve(self, session_id: str) -> Optional[str]:
+        """Resolve ``last`` or a unique id prefix to a full session id."""
+        sessions = self.list()
+        if session_id == "last":
+            return sessions[0]["id"] if sessions else None
+        matches = [meta["id"] for meta in sessions if meta["id"].startswith(session_id)]
+        return matches[0] if len(matches) == 1 else None
+
+    def _read_records(self, start: int, end: int, total: int, offsets_file, data_file) -> List[Dict[str, Any]]:
+        """Read records ``start`` to ``end`` (exclusive) of ``total`` with one contiguous read."""
+        offsets_file.seek(start * OFFSET.size)
+        first = OFFSET.unpack(offsets_file.read(OFFSET.size))[0]
+        if end < total:
+            offsets_file.seek(end * OFFSET.size)
+            stop = OFFSET.unpack(offsets_file.read(OFFSET.size))[0]
+        else:
+            stop = None
+        data_file.seek(first)
+        data = data_file.read() if stop is None else data_file.read(stop - first)
+        records = []
+        for line in data.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Torn write from a crash; the record never made it to disk
+                continue
+        return records
+
+    def read_records(self, session_id: str, start: int = 0, end: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Parse journal records ``start`` to ``end`` (exclusive; default: to the last one)."""
+        total = self.record_count(session_id)
+        end = total if end is None else min(end, total)
+        if start >= end:
+            return []
+        with open(self.index_path(session_id), "rb") as offsets_file, \
+                open(self.journal_path(session_id), "rb") as data_file:
+            return self._read_records(start, end, total, offsets_file, data_file)
+
+    def load(self, session_id: str, conversation: Conversation, max_messages: int = 0):
+        """Restore a session into ``conversation``, reading the journal from the end.
+
+        Records are read backwards in batches through the offset index, so
+        only the tail that is actually restored gets parsed.
+
+        Args:
+            session_id: Session to restore
+            conversation: Conversation to fill (its journal is not written to)
+            max_messages: Restore at most this many of the latest messages;
+                0 restores the whole session
+        """
+        meta = self.get_meta(session_id) or {}
+        total = self.record_count(session_id)
+        messages: List[Dict[str, str]] = []
+        system_message = None
+        truncated = None
+        pops = 0
+        done = False
+
+        with open(self.index_path(session_id), "rb") as offsets_file, \
+                open(self.journal_path(session_id), "rb") as data_file:
+            end = total
+            while end > 0 and not done:
+                start = max(end - _READ_BATCH, 0)
+                records = self._read_records(start, end, total, offsets_file, data_file)
+                for record in reversed(records):
+                    kind = record.get("type")
+                    if kind == "clear":
+                        done = True
+                        break
+                    if kind == "system":
+                        if system_message is None:
+                            system_message = record["content"]
+                    elif kind == "pop":
+                        pops += 1
+                    elif kind == "message":
+                        if pops:
+                            pops -= 1
+                            continue
+                        messages.append({"role": record["role"], "content": record["content"]})
+                        if truncated is None:
+                            truncated = bool(record.get("truncated"))
+                        if max_messages and len(messages) >= max_messages:
+                            done = True
+                            break
+                end = start
+
+        messages.reverse()
+        # Restoring must not be journaled again
+        journal, conversation.journal = conversation.journal, None
+        conversation.clear()
+        for path in list(conversation.attachments):
+            conversation.detach(path)
+        for path, digest in meta.get("attachments", {}).items():
+            content = self.read_blob(digest)
+            if content is not None:
+                conversation.attach(path, digest, content)
+        conversation.journal = journal
+        conversation.replace_messages(messages)
+        conversation.truncated = bool(truncated)
+        # The latest system message is also kept in the metadata, so it is
+        # known even when the record setting it is older than the tail read.
+        conversation.system_message = system_message or meta.get("system_message") or conversation.system_message
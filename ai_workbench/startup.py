@@ -0,0 +1,77 @@
+"""Import-time profiling for the ``--profile-startup`` flag."""
+
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+
+def _run_importtime(statement: str) -> Tuple[List[Tuple[str, int, int]], float]:
+    """Run ``statement`` in a fresh interpreter with ``-X importtime``.
+    
+    A fresh process is used so the numbers are not hidden by modules the
+    current process has already imported.
+    
+    Returns:
+        A list of ``(module, self_us, cumulative_us)`` tuples in import order,
+        and the wall-clock time of the whole child process in milliseconds
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+    
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3:
+            continue
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            # Column header line
+            continue
+        timings.append((fields[2].strip(), self_us, cumulative_us))
+    return timings, wall_ms
+
+
+def profile_startup(provider_module: str = None) -> Dict[str, object]:
+    """Profile the imports needed to start the CLI and, optionally, a provider.
+    
+    Args:
+        provider_module: Module of the provider that would be loaded, e.g.
+            ``ai_workbench.providers.openai_provider``
+        
+    Returns:
+        A dict with the cumulative import time of the CLI and the provider
+        (in ms), the child process wall time and a per-package breakdown of
+        self time sorted from slowest to fastest
+    """
+    statement = "import ai_workbench.cli"
+    if provider_module:
+        statement += f"; import {provider_module}"
+    timings, wall_ms = _run_importtime(statement)
+    
+    cumulative = {name: cumulative_us for name, _, cumulative_us in timings}
+    packages: Dict[str, int] = {}
+    for name, self_us, _ in timings:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    
+    return {
+        "cli_ms": cumulative.get("ai_workbench.cli", 0) / 1000,
+        "provider_ms": cumulative.get(provider_module, 0) / 1000 if provider_module else 0.0,
+        "total_ms": sum(self_us for _, self_us, _ in timings) / 1000,
+        "wall_ms": wall_ms,
+        "packages": sorted(
+            ((package, us / 1000) for package, us in packages.items()),
+            key=lambda item: item[1],
+            reverse=True,
+        ),
+    }
@@ -0,0 +1,450 @@
+"""Per-request latency telemetry.
+
+``InstrumentedProvider`` times every request made through it: connection
+setup, time to response headers, time to first token, the gaps between
+chunks, the time the caller spent between chunks (rendering), and the
+token usage the provider reports. Requests are kept in memory for
+``/stats`` and can be appended to a JSONL file and exported as a
+Prometheus textfile.
+
+Lower layers report into the request in flight through a context
+variable: the pooled HTTP clients attach an httpx ``trace`` callback for
+connection timings, and providers call ``report_usage`` with the token
+counts from the API response, including how much of the prompt was read
+from or written to the provider's prompt cache.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from ai_workbench.providers import AIProvider, ProviderWrapper
+
+# Upper bounds (seconds) of the inter-chunk gap histogram; the last bucket is +Inf
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Upper bounds (seconds) of the first-token and duration histograms
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Requests kept in memory for /stats
+_HISTORY = 5000
+
+# The request currently being made in this context, if it is instrumented
+_active: ContextVar[Optional["RequestMetrics"]] = ContextVar("awb_active_request", default=None)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of ``values`` (``q`` between 0 and 1)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def _bucket(value: float, bounds: Tuple[float, ...]) -> int:
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            return i
+    return len(bounds)
+
+
+def report_usage(input_tokens: Optional[int] = None, output_tokens: Optional[int] = None,
+                 cache_read_tokens: Optional[int] = None, cache_write_tokens: Optional[int] = None):
+    """Record provider-reported token usage on the request in flight.
+    
+    ``input_tokens`` is the whole prompt; ``cache_read_tokens`` and
+    ``cache_write_tokens`` are the parts of it read from and written to the
+    provider's prompt cache.
+    """
+    metrics = _active.get()
+    if metrics is None:
+        return
+    if input_tokens is not None:
+        metrics.input_tokens = input_tokens
+    if output_tokens is not None:
+        metrics.output_tokens = output_tokens
+    if cache_read_tokens is not None:
+        metrics.cache_read_tokens = cache_read_tokens
+    if cache_write_tokens is not None:
+        metrics.cache_write_tokens = cache_write_tokens
+
+
+def _on_trace(event: str, info: Dict[str, Any]):
+    metrics = _active.get()
+    if metrics is None:
+        return
+    now = time.perf_counter()
+    if event == "connection.connect_tcp.started" and metrics._connect_start is None:
+        metrics._connect_start = now
+    elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+        if metrics._connect_start is not None:
+            metrics.connect_ms = (now - metrics._connect_start) * 1000
+    elif event.endswith(".receive_response_headers.complete") and metrics.headers_ms is None:
+        metrics.headers_ms = (now - metrics._start) * 1000
+
+
+def _trace(event: str, info: Dict[str, Any]):
+    _on_trace(event, info)
+
+
+async def _atrace(event: str, info: Dict[str, Any]):
+    _on_trace(event, info)
+
+
+def _request_hook(request):
+    if _active.get() is not None:
+        request.extensions["trace"] = _trace
+
+
+async def _arequest_hook(request):
+    if _active.get() is not None:
+        request.extensions["trace"] = _atrace
+
+
+def http_event_hooks(is_async: bool) -> Dict[str, list]:
+    """Event hooks that let pooled HTTP clients report connection timings."""
+    return {"request": [_arequest_hook if is_async else _request_hook], "response": []}
+
+
+class RequestMetrics:
+    """Timings and counts of a single request."""
+
+    def __init__(self, provider: str, model: str, mode: str):
+        self.timestamp = time.time()
+        self.provider = provider
+        self.model = model
+        self.mode = mode
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.cached = False
+        # None when an existing connection was reused
+        self.connect_ms: Optional[float] = None
+        self.headers_ms: Optional[float] = None
+        self.ttft_ms: Optional[float] = None
+        self.duration_ms = 0.0
+        # Time the caller spent between chunks, i.e. rendering
+        self.consumer_ms = 0.0
+        self.chunks = 0
+        self.chars = 0
+        self.gaps = [0] * (len(GAP_BUCKETS) + 1)
+        self.max_gap_ms = 0.0
+        self.input_tokens: Optional[int] = None
+        self.output_tokens: Optional[int] = None
+        # Prompt tokens served from / stored in the provider's prompt cache
+        self.cache_read_tokens: Optional[int] = None
+        self.cache_write_tokens: Optional[int] = None
+        self._start = time.perf_counter()
+        self._connect_start: Optional[float] = None
+
+    def chunk(self, text: str, waited: float):
+        """Record a chunk that took ``waited`` seconds to arrive."""
+        if self.chunks == 0:
+            self.ttft_ms = (time.perf_counter() - self._start) * 1000
+        else:
+            self.gaps[_bucket(waited, GAP_BUCKETS)] += 1
+            self.max_gap_ms = max(self.max_gap_ms, waited * 1000)
+        self.chunks += 1
+        self.chars += len(text)
+
+    def finish(self, status: str = "ok", error: Optional[BaseException] = None):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        self.status = status
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {key: value for key, value in vars(self).items() if not key.startswith("_")}
+        for key in ("connect_ms", "headers_ms", "ttft_ms", "duration_ms", "consumer_ms", "max_gap_ms"):
+            if data[key] is not None:
+                data[key] = round(data[key], 2)
+        return data
+
+
+class _Histogram:
+    """Cumulative histogram in the Prometheus sense."""
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float, count: int = 1):
+        self.counts[_bucket(value, self.bounds)] += count
+        self.sum += value * count
+
+
+class Telemetry:
+    """Collects request metrics and exports them.
+
+    Args:
+        metrics_file: Append every request as a JSON line to this file
+        prometheus_file: Rewrite this Prometheus textfile after every request
+    """
+
+    def __init__(self, metrics_file: Optional[Path] = None, prometheus_file: Optional[Path] = None):
+        self.metrics_file = Path(metrics_file).expanduser() if metrics_file else None
+        self.prometheus_file = Path(prometheus_file).expanduser() if prometheus_file else None
+        self.requests: Deque[RequestMetrics] = deque(maxlen=_HISTORY)
+        self._lock = threading.Lock()
+        # All-time aggregates per (provider, model) for the Prometheus export
+        self._totals: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Called with every recorded request, e.g. to feed model routing
+        self.listeners: List[Callable[[RequestMetrics], None]] = []
+
+    def record(self, metrics: RequestMetrics):
+        """Store a finished request and write it to the configured outputs."""
+        with self._lock:
+            self.requests.append(metrics)
+            self._aggregate(metrics)
+            if self.metrics_file is not None:
+                self.metrics_file.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.metrics_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(metrics.to_dict(), ensure_ascii=False) + "\n")
+            if self.prometheus_file is not None:
+                self._write_prometheus()
+        for listener in self.listeners:
+            listener(metrics)
+
+    def _aggregate(self, metrics: RequestMetrics):
+        totals = self._totals.get((metrics.provider, metrics.model))
+        if totals is None:
+            totals = {
+                "requests": {},
+                "cached": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "cache_read_tokens": 0,
+                "cache_write_tokens": 0,
+                "chars": 0,
+                "ttft": _Histogram(LATENCY_BUCKETS),
+                "duration": _Histogram(LATENCY_BUCKETS),
+                "gap": _Histogram(GAP_BUCKETS),
+            }
+            self._totals[(metrics.provider, metrics.model)] = totals
+        totals["requests"][metrics.status] = totals["requests"].get(metrics.status, 0) + 1
+        totals["cached"] += metrics.cached
+        totals["input_tokens"] += metrics.input_tokens or 0
+        totals["output_tokens"] += metrics.output_tokens or 0
+        totals["cache_read_tokens"] += metrics.cache_read_tokens or 0
+        totals["cache_write_tokens"] += metrics.cache_write_tokens or 0
+        totals["chars"] += metrics.chars
+        if metrics.status != "ok":
+            return
+        totals["duration"].observe(metrics.duration_ms / 1000)
+        if metrics.ttft_ms is not None:
+            totals["ttft"].observe(metrics.ttft_ms / 1000)
+        # Gaps are only kept as bucket counts; each is observed at its bucket's bound
+        for i, count in enumerate(metrics.gaps):
+            if count:
+                bound = GAP_BUCKETS[i] if i < len(GAP_BUCKETS) else GAP_BUCKETS[-1]
+                totals["gap"].observe(bound, count)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Per provider and model statistics of the requests in memory."""
+        groups: Dict[Tuple[str, str], List[RequestMetrics]] = {}
+        with self._lock:
+            for metrics in self.requests:
+                groups.setdefault((metrics.provider, metrics.model), []).append(metrics)
+
+        rows = []
+        for (provider, model), requests in groups.items():
+            ok = [m for m in requests if m.status == "ok"]
+            live = [m for m in ok if not m.cached]
+            gaps = [0] * (len(GAP_BUCKETS) + 1)
+            for m in ok:
+                gaps = [a + b for a, b in zip(gaps, m.gaps)]
+            stream_seconds = sum(m.duration_ms for m in live if m.mode == "stream") / 1000
+            rows.append({
+                "provider": provider,
+                "model": model,
+                "requests": len(requests),
+                "errors": sum(m.status == "error" for m in requests),
+                "cancelled": sum(m.status == "cancelled" for m in requests),
+                "cached": sum(m.cached for m in requests),
+                "connect_ms": [m.connect_ms for m in live if m.connect_ms is not None],
+                "headers_ms": [m.headers_ms for m in live if m.headers_ms is not None],
+                "ttft_ms": [m.ttft_ms for m in live if m.ttft_ms is not None],
+                "duration_ms": [m.duration_ms for m in live],
+                "consumer_ms": [m.consumer_ms for m in ok if m.mode == "stream"],
+                "gaps": gaps,
+                "max_gap_ms": max((m.max_gap_ms for m in ok), default=0.0),
+                "input_tokens": sum(m.input_tokens or 0 for m in requests),
+                "output_tokens": sum(m.output_tokens or 0 for m in requests),
+                "cache_read_tokens": sum(m.cache_read_tokens or 0 for m in requests),
+                "cache_write_tokens": sum(m.cache_write_tokens or 0 for m in requests),
+                # Requests that reported prompt cache usage at all
+                "cache_reported": sum(m.cache_read_tokens is not None for m in requests),
+                "chars_per_second": sum(m.chars for m in live if m.mode == "stream") / stream_seconds
+                if stream_seconds else None,
+            })
+        return sorted(rows, key=lambda row: -row["requests"])
+
+    def prometheus_text(self) -> str:
+        """All-time aggregates in the Prometheus text exposition format."""
+        lines = []
+
+        def header(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def labels(provider: str, model: str, **extra) -> str:
+            pairs = {"provider": provider, "model": model, **extra}
+            return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs.items()) + "}"
+
+        header("awb_requests_total", "counter", "Requests by outcome")
+        for (provider, model), totals in self._totals.items():
+            for status, count in sorted(totals["requests"].items()):
+                lines.append(f"awb_requests_total{labels(provider, model, status=status)} {count}")
+        header("awb_cached_requests_total", "counter", "Requests answered from the response cache")
+        for (provider, model), totals in self._totals.items():
+            lines.append(f"awb_cached_requests_total{labels(provider, model)} {totals['cached']}")
+        header("awb_tokens_total", "counter", "Provider-reported token usage")
+        for (provider, model), totals in self._totals.items():
+            lines.append(f"awb_tokens_total{labels(provider, model, direction='input')} {totals['input_tokens']}")
+            lines.append(f"awb_tokens_total{labels(provider, model, direction='output')} {totals['output_tokens']}")
+        header("awb_prompt_cache_tokens_total", "counter", "Prompt tokens read from or written to the provider's prompt cache")
+        for (provider, model), totals in self._totals.items():
+            lines.append(f"awb_prompt_cache_tokens_total{labels(provider, model, kind='read')} {totals['cache_read_tokens']}")
+            lines.append(f"awb_prompt_cache_tokens_total{labels(provider, model, kind='write')} {totals['cache_write_tokens']}")
+        header("awb_response_chars_total", "counter", "Characters received")
+        for (provider, model), totals in self._totals.items():
+            lines.append(f"awb_response_chars_total{labels(provider, model)} {totals['chars']}")
+
+        for key, name, help_text in (
+            ("ttft", "awb_time_to_first_token_seconds", "Time from request to first chunk"),
+            ("duration", "awb_request_duration_seconds", "Time from request to last chunk"),
+            ("gap", "awb_chunk_gap_seconds", "Time between consecutive chunks"),
+        ):
+            header(name, "histogram", help_text)
+            for (provider, model), totals in self._totals.items():
+                histogram = totals[key]
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{labels(provider, model, le=le)} {cumulative}")
+                lines.append(f"{name}_sum{labels(provider, model)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{labels(provider, model)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def _write_prometheus(self):
+        # Written atomically so a node exporter never reads a partial file
+        self.prometheus_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.prometheus_file.with_name(f".{self.prometheus_file.name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, self.prometheus_file)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class InstrumentedProvider(ProviderWrapper):
+    """Provider wrapper that records metrics of every request in ``telemetry``."""
+
+    def __init__(self, provider: AIProvider, telemetry: Telemetry):
+        super().__init__(provider)
+        self.telemetry = telemetry
+
+    def _start(self, mode: str) -> RequestMetrics:
+        return RequestMetrics(self.provider.name, self.provider.model, mode)
+
+    def _finish(self, metrics: RequestMetrics, status: str = "ok", error: Optional[BaseException] = None):
+        metrics.finish(status, error)
+        metrics.cached = bool(getattr(self.provider, "last_hit", False))
+        self.telemetry.record(metrics)
+
+    def generate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Generate a response, recording its metrics."""
+        metrics = self._start("response")
+        token = _active.set(metrics)
+        try:
+            response = self.provider.generate_response(messages, **kwargs)
+        except BaseException as e:
+            self._finish(metrics, "error" if isinstance(e, Exception) else "cancelled", e)
+            raise
+        finally:
+            _active.reset(token)
+        metrics.chunk(response or "", 0.0)
+        self._finish(metrics)
+        return response
+
+    def generate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Generate a streaming response, recording its metrics."""
+        metrics = self._start("stream")
+        status, error = "ok", None
+        try:
+            iterator = iter(self.provider.generate_stream(messages, **kwargs))
+            while True:
+                # The context is set around each step only, so lower layers
+                # see this request however the stream is driven
+                token = _active.set(metrics)
+                waiting = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    _active.reset(token)
+                received = time.perf_counter()
+                metrics.chunk(chunk, received - waiting)
+                yield chunk
+                metrics.consumer_ms += (time.perf_counter() - received) * 1000
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        except BaseException as e:
+            status, error = ("error" if isinstance(e, Exception) else "cancelled"), e
+            raise
+        finally:
+            self._finish(metrics, status, error)
+
+    async def agenerate_response(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """Asynchronously generate a response, recording its metrics."""
+        metrics = self._start("response")
+        token = _active.set(metrics)
+        try:
+            response = await self.provider.agenerate_response(messages, **kwargs)
+        except BaseException as e:
+            self._finish(metrics, "error" if isinstance(e, Exception) else "cancelled", e)
+            raise
+        finally:
+            _active.reset(token)
+        metrics.chunk(response or "", 0.0)
+        self._finish(metrics)
+        return response
+
+    async def agenerate_stream(self, messages: List[Dict[str, str]], **kwargs):
+        """Asynchronously generate a streaming response, recording its metrics."""
+        metrics = self._start("stream")
+        status, error = "ok", None
+        stream = self.provider.agenerate_stream(messages, **kwargs)
+        try:
+            while True:
+                token = _active.set(metrics)
+                waiting = time.perf_counter()
+                try:
+                    chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    _active.reset(token)
+                received = time.perf_counter()
+                metrics.chunk(chunk, received - waiting)
+                yield chunk
+                metrics.consumer_ms += (time.perf_counter() - received) * 1000
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        except BaseException as e:
+            status, error = ("error" if isinstance(e, Exception) else "cancelled"), e
+            raise
+        finally:
+            self._finish(metrics, status, error)
+            await stream.aclose()
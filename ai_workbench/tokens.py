@@ -0,0 +1,61 @@
+"""Offline token estimation for conversation messages."""
+
+import functools
+from typing import Dict
+
+# Rough characters-per-token ratios for English text and code, used when no
+# exact tokenizer is available for a provider.
+CHARS_PER_TOKEN = {
+    "openai": 4.0,
+    "anthropic": 3.5,
+    "google": 4.0,
+}
+
+# Tokens added per message for role markers and separators
+MESSAGE_OVERHEAD = 4
+
+
+class TokenEstimator:
+    """Estimate token counts for a provider/model without calling the API.
+    
+    OpenAI models use ``tiktoken`` when it is installed; everything else uses
+    a characters-per-token heuristic, which is O(1) per message.
+    """
+    
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.key = f"{provider}:{model}"
+        self.chars_per_token = CHARS_PER_TOKEN.get(provider, 4.0)
+        self._encoding = self._load_encoding() if provider == "openai" else None
+    
+    def _load_encoding(self):
+        try:
+            import tiktoken
+        except ImportError:
+            return None
+        try:
+            return tiktoken.encoding_for_model(self.model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    
+    @property
+    def exact(self) -> bool:
+        """Whether counts come from the model's real tokenizer."""
+        return self._encoding is not None
+    
+    def count(self, text: str) -> int:
+        """Estimate the number of tokens in ``text``."""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return int(len(text) / self.chars_per_token) + 1
+    
+    def count_message(self, message: Dict[str, str]) -> int:
+        """Estimate the tokens a message adds to a request, including overhead."""
+        return self.count(message["content"]) + MESSAGE_OVERHEAD
+
+
+@functools.lru_cache(maxsize=None)
+def get_estimator(provider: str, model: str) -> TokenEstimator:
+    """Return the shared estimator for a provider/model."""
+    return TokenEstimator(provider, model)
@@ -0,0 +1,368 @@
+"""Local stand-ins for the OpenAI and Anthropic HTTP APIs.
+
+The server answers ``POST /v1/chat/completions`` (OpenAI) and
+``POST /v1/messages`` (Anthropic), streamed as server-sent events or as a
+single JSON body, with configurable time-to-first-token, token rate and
+jitter. Point a provider at it with ``base_url``::
+
+    with MockServer(ttft=0.2, tokens_per_second=80) as server:
+        provider = OpenAIProvider("test-key", "gpt-4", base_url=server.openai_url)
+
+Every request body is recorded in ``server.requests`` so payloads can be
+checked afterwards.
+
+Prompt caching is emulated: OpenAI requests read the longest message
+prefix seen before from the cache (``prompt_tokens_details.cached_tokens``),
+and Anthropic requests read and write the prefixes ending at their
+``cache_control`` breakpoints (``cache_read_input_tokens`` and
+``cache_creation_input_tokens``). There is no minimum cacheable length. Faults can be queued for the next requests with
+``server.faults.append(...)``: ``{"status": 429, "retry_after": 1}``
+answers with an error, ``{"drop_after": 10}`` cuts a stream off after ten
+tokens, and ``{"error_after": 10, "error_type": "overloaded_error"}`` ends
+an Anthropic stream after ten tokens with an ``error`` event, as the API
+does when it is overloaded mid-stream.
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+
+class MockServer:
+    """Threaded HTTP server emulating the provider APIs.
+
+    Args:
+        ttft: Seconds before the first token is sent
+        tokens_per_second: Token rate after the first token; 0 sends as
+            fast as possible
+        jitter: Relative random variation of every delay (0.2 = +/-20%)
+        response_tokens: Number of tokens in every response
+        seed: Seed for the jitter, for repeatable runs
+    """
+
+    def __init__(self, ttft: float = 0.0, tokens_per_second: float = 0.0, jitter: float = 0.0,
+                 response_tokens: int = 200, seed: int = 0):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.jitter = jitter
+        self.response_tokens = response_tokens
+        self.requests: List[Dict[str, Any]] = []
+        self.faults: List[Dict[str, Any]] = []
+        # Hashes of the prompt prefixes in the emulated prompt cache
+        self.prompt_cache = set()
+        # Tokens streamed so far, and streams the client closed early
+        self.tokens_sent = 0
+        self.disconnects = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def openai_url(self) -> str:
+        return f"{self.url}/v1"
+
+    @property
+    def anthropic_url(self) -> str:
+        return self.url
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "MockServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def tokens(self) -> List[str]:
+        """The tokens of one response: Markdown-ish prose and a code block."""
+        words = []
+        for i in range(self.response_tokens):
+            if i % 50 == 25:
+                words.append("\n\n```python\nx = 1\n```\n\n")
+            elif i % 12 == 11:
+                words.append(f"word{i}.\n")
+            else:
+                words.append(f"word{i} ")
+        return words
+
+    def delay(self, seconds: float) -> float:
+        """Apply jitter to a delay."""
+        if seconds <= 0:
+            return 0.0
+        with self._lock:
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+        return max(seconds * factor, 0.0)
+
+    def cache_prompt(self, blocks: List[Any], breakpoints: List[int]) -> Tuple[int, int, int]:
+        """Look up and store prompt prefixes; return ``(total, read, written)`` tokens.
+        
+        ``blocks`` are the prompt's parts in order. The longest prefix ending
+        at one of ``breakpoints`` (indexes into ``blocks``) that is already
+        cached is read; prefixes ending at the breakpoints after it are
+        written.
+        """
+        digest = hashlib.sha256()
+        ends: Dict[int, Tuple[str, int]] = {}
+        tokens = 0
+        for i, block in enumerate(blocks):
+            text = json.dumps(block, sort_keys=True)
+            digest.update(text.encode("utf-8"))
+            tokens += len(text) // 4
+            ends[i] = (digest.copy().hexdigest(), tokens)
+        read = written = 0
+        with self._lock:
+            for i in breakpoints:
+                key, size = ends[i]
+                if key in self.prompt_cache:
+                    read = max(read, size)
+            for i in breakpoints:
+                key, size = ends[i]
+                if size > read and key not in self.prompt_cache:
+                    self.prompt_cache.add(key)
+                    written = max(written, size - read)
+        return tokens, read, written
+    
+    def record(self, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Record a request and return the fault to apply to it, if any."""
+        with self._lock:
+            self.requests.append({"path": path, "body": body, "time": time.time()})
+            return self.faults.pop(0) if self.faults else {}
+
+
+def _make_handler(server: MockServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            self._send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            fault = server.record(self.path, body)
+            self.drop_after = fault.get("drop_after")
+            self.error_after = fault.get("error_after")
+            self.fault_type = fault.get("error_type", "overloaded_error")
+            if "status" in fault:
+                headers = {}
+                if fault.get("retry_after") is not None:
+                    headers["Retry-After"] = str(fault["retry_after"])
+                self._send_json(fault["status"], {"error": {"type": "mock_fault", "message": "injected fault"}}, headers)
+                return
+            try:
+                if self.path.endswith("/chat/completions"):
+                    self._openai(body)
+                elif self.path.endswith("/messages"):
+                    self._anthropic(body)
+                else:
+                    self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            except OSError as e:
+                # Dropped on purpose, or the client went away mid-stream
+                self.close_connection = True
+                if not isinstance(e, ConnectionAbortedError):
+                    with server._lock:
+                        server.disconnects += 1
+
+        # -- transport helpers -------------------------------------------
+
+        def _send_json(self, status: int, data: Dict[str, Any], headers: Dict[str, str] = None):
+            payload = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _start_stream(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+        def _chunk(self, data: bytes):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def _end_stream(self):
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def _event(self, data: Dict[str, Any], event: str = None):
+            text = f"event: {event}\n" if event else ""
+            text += f"data: {json.dumps(data)}\n\n"
+            self._chunk(text.encode("utf-8"))
+
+        def _timed_tokens(self):
+            """Yield tokens at the configured pace."""
+            interval = 1.0 / server.tokens_per_second if server.tokens_per_second > 0 else 0.0
+            time.sleep(server.delay(server.ttft))
+            for i, token in enumerate(server.tokens()):
+                if self.error_after is not None and i >= self.error_after:
+                    return
+                if self.drop_after is not None and i >= self.drop_after:
+                    # Cut the connection mid-stream, without a final chunk
+                    self.close_connection = True
+                    self.wfile.flush()
+                    self.connection.shutdown(2)
+                    raise ConnectionAbortedError("stream dropped")
+                if i and interval:
+                    time.sleep(server.delay(interval))
+                with server._lock:
+                    server.tokens_sent += 1
+                yield token
+
+        def _anthropic_usage(self, body: Dict[str, Any]) -> Dict[str, int]:
+            """Usage of an Anthropic request, with its cache breakpoints applied."""
+            blocks, breakpoints = [], []
+            system = body.get("system") or []
+            for message in [{"content": system}] + body.get("messages", []):
+                content = message["content"]
+                if isinstance(content, str):
+                    content = [{"type": "text", "text": content}] if content else []
+                for block in content:
+                    # Breakpoints are not part of the cached prompt
+                    blocks.append({key: value for key, value in block.items() if key != "cache_control"})
+                    breakpoints.extend([len(blocks) - 1] if block.get("cache_control") else [])
+            total, read, written = server.cache_prompt(blocks, breakpoints)
+            return {
+                "input_tokens": total - read - written,
+                "cache_read_input_tokens": read,
+                "cache_creation_input_tokens": written,
+                "output_tokens": server.response_tokens,
+            }
+
+        # -- OpenAI --------------------------------------------------------
+
+        def _openai(self, body: Dict[str, Any]):
+            model = body.get("model", "gpt-4")
+            # Automatic prefix caching: any earlier message prefix matches
+            messages = body.get("messages", [])
+            prompt_tokens, cached, _ = server.cache_prompt(messages, list(range(len(messages))))
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": server.response_tokens,
+                "total_tokens": prompt_tokens + server.response_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached},
+            }
+            if not body.get("stream"):
+                text = "".join(self._timed_tokens())
+                self._send_json(200, {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+                return
+
+            def chunk(delta, finish_reason=None):
+                return {
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+
+            self._start_stream()
+            first = True
+            for token in self._timed_tokens():
+                delta = {"role": "assistant", "content": token} if first else {"content": token}
+                first = False
+                self._event(chunk(delta))
+            self._event(chunk({}, "stop"))
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._event({
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [],
+                    "usage": usage,
+                })
+            self._chunk(b"data: [DONE]\n\n")
+            self._end_stream()
+
+        # -- Anthropic -----------------------------------------------------
+
+        def _anthropic(self, body: Dict[str, Any]):
+            model = body.get("model", "claude")
+            usage = self._anthropic_usage(body)
+            if not body.get("stream"):
+                text = "".join(self._timed_tokens())
+                self._send_json(200, {
+                    "id": "msg_mock",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": model,
+                    "content": [{"type": "text", "text": text}],
+                    "stop_reason": "end_turn",
+                    "stop_sequence": None,
+                    "usage": usage,
+                })
+                return
+
+            self._start_stream()
+            self._event({
+                "type": "message_start",
+                "message": {
+                    "id": "msg_mock",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": model,
+                    "content": [],
+                    "stop_reason": None,
+                    "stop_sequence": None,
+                    "usage": dict(usage, output_tokens=1),
+                },
+            }, "message_start")
+            self._event({"type": "content_block_start", "index": 0,
+                         "content_block": {"type": "text", "text": ""}}, "content_block_start")
+            for token in self._timed_tokens():
+                self._event({"type": "content_block_delta", "index": 0,
+                             "delta": {"type": "text_delta", "text": token}}, "content_block_delta")
+            if self.error_after is not None:
+                self._event({"type": "error", "error": {"type": self.fault_type, "message": "injected fault"}}, "error")
+                self._end_stream()
+                return
+            self._event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+            self._event({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                         "usage": {"output_tokens": usage["output_tokens"]}}, "message_delta")
+            self._event({"type": "message_stop"}, "message_stop")
+            self._end_stream()
+
+    return Handler
@@ -0,0 +1,658 @@
+"""Offline performance benchmarks for AI Terminal Workbench.
+
+Runs the real provider clients against the local stand-in servers in
+``mock_server.py`` and measures the overhead the workbench itself adds.
+No API keys or network access are needed.
+
+Usage::
+
+    python -m benchmarks.run                         # all suites
+    python -m benchmarks.run --suite stream --suite render
+    python -m benchmarks.run -o results.json --compare baseline.json
+
+Every metric is written to the JSON results file with its unit and
+whether lower or higher is better. ``--compare`` flags metrics that got
+worse than a baseline file by more than ``--threshold`` percent and exits
+non-zero, so it can gate a release.
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from ai_workbench import __version__
+from benchmarks.mock_server import MockServer
+
+MESSAGES = [
+    {"role": "system", "content": "You are a benchmark."},
+    {"role": "user", "content": "Write a long answer."},
+]
+
+
+class Results:
+    """Collects metrics as ``name -> {value, unit, better}``."""
+
+    def __init__(self):
+        self.metrics: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, name: str, value: float, unit: str, better: str = "lower"):
+        self.metrics[name] = {"value": round(value, 3), "unit": unit, "better": better}
+        print(f"  {name:<48} {value:>12.3f} {unit}")
+
+
+def _make_provider(name: str, server: MockServer):
+    if name == "openai":
+        from ai_workbench.providers.openai_provider import OpenAIProvider
+        return OpenAIProvider("benchmark-key", "gpt-4", base_url=server.openai_url)
+    from ai_workbench.providers.anthropic_provider import AnthropicProvider
+    return AnthropicProvider("benchmark-key", "claude-3-5-sonnet-20241022", base_url=server.anthropic_url)
+
+
+def _raw_stream_seconds(provider, server: MockServer) -> float:
+    """Time to read the same stream as raw SSE lines, without the SDK or workbench."""
+    if provider.name == "openai":
+        url = f"{server.openai_url}/chat/completions"
+        body = {"model": provider.model, "messages": MESSAGES, "stream": True}
+    else:
+        url = f"{server.anthropic_url}/v1/messages"
+        body = {"model": provider.model, "messages": MESSAGES[1:], "max_tokens": 4096, "stream": True}
+    http = provider.client._client
+    start = time.perf_counter()
+    with http.stream("POST", url, json=body) as response:
+        for _ in response.iter_lines():
+            pass
+    return time.perf_counter() - start
+
+
+def _median(run: Callable[[], float], repeat: int) -> float:
+    return statistics.median(run() for _ in range(repeat))
+
+
+def bench_stream(results: Results, repeat: int):
+    """Per-chunk cost of generate_stream/agenerate_stream at unlimited token rate."""
+    tokens = 2000
+    with MockServer(response_tokens=tokens) as server:
+        for name in ("openai", "anthropic"):
+            provider = _make_provider(name, server)
+
+            def sync_run():
+                start = time.perf_counter()
+                for _ in provider.generate_stream(MESSAGES):
+                    pass
+                return time.perf_counter() - start
+
+            async def async_runs():
+                # One loop for every repetition: the pooled async client's
+                # connections belong to the loop that opened them
+                times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    async for _ in provider.agenerate_stream(MESSAGES):
+                        pass
+                    times.append(time.perf_counter() - start)
+                return times
+
+            raw = _median(lambda: _raw_stream_seconds(provider, server), repeat)
+            sync = _median(sync_run, repeat)
+            asynchronous = statistics.median(asyncio.run(async_runs()))
+            results.add(f"stream.{name}.raw_http_us_per_chunk", raw / tokens * 1e6, "us")
+            results.add(f"stream.{name}.sync_us_per_chunk", sync / tokens * 1e6, "us")
+            results.add(f"stream.{name}.async_us_per_chunk", asynchronous / tokens * 1e6, "us")
+            results.add(f"stream.{name}.sync_overhead_us_per_chunk", (sync - raw) / tokens * 1e6, "us")
+            results.add(f"stream.{name}.async_overhead_us_per_chunk", (asynchronous - raw) / tokens * 1e6, "us")
+
+
+def bench_throughput(results: Results, repeat: int):
+    """Achieved chunk rate and first-token overhead against a fast, paced server."""
+    rate = 2000
+    ttft = 0.05
+    tokens = 1000
+    with MockServer(ttft=ttft, tokens_per_second=rate, jitter=0.1, response_tokens=tokens) as server:
+        for name in ("openai", "anthropic"):
+            provider = _make_provider(name, server)
+
+            async def consume():
+                start = time.perf_counter()
+                first = None
+                async for _ in provider.agenerate_stream(MESSAGES):
+                    if first is None:
+                        first = time.perf_counter() - start
+                return first, time.perf_counter() - start
+
+            async def consume_all():
+                return [await consume() for _ in range(repeat)]
+
+            runs = asyncio.run(consume_all())
+            first = statistics.median(run[0] for run in runs)
+            total = statistics.median(run[1] for run in runs)
+            results.add(f"throughput.{name}.ttft_overhead_ms", (first - ttft) * 1000, "ms")
+            results.add(f"throughput.{name}.chunks_per_second", tokens / total, "chunks/s", better="higher")
+            results.add(f"throughput.{name}.rate_efficiency_pct", tokens / total / rate * 100, "%", better="higher")
+
+
+def bench_render(results: Results, repeat: int):
+    """Cost of the REPL's streaming render loop per chunk."""
+    from rich.console import Console
+    from ai_workbench.rendering import StreamRenderer
+
+    with MockServer(response_tokens=10000) as server:
+        chunks = server.tokens()
+
+    def run():
+        console = Console(file=io.StringIO(), force_terminal=True, width=100, height=40)
+        start = time.perf_counter()
+        with StreamRenderer(console, fps=15) as renderer:
+            for chunk in chunks:
+                renderer.feed(chunk)
+        return time.perf_counter() - start
+
+    elapsed = _median(run, repeat)
+    results.add("render.us_per_chunk", elapsed / len(chunks) * 1e6, "us")
+    results.add("render.total_ms_10k_chunks", elapsed * 1000, "ms")
+
+
+def bench_startup(results: Results, repeat: int):
+    """Wall time of a fresh interpreter importing the CLI and a provider, and of ``ask``."""
+    def spawn(statement: str) -> float:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        return time.perf_counter() - start
+
+    baseline = _median(lambda: spawn("pass"), repeat)
+    cli = _median(lambda: spawn("import ai_workbench.cli"), repeat)
+    provider = _median(lambda: spawn("import ai_workbench.cli, ai_workbench.providers.openai_provider"), repeat)
+    results.add("startup.interpreter_ms", baseline * 1000, "ms")
+    results.add("startup.cli_import_ms", (cli - baseline) * 1000, "ms")
+    results.add("startup.cli_and_openai_import_ms", (provider - baseline) * 1000, "ms")
+
+    # A whole `ai-workbench ask` in a pipeline, with a short streamed reply
+    import os
+    with MockServer(response_tokens=20) as server:
+        env = dict(os.environ, OPENAI_API_KEY="benchmark-key", OPENAI_BASE_URL=server.openai_url,
+                   AWB_CACHE="0", AWB_DAEMON="0")
+
+        def ask() -> float:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-m", "ai_workbench.cli", "ask", "-p", "openai", "hi"], env=env,
+                           stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, check=True)
+            return time.perf_counter() - start
+
+        results.add("startup.ask_pipe_ms", _median(ask, repeat) * 1000, "ms")
+
+
+def bench_memory(results: Results, repeat: int):
+    """Memory and per-turn preparation cost of a long conversation."""
+    from ai_workbench.context import ContextWindow
+    from ai_workbench.conversation import Conversation
+    from ai_workbench.providers.anthropic_provider import AnthropicProvider
+    from ai_workbench.tokens import get_estimator
+
+    # Formatting the request for the wire, without sending it
+    anthropic = AnthropicProvider("benchmark-key")
+
+    turns = 2000
+    reply = "Here is some code:\n```python\n" + "print('hello world')\n" * 40 + "```\n"
+    window = ContextWindow(get_estimator("anthropic", "claude"), 200000, 4096, policy="pin")
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    conversation = Conversation()
+    fit_times: List[float] = []
+    prep_times: List[float] = []
+    for i in range(turns):
+        conversation.add_user_message(f"Question {i}: how do I do thing {i}?")
+        start = time.perf_counter()
+        request = window.fit(conversation)
+        fit_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        anthropic._split_system(request)
+        prep_times.append(time.perf_counter() - start)
+        # A distinct string per turn, as real replies would be
+        conversation.add_assistant_message(reply + str(i))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    payload = sum(len(m["content"]) for m in conversation.messages)
+    results.add("memory.bytes_per_turn", (after - before) / turns, "bytes")
+    results.add("memory.overhead_ratio", (after - before) / payload, "x")
+    results.add("memory.fit_us_last_100_turns", statistics.mean(fit_times[-100:]) * 1e6, "us")
+    results.add("memory.anthropic_prep_us_last_100_turns", statistics.mean(prep_times[-100:]) * 1e6, "us")
+
+    calls = 200
+    start = time.perf_counter()
+    for _ in range(calls):
+        conversation.get_messages()
+    results.add("memory.get_messages_us", (time.perf_counter() - start) / calls * 1e6, "us")
+
+    # A session far longer than the context window: what is held of the
+    # turns that fell out of it, with the tiered store's defaults and with
+    # every message kept as is
+    import random
+    from ai_workbench.memory import MessageStore
+
+    rng = random.Random(0)
+    vocabulary = [f"{word}{i}" for i in range(400) for word in ("token", "frame", "value")]
+    replies = [" ".join(rng.choices(vocabulary, k=300)) for _ in range(50)]
+    for name, store in (("tiered", MessageStore()), ("flat", MessageStore(hot_bytes=sys.maxsize))):
+        anthropic = AnthropicProvider("benchmark-key")
+        window = ContextWindow(get_estimator("anthropic", "claude"), 32000, 4096, policy="pin")
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        conversation = Conversation(store)
+        turn_times = []
+        for i in range(5000):
+            conversation.add_user_message(f"Question {i}: what does frame {i} hold?")
+            start = time.perf_counter()
+            anthropic._split_system(window.fit(conversation))
+            turn_times.append(time.perf_counter() - start)
+            conversation.add_assistant_message(f"{replies[i % len(replies)]} {i}")
+        held = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        results.add(f"memory.{name}_bytes_per_turn_long_session", held / 5000, "bytes")
+        results.add(f"memory.{name}_turn_us_last_100_turns", statistics.mean(turn_times[-100:]) * 1e6, "us")
+
+
+def bench_cache(results: Results, repeat: int):
+    """Share of the prompt read from the provider's prompt cache over a long session.
+    
+    The conversation outgrows a small context window, so history is dropped
+    along the way. Run with the workbench's cache-friendly layout and
+    without it.
+    """
+    from ai_workbench.context import ContextWindow
+    from ai_workbench.conversation import Conversation
+    from ai_workbench.telemetry import InstrumentedProvider, Telemetry
+    from ai_workbench.tokens import get_estimator
+
+    turns = 40
+    for name in ("openai", "anthropic"):
+        for label, prompt_cache, slack in (("read_pct", True, 0.2), ("read_pct_uncached_layout", False, 0.0)):
+            with MockServer(response_tokens=60) as server:
+                provider = _make_provider(name, server)
+                provider.prompt_cache = prompt_cache
+                telemetry = Telemetry()
+                instrumented = InstrumentedProvider(provider, telemetry)
+                window = ContextWindow(get_estimator(name, provider.model), 6000, 1000, policy="pin", slack=slack)
+                conversation = Conversation()
+                conversation.add_user_message("Here is my file:\n" + "def f(x):\n    return x\n" * 200)
+                for i in range(turns):
+                    reply = instrumented.generate_response(window.fit(conversation))
+                    conversation.add_assistant_message(reply)
+                    conversation.add_user_message(f"Question {i}: what about case {i}?")
+            row = telemetry.summary()[0]
+            results.add(f"cache.{name}.{label}", row["cache_read_tokens"] / row["input_tokens"] * 100, "%",
+                        better="higher")
+
+
+def bench_search(results: Results, repeat: int):
+    """Indexed search over many saved sessions against scanning their journals."""
+    import random
+    import tempfile
+    from pathlib import Path
+    from ai_workbench.conversation import Conversation
+    from ai_workbench.search import SearchIndex
+    from ai_workbench.sessions import SessionStore
+
+    sessions, turns = 300, 20
+    words = [f"term{i}" for i in range(5000)]
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as root:
+        store = SessionStore(Path(root) / "sessions")
+        for _ in range(sessions):
+            conversation = Conversation()
+            conversation.journal = store.open_journal(store.create("openai", "gpt-4", "benchmark"))
+            for _ in range(turns):
+                conversation.add_user_message(" ".join(rng.choices(words, k=30)))
+                conversation.add_assistant_message(" ".join(rng.choices(words, k=300)))
+            conversation.journal.close()
+        index = SearchIndex(Path(root) / "search.sqlite3", store)
+
+        start = time.perf_counter()
+        index.refresh()
+        results.add("search.build_ms", (time.perf_counter() - start) * 1000, "ms")
+        query = "term17 term4242"
+        results.add("search.query_ms", _median(lambda: _timed(lambda: index.search(query)), repeat) * 1000, "ms")
+
+        def grep():
+            for path in store.root.glob("*.jsonl"):
+                with open(path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        record = json.loads(line)
+                        if all(word in record.get("content", "") for word in query.split()):
+                            pass
+        results.add("search.scan_journals_ms", _median(lambda: _timed(grep), repeat) * 1000, "ms")
+
+        # One new message in one session, then a search
+        conversation = Conversation()
+        conversation.journal = store.open_journal(store.list()[-1]["id"])
+        conversation.add_user_message("term17 term4242 again")
+        conversation.journal.close()
+        start = time.perf_counter()
+        index.search(query)
+        results.add("search.query_after_new_message_ms", (time.perf_counter() - start) * 1000, "ms")
+        index.close()
+
+
+def bench_cancel(results: Results, repeat: int):
+    """Cancelling a long streamed reply partway through.
+
+    Measures the time until the cancelled task is done, the time until the
+    server sees the connection closed, and how many tokens it streamed
+    after the cancellation.
+    """
+    from ai_workbench.resilience import ResilientProvider
+    from ai_workbench.telemetry import InstrumentedProvider, Telemetry
+
+    async def cancel_once(provider, server: MockServer):
+        received: List[str] = []
+
+        async def consume():
+            async for chunk in provider.agenerate_stream(MESSAGES):
+                received.append(chunk)
+
+        disconnects = server.disconnects
+        task = asyncio.ensure_future(consume())
+        while len(received) < 20:
+            await asyncio.sleep(0.001)
+        start = time.perf_counter()
+        sent = server.tokens_sent
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        done = time.perf_counter() - start
+        while server.disconnects == disconnects and time.perf_counter() - start < 5:
+            await asyncio.sleep(0.001)
+        return done, time.perf_counter() - start, server.tokens_sent - sent
+
+    async def run(provider, server: MockServer):
+        return [await cancel_once(provider, server) for _ in range(repeat)]
+
+    for name in ("openai", "anthropic"):
+        with MockServer(tokens_per_second=500, response_tokens=5000) as server:
+            provider = InstrumentedProvider(ResilientProvider(_make_provider(name, server)), Telemetry())
+            runs = asyncio.run(run(provider, server))
+        results.add(f"cancel.{name}.task_done_ms", statistics.median(r[0] for r in runs) * 1000, "ms")
+        results.add(f"cancel.{name}.server_stopped_ms", statistics.median(r[1] for r in runs) * 1000, "ms")
+        results.add(f"cancel.{name}.tokens_after_cancel", statistics.median(r[2] for r in runs), "tokens")
+
+
+def bench_resume(results: Results, repeat: int):
+    """Recovering a stream that Anthropic ends with an ``overloaded_error`` event.
+
+    The error arrives after the stream started with a 200 response; the
+    resilience layer retries it and resumes the reply by prefilling what
+    was received. Measures the time to the complete reply against an
+    undisturbed stream (with no backoff delay), and the requests made.
+    """
+    from ai_workbench.resilience import ResilientProvider
+
+    with MockServer(response_tokens=400) as server:
+        provider = ResilientProvider(_make_provider("anthropic", server), base_delay=0.0)
+
+        def run(fault: Dict[str, Any]) -> float:
+            if fault:
+                server.faults.append(fault)
+            start = time.perf_counter()
+            for _ in provider.generate_stream(MESSAGES):
+                pass
+            return time.perf_counter() - start
+
+        clean = _median(lambda: run({}), repeat)
+        sent = len(server.requests)
+        faulty = _median(lambda: run({"error_after": 200, "error_type": "overloaded_error"}), repeat)
+        requests = (len(server.requests) - sent) / repeat
+    results.add("resume.anthropic.overloaded_extra_ms", (faulty - clean) * 1000, "ms")
+    results.add("resume.anthropic.overloaded_requests", requests, "requests")
+
+
+def bench_attach(results: Results, repeat: int):
+    """Attaching a source tree, re-attaching it every turn, and fitting requests with it."""
+    import os
+    from ai_workbench.attachments import collect
+    from ai_workbench.context import ContextWindow
+    from ai_workbench.conversation import Conversation
+    from ai_workbench.tokens import get_estimator
+
+    tree = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    patterns = [os.path.join(tree, "ai_workbench"), os.path.join(tree, "benchmarks")]
+    window = ContextWindow(get_estimator("anthropic", "claude"), 200000, 4096, policy="pin")
+
+    def attach(conversation: Conversation):
+        for path, digest, text, size in collect(patterns, conversation.blobs, 1 << 20, 1 << 30)["files"]:
+            conversation.attach(path, digest, text if text is not None else conversation.blobs[digest])
+
+    turns = 20
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    conversation = Conversation()
+    start = time.perf_counter()
+    attach(conversation)
+    results.add("attach.first_ms", (time.perf_counter() - start) * 1000, "ms")
+    reattach_times: List[float] = []
+    fit_times: List[float] = []
+    for i in range(turns):
+        conversation.add_user_message(f"Question {i} about the code")
+        start = time.perf_counter()
+        window.fit(conversation)
+        fit_times.append(time.perf_counter() - start)
+        conversation.add_assistant_message(f"Answer {i}")
+        # The user attaches the same tree again
+        start = time.perf_counter()
+        attach(conversation)
+        reattach_times.append(time.perf_counter() - start)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    payload = sum(len(content) for content in conversation.blobs.values())
+    results.add("attach.files", len(conversation.attachments), "files", better="higher")
+    results.add("attach.memory_ratio", (after - before) / payload, "x")
+    results.add("attach.reattach_unchanged_ms", statistics.median(reattach_times) * 1000, "ms")
+    results.add("attach.fit_us", statistics.median(fit_times[1:]) * 1e6, "us")
+
+
+def bench_daemon(results: Results, repeat: int):
+    """A fresh process's first request, made locally and through the shared daemon."""
+    import os
+    import tempfile
+
+    statement = ("from ai_workbench import cli; "
+                 "cli.get_provider('openai', 'gpt-4', False).generate_response([{'role': 'user', 'content': 'hi'}])")
+
+    with MockServer(ttft=0, tokens_per_second=0, response_tokens=20) as server, \
+            tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, OPENAI_API_KEY="benchmark-key", OPENAI_BASE_URL=server.openai_url,
+                   AWB_DATA_DIR=directory, AWB_CACHE="0", AWB_DAEMON_SOCKET=os.path.join(directory, "daemon.sock"))
+
+        def spawn(daemon: str) -> float:
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", statement], env=dict(env, AWB_DAEMON=daemon), check=True)
+            return time.perf_counter() - start
+
+        local = _median(lambda: spawn("0"), repeat)
+        daemon = subprocess.Popen([sys.executable, "-m", "ai_workbench.cli", "serve"], env=env,
+                                  stdout=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(env["AWB_DAEMON_SOCKET"]):
+                time.sleep(0.01)
+            # The first client pays for loading the provider in the daemon
+            spawn("1")
+            shared = _median(lambda: spawn("1"), repeat)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    results.add("daemon.local_first_request_ms", local * 1000, "ms")
+    results.add("daemon.shared_first_request_ms", shared * 1000, "ms")
+
+
+def bench_history(results: Results, repeat: int):
+    """Recording, loading, suggesting and searching a 100,000-prompt history."""
+    import random
+    import tempfile
+    from pathlib import Path
+    from prompt_toolkit.history import FileHistory
+    from ai_workbench.history import HistoryStore
+
+    prompts = 100000
+    words = [f"word{i}" for i in range(2000)]
+    rng = random.Random(0)
+    texts = [" ".join(rng.choices(words, k=rng.randint(3, 20))) for _ in range(prompts)]
+    with tempfile.TemporaryDirectory() as root:
+        store = HistoryStore(Path(root) / "history.sqlite3", "project")
+        conn = store._connect()
+        now = time.time()
+        conn.executemany("INSERT OR IGNORE INTO history (project, text, used) VALUES ('project', ?, ?)",
+                         [(text, now - i) for i, text in enumerate(texts)])
+        conn.commit()
+
+        results.add("history.add_ms", _median(lambda: _timed(lambda: store.add(rng.choice(texts))), repeat) * 1000, "ms")
+        results.add("history.load_recent_ms",
+                    _median(lambda: _timed(lambda: list(store.recent(10000))), repeat) * 1000, "ms")
+        prefixes = ["word1", "word42 word7", "word1999 word", "nothing"]
+        results.add("history.suggest_ms", _median(
+            lambda: _timed(lambda: [store.suggest(prefix) for prefix in prefixes]) / len(prefixes), repeat) * 1000, "ms")
+        results.add("history.search_ms", _median(lambda: _timed(lambda: store.search("w42 w7")), repeat) * 1000, "ms")
+        store.close()
+
+        # What prompt_toolkit's FileHistory reads at startup for the same prompts
+        path = Path(root) / "file_history"
+        file_history = FileHistory(str(path))
+        for text in texts:
+            file_history.store_string(text)
+        results.add("history.file_history_load_ms",
+                    _median(lambda: _timed(lambda: list(FileHistory(str(path)).load_history_strings())), repeat) * 1000,
+                    "ms")
+
+
+def bench_index(results: Results, repeat: int):
+    """Building the code index of a copy of some stdlib packages, updating it and retrieving from it."""
+    import os
+    import shutil
+    import sysconfig
+    import tempfile
+    from pathlib import Path
+    from ai_workbench.codeindex import CodeIndex
+    from ai_workbench.tokens import get_estimator
+
+    stdlib = Path(sysconfig.get_paths()["stdlib"])
+    packages = ["asyncio", "email", "json", "http", "urllib", "concurrent", "importlib", "logging", "xml", "unittest"]
+    estimator = get_estimator("openai", "gpt-4")
+    prompts = ["how are callbacks scheduled in the event loop", "parse a MIME multipart message",
+               "where does HTTPResponse read chunked transfer encoding", "TestCase.assertRaises"]
+    with tempfile.TemporaryDirectory() as root:
+        tree = Path(root) / "tree"
+        for package in packages:
+            shutil.copytree(stdlib / package, tree / package, ignore=shutil.ignore_patterns("__pycache__"))
+        builds = []
+        for i in range(max(1, repeat // 3)):
+            index = CodeIndex(tree, Path(root) / f"index{i}.sqlite3")
+            builds.append(_timed(index.update))
+            index.close()
+        index = CodeIndex(tree, Path(root) / "index0.sqlite3")
+        results.add("index.files", index.stats()["indexed"], "files", better="higher")
+        results.add("index.build_s", statistics.median(builds), "s")
+        results.add("index.update_unchanged_ms", _median(lambda: _timed(index.update), repeat) * 1000, "ms")
+
+        target = tree / "asyncio" / "events.py"
+
+        def touch_and_update():
+            # Same content, new mtime: hashed again, not re-chunked
+            os.utime(target)
+            return _timed(index.update)
+
+        results.add("index.update_touched_ms", _median(touch_and_update, repeat) * 1000, "ms")
+        results.add("index.retrieve_ms", _median(
+            lambda: _timed(lambda: [index.retrieve(prompt, 3000, estimator.count) for prompt in prompts]) / len(prompts),
+            repeat) * 1000, "ms")
+        index.close()
+
+
+def _timed(run: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+
+SUITES = {
+    "stream": bench_stream,
+    "throughput": bench_throughput,
+    "render": bench_render,
+    "startup": bench_startup,
+    "memory": bench_memory,
+    "cache": bench_cache,
+    "search": bench_search,
+    "cancel": bench_cancel,
+    "resume": bench_resume,
+    "attach": bench_attach,
+    "daemon": bench_daemon,
+    "history": bench_history,
+    "index": bench_index,
+}
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Return descriptions of metrics that regressed by more than ``threshold`` percent."""
+    regressions = []
+    for name, metric in current["metrics"].items():
+        old = baseline.get("metrics", {}).get(name)
+        if old is None or not old["value"]:
+            continue
+        change = (metric["value"] - old["value"]) / abs(old["value"]) * 100
+        if metric["better"] == "higher":
+            change = -change
+        if change > threshold:
+            regressions.append(f"{name}: {old['value']} -> {metric['value']} {metric['unit']} ({change:+.1f}% worse)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES), help="Suite to run (repeatable; default all)")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions per measurement (median is reported)")
+    parser.add_argument("--output", "-o", default="benchmark-results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", metavar="BASELINE", help="Baseline results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=20.0, help="Regression threshold in percent")
+    args = parser.parse_args(argv)
+
+    results = Results()
+    for name in args.suite or SUITES:
+        print(f"{name}:")
+        SUITES[name](results, args.repeat)
+
+    report = {
+        "meta": {
+            "version": __version__,
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "metrics": results.metrics,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"No regressions over {args.threshold:.0f}% against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,8 +6,8 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
-        "openai>=1.0.0",
-        "anthropic>=0.18.0",
+        "openai>=1.26.0",
+        "anthropic>=0.25.0",
         "google-generativeai>=0.3.0",
         "click>=8.1.0",
         "rich>=13.0.0",